@@ -1,9 +1,5 @@
 # Authors: Kyle Kastner
 from __future__ import print_function
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
 try:
     import Queue
 except ImportError:
@@ -13,21 +9,26 @@ try:
 except ImportError:
     import urllib2 as urllib
 try:
-    import cPickle as pickle
+    import copyreg
 except ImportError:
-    import pickle
+    import copy_reg as copyreg
 import heapq
 import copy
+import json
 import threading
+import multiprocessing
 import logging
+import logging.handlers
 import uuid
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import socket
 import random
 import os
 import glob
+import fnmatch
 import subprocess
 import numpy as np
+import itertools
 from itertools import cycle
 import __main__ as main
 import re
@@ -50,12 +51,80 @@ logging.basicConfig(level=logging.INFO,
                     format='%(message)s')
 logger = logging.getLogger(__name__)
 
-string_f = StringIO()
-ch = logging.StreamHandler(string_f)
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the last capacity formatted records in memory
+
+    Every record gets a sequence number, so readers can ask for only the
+    lines they have not seen with tail(since). Records which fall out of
+    the ring can optionally be kept on disk with spill_to.
+
+    Parameters
+    ----------
+    capacity : int, default 10000
+        Number of formatted records to keep
+    """
+    def __init__(self, capacity=10000):
+        logging.Handler.__init__(self)
+        self.capacity = capacity
+        self.records = deque(maxlen=capacity)
+        self.count = 0
+        self.spill_handler = None
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + "\n"
+        except Exception:
+            self.handleError(record)
+            return
+        # handle() holds self.lock here
+        self.records.append(line)
+        self.count += 1
+        if self.spill_handler is not None:
+            self.spill_handler.handle(record)
+
+    def tail(self, since=0):
+        """
+        Lines with sequence number >= since which are still in the ring
+
+        Returns (lines, count), pass count as since to get only newer lines
+        """
+        self.acquire()
+        try:
+            n_new = min(self.count - since, len(self.records))
+            if n_new <= 0:
+                return [], self.count
+            if n_new == len(self.records):
+                lines = list(self.records)
+            else:
+                lines = list(itertools.islice(
+                    self.records, len(self.records) - n_new, None))
+            return lines, self.count
+        finally:
+            self.release()
+
+    def spill_to(self, save_path, max_bytes=10 * 1024 * 1024,
+                 backup_count=5):
+        """ Also write every record to a size-rotated log file """
+        spill_handler = logging.handlers.RotatingFileHandler(
+            save_path, maxBytes=max_bytes, backupCount=backup_count)
+        spill_handler.setFormatter(logging.Formatter('%(message)s'))
+        self.acquire()
+        try:
+            old_handler = self.spill_handler
+            self.spill_handler = spill_handler
+        finally:
+            self.release()
+        if old_handler is not None:
+            old_handler.close()
+
+
+log_ring = RingBufferHandler()
 # Automatically put the HTML break characters on there
 formatter = logging.Formatter('%(message)s<br>')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+log_ring.setFormatter(formatter)
+logger.addHandler(log_ring)
 
 
 def get_logger():
@@ -75,6 +144,9 @@ def _get_finalize_train():
 def _set_finalize_train():
     global FINALIZE_TRAINING
     FINALIZE_TRAINING = True
+    # wake the timed writer so it can flush the best items and exit
+    with _timed_writer_condition:
+        _timed_writer_condition.notify_all()
 
 
 # Storage of internal shared
@@ -438,14 +510,639 @@ def set_shared_variables_in_function(func, list_of_values):
 
     list_of_values : list
         List of numpy arrays to add into shared variables
+        (memmapped arrays from load_weight_store are fine)
     """
-    # TODO : Add checking that sizes are OK
-    shared_variable_indices = [n for n, var in enumerate(func.maker.inputs)
-                               if isinstance(var.variable,
-                                             theano.compile.SharedVariable)]
-    shared_variables = [func.maker.inputs[i].variable
-                        for i in shared_variable_indices]
-    [s.set_value(v) for s, v in safe_zip(shared_variables, list_of_values)]
+    shared_variables = get_shared_variables_from_function(func)
+    for s, v in safe_zip(shared_variables, list_of_values):
+        current = s.get_value(borrow=True, return_internal_type=True)
+        if isinstance(current, np.ndarray):
+            if current.shape != v.shape:
+                raise ValueError("Shape mismatch for %s, expected %s got %s" %
+                                 (s, current.shape, v.shape))
+            # Copy straight into the existing storage, no temporaries
+            np.copyto(current, v, casting="same_kind")
+        else:
+            s.set_value(np.asarray(v))
+
+
+class _SnapshotPickler(dill.Pickler):
+    """
+    dill Pickler which writes snapshot state in place of live state
+
+    substitutes maps id(live_container) -> (live_container, frozen_copy).
+    functions maps id(function) -> (function, inputs_data), where
+    inputs_data replaces the input values the function reducer reads from
+    its live containers. Live objects are kept so their ids cannot be
+    reused while pickling.
+    """
+    def __init__(self, file, protocol, substitutes, functions):
+        dill.Pickler.__init__(self, file, protocol)
+        self._substitutes = substitutes
+        self._functions = functions
+
+    def save(self, obj, *args, **kwargs):
+        sub = self._substitutes.get(id(obj))
+        if sub is not None and sub[0] is obj:
+            obj = sub[1]
+        func = self._functions.get(id(obj))
+        if (func is not None and func[0] is obj and
+                id(obj) not in self.memo):
+            reducer = copyreg.dispatch_table.get(type(obj), None)
+            if reducer is not None:
+                # (constructor, (maker, input_storage, inputs_data, ...))
+                reduced = reducer(obj)
+                args = list(reduced[1])
+                args[2] = [live if frozen is None else frozen
+                           for live, frozen in safe_zip(args[2], func[1])]
+                self.save_reduce(reduced[0], tuple(args), obj=obj)
+                return
+        return dill.Pickler.save(self, obj, *args, **kwargs)
+
+
+class CheckpointSnapshot(object):
+    """
+    A frozen view of a checkpoint_dict, returned by ParameterSnapshot.take()
+
+    Theano functions are held by reference. The values of their shared
+    variables are copies held in buffers owned by the ParameterSnapshot,
+    their other inputs are copied, and frozen copies of every input
+    container point at those values. All other entries are deep copied
+    into self.results. Nothing live is read again by dump(), apart from
+    values which are not host arrays (device shared variables).
+
+    The writer calls release() once the snapshot is on disk, which hands the
+    buffers back for reuse. Anyone keeping a snapshot alive past a send must
+    call retain() first.
+    """
+    def __init__(self, owner, buffers, results, containers, inputs_data):
+        self.owner = owner
+        self.buffers = buffers
+        self.results = results
+        self.containers = containers
+        self.inputs_data = inputs_data
+        self.refcount = 1
+
+    def retain(self):
+        with self.owner.lock:
+            self.refcount += 1
+
+    def release(self):
+        with self.owner.lock:
+            self.refcount -= 1
+            if self.refcount == 0:
+                self.owner.free_buffers.append(self.buffers)
+                self.buffers = None
+                self.containers = None
+                self.inputs_data = None
+
+    def get_function_values(self, key):
+        """ Snapshot values for the shared variables of function key """
+        return [self.buffers[i] for i in self.owner.function_indices[key]]
+
+    def dump(self, f, protocol=-1):
+        """
+        Pickle as the original checkpoint_dict, using the snapshot values
+        """
+        functions = {}
+        pickle_item = dict(self.results)
+        for k in self.owner.function_keys:
+            func = self.owner.checkpoint_dict[k]
+            functions[id(func)] = (func, self.inputs_data[k])
+            pickle_item[k] = func
+        old_recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(40000)
+        _SnapshotPickler(f, protocol, self.containers,
+                         functions).dump(pickle_item)
+        sys.setrecursionlimit(old_recursion_limit)
+
+
+def _checkpoint_shared_variables(checkpoint_dict):
+    """
+    Theano function keys of checkpoint_dict, the shared variables they use
+    and, per key, the index of each of its variables in that list
+    """
+    function_keys = sorted([
+        k for k, v in checkpoint_dict.items()
+        if isinstance(v, theano.compile.function_module.Function)])
+    # Functions often share parameters, only list each variable once
+    shared_variables = []
+    function_indices = {}
+    seen = {}
+    for k in function_keys:
+        indices = []
+        for var in get_shared_variables_from_function(checkpoint_dict[k]):
+            if id(var) not in seen:
+                seen[id(var)] = len(shared_variables)
+                shared_variables.append(var)
+            indices.append(seen[id(var)])
+        function_indices[k] = indices
+    return function_keys, shared_variables, function_indices
+
+
+class ParameterSnapshot(object):
+    """
+    Double-buffered copies of all shared variables used by the theano
+    functions in checkpoint_dict
+
+    take() copies each parameter into a preallocated buffer, so the training
+    thread blocks for one memcpy per parameter. Serialization happens later,
+    from the buffers, in the writer thread.
+
+    Parameters
+    ----------
+    checkpoint_dict : dict
+        A checkpoint dictionary, as passed to TrainingLoop
+
+    n_buffers : int, default 2
+        Number of buffer sets to preallocate. More are allocated if the
+        writer falls behind.
+    """
+    def __init__(self, checkpoint_dict, n_buffers=2):
+        self.checkpoint_dict = checkpoint_dict
+        (self.function_keys, self.shared_variables,
+         self.function_indices) = _checkpoint_shared_variables(
+            checkpoint_dict)
+        self.lock = threading.Lock()
+        self.free_buffers = [self._allocate() for i in range(n_buffers)]
+
+    def _allocate(self):
+        return [np.empty_like(np.asarray(var.get_value(borrow=True)))
+                for var in self.shared_variables]
+
+    def take(self):
+        """ Copy current values, returns a CheckpointSnapshot """
+        with self.lock:
+            if len(self.free_buffers) > 0:
+                buffers = self.free_buffers.pop()
+            else:
+                buffers = None
+        if buffers is None:
+            buffers = self._allocate()
+        for n, var in enumerate(self.shared_variables):
+            value = np.asarray(var.get_value(borrow=True))
+            if value.shape != buffers[n].shape or (
+                    value.dtype != buffers[n].dtype):
+                buffers[n] = np.empty_like(value)
+            np.copyto(buffers[n], value)
+        # freeze every input container of every function, shared variable
+        # containers hold the buffers and other inputs hold copies
+        frozen_values = {}
+        for n, var in enumerate(self.shared_variables):
+            live = var.container.storage[0]
+            if isinstance(live, np.ndarray):
+                frozen_values[id(var.container)] = buffers[n]
+        containers = {}
+        inputs_data = {}
+        for k in self.function_keys:
+            data = []
+            for c in self.checkpoint_dict[k].input_storage:
+                if id(c) in frozen_values:
+                    frozen = frozen_values[id(c)]
+                elif id(c) in containers:
+                    frozen = containers[id(c)][1].storage[0]
+                elif isinstance(c.storage[0], np.ndarray):
+                    frozen = c.storage[0].copy()
+                elif isinstance(c.storage[0], (numbers.Number, np.generic)):
+                    frozen = c.storage[0]
+                else:
+                    # device values and python scalars are left as is
+                    frozen = None
+                if frozen is not None and id(c) not in containers:
+                    frozen_container = copy.copy(c)
+                    frozen_container.storage = [frozen]
+                    containers[id(c)] = (c, frozen_container)
+                data.append(frozen)
+            inputs_data[k] = data
+        results = {k: copy.deepcopy(v)
+                   for k, v in self.checkpoint_dict.items()
+                   if k not in self.function_keys}
+        return CheckpointSnapshot(self, buffers, results, containers,
+                                  inputs_data)
+
+
+class RunningStatistics(object):
+    """
+    Streaming statistics over a sequence of scalar costs
+
+    Every append is O(1) amortized. Values, the running mean and an
+    exponential moving average are kept per step in growable float64
+    buffers, and a fixed size reservoir sample gives approximate quantiles.
+
+    values(), running_mean() and ema() return views of the filled part of
+    the buffers. Entries are never overwritten, and both growth and reset()
+    allocate new buffers, so views handed to a writer thread stay valid.
+
+    Parameters
+    ----------
+    initial_size : int, default 1024
+        Initial buffer length, doubled whenever it fills
+
+    ema_decay : float, default 0.99
+        Decay of the exponential moving average
+
+    reservoir_size : int, default 1024
+        Number of values kept for quantile estimates
+
+    random_state : RandomState or None, default None
+        Used for reservoir sampling, defaults to a fixed seed
+    """
+    def __init__(self, initial_size=1024, ema_decay=0.99,
+                 reservoir_size=1024, random_state=None):
+        self.initial_size = initial_size
+        self.ema_decay = ema_decay
+        self.reservoir_size = reservoir_size
+        if random_state is None:
+            random_state = np.random.RandomState(1999)
+        self.random_state = random_state
+        self.reset()
+
+    def reset(self):
+        self._values = np.zeros((self.initial_size,), dtype="float64")
+        self._means = np.zeros_like(self._values)
+        self._emas = np.zeros_like(self._values)
+        self._reservoir = np.zeros((self.reservoir_size,), dtype="float64")
+        self.count = 0
+        self.total = 0.
+
+    def _grow(self):
+        new_size = 2 * len(self._values)
+        for name in ["_values", "_means", "_emas"]:
+            old = getattr(self, name)
+            new = np.zeros((new_size,), dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def append(self, value):
+        value = float(value)
+        n = self.count
+        if n == len(self._values):
+            self._grow()
+        self._values[n] = value
+        self.total += value
+        self._means[n] = self.total / (n + 1)
+        if n == 0:
+            self._emas[n] = value
+        else:
+            self._emas[n] = self.ema_decay * self._emas[n - 1] + (
+                1. - self.ema_decay) * value
+        if n < self.reservoir_size:
+            self._reservoir[n] = value
+        else:
+            j = self.random_state.randint(0, n + 1)
+            if j < self.reservoir_size:
+                self._reservoir[j] = value
+        self.count = n + 1
+
+    def __len__(self):
+        return self.count
+
+    def values(self):
+        return self._values[:self.count]
+
+    def running_mean(self):
+        return self._means[:self.count]
+
+    def ema(self):
+        return self._emas[:self.count]
+
+    def mean(self):
+        if self.count == 0:
+            return np.nan
+        return self._means[self.count - 1]
+
+    def quantiles(self, q=(0.05, 0.5, 0.95)):
+        """ Approximate quantiles of all values, from the reservoir """
+        if self.count == 0:
+            return np.nan * np.ones((len(q),))
+        n = min(self.count, self.reservoir_size)
+        return np.percentile(self._reservoir[:n], 100. * np.asarray(q))
+
+
+class PhaseProfiler(object):
+    """
+    Low overhead timings of the phases of a training loop
+
+    Each record is (phase, start, duration, thread) stored in preallocated
+    numpy ring buffers, so memory is fixed and only the most recent
+    ring_size records are kept. run_loop records these phases
+
+    train_fetch, valid_fetch - time spent in next() on the iterators
+    train_compute, valid_compute - rest of the loop function call
+    nan_check - reducing the returned costs and checking for NaN
+    enqueue - blocked in a send to the checkpoint writers
+    writer_io - serialization in the shared writer thread
+
+    Hooks added with add_hook are called as hook(phase, start, duration)
+    after every record.
+
+    Parameters
+    ----------
+    ring_size : int, default 65536
+        Number of records to keep
+
+    percentiles : tuple, default (50, 95, 99)
+        Percentiles reported by summary()
+    """
+    def __init__(self, ring_size=65536, percentiles=(50, 95, 99)):
+        self.ring_size = ring_size
+        self.percentiles = percentiles
+        self.phase_names = []
+        self.phase_ids = {}
+        self.hooks = []
+        self.origin = time.time()
+        self.count = 0
+        self.lock = threading.Lock()
+        self._phases = np.zeros((ring_size,), dtype="int16")
+        self._starts = np.zeros((ring_size,), dtype="float64")
+        self._durations = np.zeros((ring_size,), dtype="float64")
+        self._threads = np.zeros((ring_size,), dtype="int64")
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def _phase_id(self, phase):
+        if phase not in self.phase_ids:
+            self.phase_ids[phase] = len(self.phase_names)
+            self.phase_names.append(phase)
+        return self.phase_ids[phase]
+
+    def record(self, phase, start, duration):
+        """ Add one timing, start from time.time() and duration in seconds """
+        thread_id = threading.current_thread().ident % (2 ** 31)
+        with self.lock:
+            i = self.count % self.ring_size
+            self._phases[i] = self._phase_id(phase)
+            self._starts[i] = start
+            self._durations[i] = duration
+            self._threads[i] = thread_id
+            self.count += 1
+        for hook in self.hooks:
+            hook(phase, start, duration)
+
+    def _records(self, since=0):
+        # records since the given count which are still in the ring
+        with self.lock:
+            count = self.count
+            start = max(since, count - self.ring_size, 0)
+            idx = np.arange(start, count) % self.ring_size
+            return (self._phases[idx], self._starts[idx],
+                    self._durations[idx], self._threads[idx])
+
+    def summary(self, since=0):
+        """
+        Percentiles of each phase in ms, keyed "profile_<phase>_p<q>_auto"
+
+        Only records made after the count since are used.
+        """
+        phases, starts, durations, threads = self._records(since)
+        summary = {}
+        for phase_id, phase in enumerate(list(self.phase_names)):
+            d = durations[phases == phase_id]
+            if len(d) == 0:
+                continue
+            values = np.percentile(1000. * d, self.percentiles)
+            for q, v in safe_zip(self.percentiles, values):
+                summary["profile_%s_p%i_auto" % (phase, q)] = float(v)
+        return summary
+
+    def save_chrome_trace(self, save_path, use_resource_dir=True):
+        """
+        Write the records in the ring as a Chrome trace (chrome://tracing)
+        """
+        phases, starts, durations, threads = self._records()
+        pid = os.getpid()
+        events = [{"name": self.phase_names[p], "ph": "X", "pid": pid,
+                   "tid": int(t), "ts": 1E6 * (s - self.origin),
+                   "dur": 1E6 * d}
+                  for p, s, d, t in safe_zip(phases, starts, durations,
+                                             threads)]
+        if use_resource_dir:
+            save_path = os.path.join(get_checkpoint_dir(), save_path)
+        tmp_path = save_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        os.rename(tmp_path, save_path)
+        logger.info("Saved profile trace %s" % save_path)
+
+
+class _ProfiledIterator(object):
+    """
+    Proxy which records the time spent in next() as phase
+
+    total_duration accumulates over all next() calls, so the caller can
+    subtract fetch time from a surrounding measurement.
+    """
+    def __init__(self, iterator, profiler, phase):
+        self.iterator = iterator
+        self.profiler = profiler
+        self.phase = phase
+        self.total_duration = 0.
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        item = next(self.iterator)
+        duration = time.time() - start
+        self.total_duration += duration
+        self.profiler.record(self.phase, start, duration)
+        return item
+
+    next = __next__
+
+    def __getattr__(self, name):
+        return getattr(self.iterator, name)
+
+
+# One manifest per checkpoint directory, cached in memory and guarded by
+# _manifest_lock. Writers record artifacts as they save them, so lookups
+# by kind, number or objective never have to list or stat the directory.
+_MANIFEST_NAME = "dagbldr_manifest.json"
+_manifest_lock = threading.Lock()
+_manifest_cache = {}
+
+
+def _artifact_kind(name):
+    if name.endswith(".pkl"):
+        if "object" in name:
+            return "object"
+        elif "results" in name:
+            return "results"
+        return "checkpoint"
+    elif name.endswith(".json") and "weights" in name:
+        return "weights"
+    elif name.endswith(".bin"):
+        return "weight_data"
+    elif name.endswith(".html"):
+        return "results"
+    else:
+        return "other"
+
+
+def _artifact_number(name):
+    try:
+        return int(name.split(".")[0].split("_")[-1])
+    except ValueError:
+        return None
+
+
+def _artifact_entry(path, objective=None, stat=None):
+    if stat is None:
+        stat = os.stat(path)
+    name = os.path.basename(path)
+    if objective is not None:
+        objective = float(objective)
+        if not np.isfinite(objective):
+            objective = None
+    return {"kind": _artifact_kind(name),
+            "number": _artifact_number(name),
+            "objective": objective,
+            "size": stat.st_size,
+            "time": stat.st_mtime}
+
+
+def _scan_checkpoint_dir(directory):
+    # Fallback for directories written before the manifest existed
+    artifacts = {}
+    for name in os.listdir(directory):
+        if (name == _MANIFEST_NAME or name.endswith(".tmp") or
+                name.endswith(".data.js")):
+            continue
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            artifacts[name] = _artifact_entry(path)
+    return artifacts
+
+
+def _write_manifest(directory, artifacts):
+    manifest_path = os.path.join(directory, _MANIFEST_NAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"format": "dagbldr_manifest", "version": 1,
+                   "artifacts": artifacts}, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, manifest_path)
+    _manifest_cache[directory] = (_manifest_key(manifest_path), artifacts)
+
+
+def _manifest_key(manifest_path):
+    # st_mtime alone can miss a rewrite within the timestamp resolution,
+    # every rewrite is a rename so the inode changes as well
+    try:
+        st = os.stat(manifest_path)
+    except OSError:
+        return None
+    return (getattr(st, "st_mtime_ns", st.st_mtime), st.st_size, st.st_ino)
+
+
+def _get_manifest_artifacts(directory):
+    # Call with _manifest_lock held
+    manifest_path = os.path.join(directory, _MANIFEST_NAME)
+    key = _manifest_key(manifest_path)
+    if key is None:
+        artifacts = _scan_checkpoint_dir(directory)
+        _write_manifest(directory, artifacts)
+        return artifacts
+    cached = _manifest_cache.get(directory, None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    # another process updated it
+    with open(manifest_path, "r") as f:
+        artifacts = json.load(f)["artifacts"]
+    _manifest_cache[directory] = (key, artifacts)
+    return artifacts
+
+
+def record_artifact(save_path, objective=None):
+    """
+    Add or update save_path in the manifest of its directory
+
+    objective is the cost associated with the artifact, used by
+    get_best_artifact. Non-finite objectives are stored as None.
+    """
+    directory = os.path.dirname(os.path.abspath(save_path))
+    entry = _artifact_entry(save_path, objective)
+    with _manifest_lock:
+        artifacts = dict(_get_manifest_artifacts(directory))
+        artifacts[os.path.basename(save_path)] = entry
+        _write_manifest(directory, artifacts)
+
+
+def forget_artifact(save_path):
+    """
+    Remove save_path, or each path in a list, from the manifest of its
+    directory, with one manifest write per directory
+    """
+    if isinstance(save_path, (list, tuple)):
+        save_paths = save_path
+    else:
+        save_paths = [save_path]
+    by_directory = defaultdict(list)
+    for path in save_paths:
+        by_directory[os.path.dirname(os.path.abspath(path))].append(
+            os.path.basename(path))
+    with _manifest_lock:
+        for directory, names in by_directory.items():
+            artifacts = _get_manifest_artifacts(directory)
+            names = [name for name in names if name in artifacts]
+            if len(names) > 0:
+                artifacts = dict(artifacts)
+                for name in names:
+                    del artifacts[name]
+                _write_manifest(directory, artifacts)
+
+
+def get_manifest(checkpoint_dir=None):
+    """
+    Artifacts recorded for checkpoint_dir, default get_checkpoint_dir()
+
+    Returns a dict of file name to a dict with kind, number, objective,
+    size and time
+    """
+    if checkpoint_dir is None:
+        checkpoint_dir = get_checkpoint_dir()
+    with _manifest_lock:
+        return copy.deepcopy(_get_manifest_artifacts(
+            os.path.abspath(checkpoint_dir)))
+
+
+def _select_artifacts(kind, append_name, checkpoint_dir):
+    if checkpoint_dir is None:
+        checkpoint_dir = get_checkpoint_dir()
+    artifacts = get_manifest(checkpoint_dir)
+    return [(os.path.join(checkpoint_dir, name), entry)
+            for name, entry in artifacts.items()
+            if entry["kind"] == kind and (
+                append_name is None or append_name in name)]
+
+
+def get_latest_artifact(kind, append_name=None, checkpoint_dir=None):
+    """
+    Path of the artifact of kind with the highest number, or None
+
+    kind is one of "checkpoint", "weights", "weight_data", "results",
+    "object" or "other"
+    """
+    selected = [(entry["number"], entry["time"], path)
+                for path, entry in _select_artifacts(
+                    kind, append_name, checkpoint_dir)
+                if entry["number"] is not None]
+    if len(selected) == 0:
+        return None
+    return max(selected)[2]
+
+
+def get_best_artifact(kind, append_name=None, checkpoint_dir=None):
+    """ Path of the artifact of kind with the lowest objective, or None """
+    selected = [(entry["objective"], entry["time"], path)
+                for path, entry in _select_artifacts(
+                    kind, append_name, checkpoint_dir)
+                if entry["objective"] is not None]
+    if len(selected) == 0:
+        return None
+    # latest wins on ties
+    best = min([s[0] for s in selected])
+    return max([s for s in selected if s[0] == best])[2]
 
 
 def load_checkpoint(saved_checkpoint_path):
@@ -460,30 +1157,31 @@ def load_checkpoint(saved_checkpoint_path):
 
 def load_last_checkpoint(append_name=None):
     """ Simple pickle wrapper for checkpoint dictionaries """
-    save_paths = glob.glob(os.path.join(get_checkpoint_dir(), "*.pkl"))
-    save_paths = [s for s in save_paths if "results" not in s]
-    if append_name is not None:
-        save_paths = [s.split(append_name)[:-1] + s.split(append_name)[-1:]
-                      for s in save_paths]
-    sorted_paths = get_file_matches("*.pkl", "best")
-    sorted_paths = [s for s in sorted_paths if "results" not in s]
-    if len(sorted_paths) == 0:
+    last_checkpoint_path = get_latest_artifact("checkpoint", "best")
+    if last_checkpoint_path is None:
         raise ValueError("No checkpoint found in %s" % get_checkpoint_dir())
-    last_checkpoint_path = sorted_paths[-1]
     logger.info("Loading checkpoint from %s" % last_checkpoint_path)
     return load_checkpoint(last_checkpoint_path)
 
 
+def _in_checkpoint_dir(path):
+    checkpoint_dir = os.path.abspath(get_checkpoint_dir(create_dir=False))
+    return os.path.dirname(os.path.abspath(path)) == checkpoint_dir
+
+
 def write_results_as_html(results_dict, save_path, default_show="all"):
-    as_html = filled_js_template_from_results_dict(
-        results_dict, default_show=default_show)
-    with open(save_path, "w") as f:
-        f.writelines(as_html)
+    write_results_report(save_path, results_dict, default_show=default_show)
+    # only checkpoint directories carry a manifest
+    if _in_checkpoint_dir(save_path):
+        record_artifact(save_path)
 
 
 def get_file_matches(glob_ext, append_name):
-    all_files = glob.glob(
-        os.path.join(get_checkpoint_dir(), glob_ext))
+    # answered from the directory manifest rather than a glob
+    checkpoint_dir = get_checkpoint_dir()
+    all_files = [os.path.join(checkpoint_dir, name)
+                 for name in sorted(get_manifest(checkpoint_dir).keys())
+                 if fnmatch.fnmatch(name, glob_ext)]
     if append_name is None:
         # This 3 is definitely brittle - need better checks
         selected = [f for n, f in enumerate(all_files)
@@ -512,25 +1210,41 @@ def argsort(seq):
 
 
 def remove_old_files(sorted_files_list):
+    """ Remove all but the NUM_SAVED_TO_KEEP latest files, returns those """
     n_saved_to_keep = NUM_SAVED_TO_KEEP
+    removed = []
     if len(sorted_files_list) > n_saved_to_keep:
-        times = [os.path.getctime(f) for f in sorted_files_list]
+        # write times come from the manifest when files were recorded
+        artifacts = {}
+        for d in set([os.path.dirname(f) for f in sorted_files_list]):
+            for name, entry in get_manifest(d).items():
+                artifacts[os.path.join(d, name)] = entry
+        times = [artifacts[f]["time"] if f in artifacts
+                 else os.path.getctime(f) for f in sorted_files_list]
         times_rank = argsort(times)
         for t, f in zip(times_rank, sorted_files_list):
             if t not in range(0, len(times))[-n_saved_to_keep:]:
-                os.remove(f)
+                if os.path.exists(f):
+                    os.remove(f)
+                removed.append(f)
+        forget_artifact(removed)
+    return removed
 
 
 def cleanup_monitors(partial_match, append_name=None):
     selected_monitors = get_file_matches(
         "*" + partial_match + "*.html", append_name)
-    remove_old_files(selected_monitors)
+    # reports are an HTML viewer plus a data sidecar
+    for f in remove_old_files(selected_monitors):
+        _remove_report_files(f)
 
 
 def cleanup_checkpoints(append_name=None):
     selected_checkpoints = get_file_matches("*.pkl", append_name)
     remove_old_files(selected_checkpoints)
-    selected_checkpoints = get_file_matches("*.npz", append_name)
+    selected_checkpoints = get_file_matches("*.json", append_name)
+    remove_old_files(selected_checkpoints)
+    selected_checkpoints = get_file_matches("*.bin", append_name)
     remove_old_files(selected_checkpoints)
 
 
@@ -569,9 +1283,8 @@ def archive_dagbldr():
     lib_dir = str(os.sep).join(save_script_path.split(os.sep)[:-2])
     save_lib_path = code_snapshot_dir + os.path.sep + "dagbldr_archive.zip"
 
-    existing_reports = glob.glob(os.path.join(checkpoint_dir, "*.html"))
-    existing_models = glob.glob(os.path.join(checkpoint_dir, "*.pkl"))
-    empty = all([len(l) == 0 for l in (existing_reports, existing_models)])
+    kinds = [entry["kind"] for entry in get_manifest(checkpoint_dir).values()]
+    empty = all([k not in kinds for k in ("results", "checkpoint")])
     if not os.path.exists(save_script_path) or empty:
         logger.info("Saving code archive %s at %s" % (lib_dir, save_lib_path))
         script_name = get_script() + ".py"
@@ -646,7 +1359,7 @@ def checkpoint_status_func(training_loop, results,
     checkpoint_save_path = os.path.join(
         get_checkpoint_dir(), "model_checkpoint_%i.pkl" % n_seen)
     weight_save_path = os.path.join(
-        get_checkpoint_dir(), "model_weights_%i.npz" % n_seen)
+        get_checkpoint_dir(), "model_weights_%i.json" % n_seen)
     results_save_path = os.path.join(
         get_checkpoint_dir(), "model_results_%i.pkl" % n_seen)
     if append_name is not None:
@@ -708,65 +1421,189 @@ def make_minibatch(arg, slice_or_indices_list):
         return [arg[slice_or_indices_list]]
 
 
-def make_masked_minibatch(arg, slice_or_indices_list):
-    """ Create masked minibatches
-        returns list of [arg, mask]
+def length_mask(lengths, time_major=True, dtype=None):
+    """
+    Mask with ones for the first lengths[n] steps of sample n
+
+    Returns (max_len, batch) if time_major, else (batch, max_len)
+    """
+    if dtype is None:
+        dtype = theano.config.floatX
+    lengths = np.asarray(lengths)
+    max_len = np.max(lengths) if len(lengths) > 0 else 0
+    mask = (np.arange(max_len)[:, None] < lengths[None, :]).astype(dtype)
+    if not time_major:
+        mask = mask.T.copy()
+    return mask
+
+
+class RaggedArray(object):
     """
-    sliced = arg[slice_or_indices_list]
-    is_two_d = True
-    if len(sliced[0].shape) > 1:
-        is_two_d = False
+    Ragged sequences stored as one flat array plus offsets
 
-    if hasattr(arg, 'shape'):
-        # should handle numpy arrays and hdf5
-        if is_two_d:
-            data = arg[slice_or_indices_list]
-            mask = np.ones_like(data[:, 0]).astype(theano.config.floatX)
+    Sequence n is flat[offsets[n]:offsets[n + 1]]. padded() builds padded
+    minibatches and masks with a single vectorized scatter, optionally
+    into buffers which are reused across calls.
+
+    Parameters
+    ----------
+    sequences : list or object array
+        Arrays (or lists) which share all dimensions but the first
+    """
+    def __init__(self, sequences):
+        sequences = [np.asarray(s) for s in sequences]
+        self.lengths = np.array([len(s) for s in sequences], dtype="int64")
+        self.offsets = np.zeros((len(sequences) + 1,), dtype="int64")
+        self.offsets[1:] = np.cumsum(self.lengths)
+        if len(sequences) > 0:
+            self.feature_shape = sequences[0].shape[1:]
+            self.flat = np.concatenate(sequences, axis=0)
         else:
-            data = arg[:, slice_or_indices_list]
-            mask = np.ones_like(data[:, :, 0]).astype(theano.config.floatX)
-        return [data, mask]
+            self.feature_shape = ()
+            self.flat = np.zeros((0,))
+        self._buffers = {}
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _storage(self, slot, name, shape, dtype):
+        # contiguous view into a buffer which grows to the largest request
+        size = int(np.prod(shape))
+        key = (slot, name)
+        buf = self._buffers.get(key, None)
+        if buf is None or buf.dtype != dtype or len(buf) < size:
+            buf = np.empty((size,), dtype=dtype)
+            self._buffers[key] = buf
+        return buf[:size].reshape(shape)
+
+    def padded(self, ind, time_major=True, dtype=None, mask_dtype=None,
+               slot=None):
+        """
+        Padded data and mask for the sequences selected by ind
+
+        Parameters
+        ----------
+        ind : slice or array of int
+            Which sequences to take
+
+        time_major : bool, default True
+            Data is (max_len, batch) + feature_shape and mask is
+            (max_len, batch) if True, batch first otherwise
+
+        dtype : dtype or None, default None
+            Data dtype, defaults to the dtype of the sequences
+
+        mask_dtype : dtype or None, default None
+            Mask dtype, defaults to theano.config.floatX
+
+        slot : hashable or None, default None
+            If not None, write into the buffers for slot, which are reused
+            and overwritten by the next call with the same slot
+
+        Returns
+        -------
+        data, mask : ndarray
+        """
+        if dtype is None:
+            dtype = self.flat.dtype
+        if mask_dtype is None:
+            mask_dtype = theano.config.floatX
+        idx = np.arange(len(self.lengths))[ind]
+        lengths = self.lengths[idx]
+        batch_size = len(idx)
+        max_len = int(np.max(lengths)) if batch_size > 0 else 0
+        if time_major:
+            shape = (max_len, batch_size)
+        else:
+            shape = (batch_size, max_len)
+        data_shape = shape + tuple(self.feature_shape)
+        if slot is None:
+            data = np.zeros(data_shape, dtype=dtype)
+            mask = np.zeros(shape, dtype=mask_dtype)
+        else:
+            data = self._storage(slot, "data", data_shape, np.dtype(dtype))
+            mask = self._storage(slot, "mask", shape, np.dtype(mask_dtype))
+            data.fill(0)
+            mask.fill(0)
+        # position of every real step in the flat array and in the batch
+        batch_pos = np.repeat(np.arange(batch_size), lengths)
+        starts = np.cumsum(lengths) - lengths
+        time_pos = np.arange(len(batch_pos)) - np.repeat(starts, lengths)
+        src = np.repeat(self.offsets[idx], lengths) + time_pos
+        if time_major:
+            data[time_pos, batch_pos] = self.flat[src]
+            mask[time_pos, batch_pos] = 1
+        else:
+            data[batch_pos, time_pos] = self.flat[src]
+            mask[batch_pos, time_pos] = 1
+        return data, mask
+
+
+def _ragged_minibatch(arg, ind, time_major, dtype, slot):
+    # a RaggedArray argument is used as is, so slot buffers can be reused,
+    # a list is only assembled for the sequences in ind
+    if isinstance(arg, RaggedArray):
+        return arg.padded(ind, time_major=time_major, dtype=dtype, slot=slot)
+    if type(ind) is slice:
+        sliced = arg[ind]
+    else:
+        sliced = [arg[i] for i in ind]
+    return RaggedArray(sliced).padded(slice(None), time_major=time_major,
+                                      dtype=dtype)
+
+
+def make_masked_minibatch(arg, slice_or_indices_list, slot=None):
+    """ Create masked minibatches
+        returns list of [arg, mask]
+
+        arg may be a RaggedArray built once for the whole dataset. With
+        slot, its minibatches are written into buffers which are reused
+        and overwritten by the next call with the same slot.
+    """
+    if isinstance(arg, RaggedArray):
+        is_two_d = len(arg.feature_shape) == 0
+        dtype = arg.flat.dtype
+    else:
+        sliced = arg[slice_or_indices_list]
+        is_two_d = True
+        if len(sliced[0].shape) > 1:
+            is_two_d = False
+
+        if hasattr(arg, 'shape'):
+            # should handle numpy arrays and hdf5
+            if is_two_d:
+                data = arg[slice_or_indices_list]
+                mask = np.ones_like(data[:, 0]).astype(theano.config.floatX)
+            else:
+                data = arg[:, slice_or_indices_list]
+                mask = np.ones_like(
+                    data[:, :, 0]).astype(theano.config.floatX)
+            return [data, mask]
+        dtype = sliced[0].dtype
 
     if is_two_d:
         # list of lists
-        d0 = [s.shape[0] for s in sliced]
-        max_len = max(d0)
-        batch_size = len(sliced)
-        data = np.zeros((batch_size, max_len)).astype(sliced[0].dtype)
-        mask = np.zeros((batch_size, max_len)).astype(theano.config.floatX)
-        for n, s in enumerate(sliced):
-            data[n, :len(s)] = s
-            mask[n, :len(s)] = 1
+        data, mask = _ragged_minibatch(arg, slice_or_indices_list,
+                                       False, dtype, slot)
     else:
         # list of arrays
-        d0 = [s.shape[0] for s in sliced]
-        d1 = [s.shape[1] for s in sliced]
-        max_len = max(d0)
-        batch_size = len(sliced)
-        dim = d1[0]
-        same_dim = all([d == dim for d in d1])
-        assert same_dim
-        data = np.zeros((max_len, batch_size, dim)).astype(theano.config.floatX)
-        mask = np.zeros((max_len, batch_size)).astype(theano.config.floatX)
-        for n, s in enumerate(sliced):
-            data[:len(s), n] = s
-            mask[:len(s), n] = 1
+        data, mask = _ragged_minibatch(arg, slice_or_indices_list,
+                                       True, theano.config.floatX, slot)
     return [data, mask]
 
 
-def make_embedding_minibatch(arg, slice_type):
+def make_embedding_minibatch(arg, slice_type, slot=None):
+    """ Padded int32 rows and (max_len, batch) mask for a list of lists
+
+        arg may be a RaggedArray built once for the whole dataset. With
+        slot, the rows are views into buffers which are reused and
+        overwritten by the next call with the same slot.
+    """
     if type(slice_type) is not slice:
         raise ValueError("Text formatters for list of list can only use "
                          "slice objects")
-    sli = arg[slice_type]
-    lengths = [len(s) for s in sli]
-    maxlen = max(lengths)
-    mask = np.zeros((max(lengths), len(sli)), dtype=theano.config.floatX)
-    expanded = [np.zeros((maxlen,), dtype="int32") for s in sli]
-    for n, l in enumerate(lengths):
-        mask[:l, n] = 1.
-        expanded[n][:l] = sli[n]
-    return expanded, mask
+    data, mask = _ragged_minibatch(arg, slice_type, False, "int32", slot)
+    return list(data), mask.T.copy()
 
 
 def gen_make_one_hot_minibatch(n_targets):
@@ -783,11 +1620,7 @@ def gen_make_masked_one_hot_minibatch(n_targets):
     def make_masked_one_hot_minibatch(arg, slice_or_indices_list):
         non_one_hot_minibatch = make_minibatch(
             arg, slice_or_indices_list)[0].squeeze()
-        max_len = max([len(i) for i in non_one_hot_minibatch])
-        mask = np.zeros((max_len, len(non_one_hot_minibatch))).astype(
-            theano.config.floatX)
-        for n, i in enumerate(non_one_hot_minibatch):
-            mask[:len(i), n] = 1.
+        mask = length_mask([len(i) for i in non_one_hot_minibatch])
         return [convert_to_one_hot(non_one_hot_minibatch, n_targets), mask]
     return make_masked_one_hot_minibatch
 
@@ -813,10 +1646,7 @@ def gen_make_list_one_hot_minibatch(n_targets):
                              "slice objects")
         sli = arg[slice_type]
         expanded = convert_to_one_hot(sli, n_targets)
-        lengths = [len(s) for s in sli]
-        mask = np.zeros((max(lengths), len(sli)), dtype=theano.config.floatX)
-        for n, l in enumerate(lengths):
-            mask[np.arange(l), n] = 1.
+        mask = length_mask([len(s) for s in sli])
         return expanded, mask
     return make_list_one_hot_minibatch
 
@@ -1052,35 +1882,203 @@ def archive(tag=None):
 def coroutine(func):
     def start(*args,**kwargs):
         cr = func(*args,**kwargs)
-        cr.next()
+        next(cr)
         return cr
     return start
 
 
-def save_weights(save_path, items_dict, use_resource_dir=True):
-    logger.info("Not saving weights due to copy issues in npz")
-    return
-    weights_dict = {}
-    # k is the function name, v is a theano function
-    for k, v in items_dict.items():
-        if isinstance(v, theano.compile.function_module.Function):
-            # w is all the numpy values from a function
-            w = get_values_from_function(v)
-            for n, w_v in enumerate(w):
+# Offsets in the weight store data file are aligned to this many bytes
+_WEIGHT_STORE_ALIGNMENT = 64
+
+
+def _weight_store_data_path(save_path):
+    return os.path.splitext(save_path)[0] + ".bin"
+
+
+def _json_default(obj):
+    # numpy scalars and arrays which end up in results dicts, anything else
+    # is stored as its repr rather than failing the save
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return repr(obj)
+
+
+def _is_json_scalar(v):
+    return (v is None or isinstance(v, (numbers.Number, np.generic)) or
+            isinstance(v, (str, type(u""))))
+
+
+def _json_results(results):
+    """
+    The entries of results which are scalars or flat sequences of scalars,
+    such as train_costs and the *_auto series
+    """
+    kept = {}
+    for k, v in results.items():
+        if isinstance(v, np.ndarray) and v.ndim <= 1:
+            v = v.tolist()
+        if _is_json_scalar(v) or (
+                isinstance(v, (list, tuple)) and
+                all([_is_json_scalar(vi) for vi in v])):
+            kept[k] = v
+    return kept
+
+
+def save_weight_store(save_path, named_arrays, results=None):
+    """
+    Save arrays as one raw contiguous file plus a small JSON index
+
+    The index at save_path lists name, dtype, shape and offset for each
+    array, the data goes to the same path with a .bin extension. Both are
+    written to temporary files and renamed, index last, so a visible index
+    always points to complete data.
+
+    Parameters
+    ----------
+    save_path : str
+        Path for the JSON index, conventionally ending in .json
+
+    named_arrays : OrderedDict
+        {name: array}, written in iteration order
+
+    results : dict, optional
+        Results to store alongside the index, values JSON can not encode
+        are stored as their repr
+    """
+    data_path = _weight_store_data_path(save_path)
+    arrays = []
+    index = []
+    offset = 0
+    for name, arr in named_arrays.items():
+        arr = np.ascontiguousarray(arr)
+        offset += -offset % _WEIGHT_STORE_ALIGNMENT
+        index.append({"name": name,
+                      "dtype": arr.dtype.str,
+                      "shape": list(arr.shape),
+                      "offset": offset})
+        arrays.append((offset, arr))
+        offset += arr.nbytes
+    tmp_data_path = data_path + ".tmp"
+    with open(tmp_data_path, "wb") as f:
+        position = 0
+        for arr_offset, arr in arrays:
+            if arr_offset > position:
+                f.write(b"\0" * (arr_offset - position))
+            f.write(arr.data)
+            position = arr_offset + arr.nbytes
+    os.rename(tmp_data_path, data_path)
+    store = {"format": "dagbldr_weight_store",
+             "version": 1,
+             "data_file": os.path.basename(data_path),
+             "total_bytes": offset,
+             "arrays": index}
+    if results is not None:
+        store["results"] = results
+    tmp_save_path = save_path + ".tmp"
+    with open(tmp_save_path, "w") as f:
+        json.dump(store, f, default=_json_default)
+    os.rename(tmp_save_path, save_path)
+
+
+def load_weight_store_index(save_path):
+    """ Load the JSON index written by save_weight_store """
+    with open(save_path, "r") as f:
+        store = json.load(f)
+    if store.get("format") != "dagbldr_weight_store":
+        raise ValueError("%s is not a dagbldr weight store" % save_path)
+    return store
+
+
+def load_weight_store(save_path, mmap_mode="r"):
+    """
+    Load arrays saved by save_weight_store
+
+    Returns an OrderedDict of {name: array}, where each array is a view into
+    one np.memmap of the data file, so nothing is read until it is used.
+    """
+    store = load_weight_store_index(save_path)
+    data_path = os.path.join(os.path.dirname(save_path), store["data_file"])
+    weights = OrderedDict()
+    if store["total_bytes"] > 0:
+        data = np.memmap(data_path, dtype=np.uint8, mode=mmap_mode,
+                         shape=(store["total_bytes"],))
+    for a in store["arrays"]:
+        dtype = np.dtype(a["dtype"])
+        shape = tuple(a["shape"])
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        if n_bytes == 0:
+            weights[a["name"]] = np.zeros(shape, dtype=dtype)
+            continue
+        start = a["offset"]
+        weights[a["name"]] = data[start:start + n_bytes].view(
+            dtype).reshape(shape)
+    return weights
+
+
+def save_weights(save_path, items_dict, use_resource_dir=True,
+                 objective=None):
+    """
+    Save the shared variable values of all theano functions in items_dict
+
+    items_dict can be a checkpoint dict or a CheckpointSnapshot. Values are
+    stored with save_weight_store under the names function_key_n, where n is
+    the position in get_shared_variables_from_function. Non-function entries
+    which are scalars or lists of scalars are kept in the index as results.
+    The files are recorded in the directory manifest with objective.
+    """
+    weights_dict = OrderedDict()
+    if isinstance(items_dict, CheckpointSnapshot):
+        for k in items_dict.owner.function_keys:
+            for n, w_v in enumerate(items_dict.get_function_values(k)):
                 weights_dict[k + "_%i" % n] = w_v
+        results = items_dict.results
+    else:
+        results = {}
+        # k is the function name, v is a theano function
+        for k in sorted(items_dict.keys()):
+            v = items_dict[k]
+            if isinstance(v, theano.compile.function_module.Function):
+                # w is all the numpy values from a function
+                w = get_values_from_function(v)
+                for n, w_v in enumerate(w):
+                    weights_dict[k + "_%i" % n] = w_v
+            else:
+                results[k] = v
     if use_resource_dir:
-        # Assume it ends with .py ...
-        script_name = get_script_name()[:-3]
         save_path = os.path.join(get_checkpoint_dir(), save_path)
-    logger.info("Saving weights to %s" % save_weights_path)
-    if len(weights_dict.keys()) > 0:
-        np.savez(save_path, **weights_dict)
-    else:
+    if len(weights_dict.keys()) == 0:
         logger.info("Possible BUG: no theano functions found in items_dict, "
-              "unable to save weights!")
+                    "unable to save weights!")
+        return
+    logger.info("Saving weights to %s" % save_path)
+    save_weight_store(save_path, weights_dict,
+                      results=_json_results(results))
+    record_artifact(_weight_store_data_path(save_path), objective)
+    record_artifact(save_path, objective)
     logger.info("Weight saving complete %s" % save_path)
 
 
+def load_weights(save_path, items_dict):
+    """
+    Set the shared variables of all theano functions in items_dict from a
+    weight store written by save_weights
+
+    Returns the results stored with the weights
+    """
+    weights = load_weight_store(save_path)
+    for k, v in items_dict.items():
+        if isinstance(v, theano.compile.function_module.Function):
+            prefix = k + "_"
+            names = [name for name in weights.keys()
+                     if name.startswith(prefix)
+                     and name[len(prefix):].isdigit()]
+            names = sorted(names, key=lambda x: int(x[len(prefix):]))
+            set_shared_variables_in_function(v, [weights[n] for n in names])
+    return load_weight_store_index(save_path).get("results", {})
+
+
 def download(url, server_fname, local_fname=None, progress_update_percentage=5,
              bypass_certificate_check=False):
     """
@@ -1123,8 +2121,78 @@ def download(url, server_fname, local_fname=None, progress_update_percentage=5,
                 p += progress_update_percentage
 
 
+# Guards the template cache and the per report append state
+_report_lock = threading.Lock()
+_report_template = None
+_report_states = {}
+
+# Collects the series pushed by a .data.js sidecar, then hands them to the
+# template in place of inline data
+_report_viewer_js = """<script>
+var dagbldr_report_series = {};
+var dagbldr_report_log = [];
+function dagbldr_report_push(key, values, visible) {
+    if (!(key in dagbldr_report_series)) {
+        dagbldr_report_series[key] = {name: key, data: [], visible: visible};
+    }
+    var s = dagbldr_report_series[key];
+    s.visible = visible;
+    for (var i = 0; i < values.length; i++) {
+        s.data.push(values[i]);
+    }
+}
+function dagbldr_report_reset(key) {
+    if (key in dagbldr_report_series) {
+        dagbldr_report_series[key].data = [];
+    }
+}
+function dagbldr_report_push_log(lines) {
+    for (var i = 0; i < lines.length; i++) {
+        dagbldr_report_log.push(lines[i]);
+    }
+}
+function dagbldr_report_series_list() {
+    var maxlen = 1500;
+    var keys = Object.keys(dagbldr_report_series).sort();
+    var out = [];
+    for (var k = 0; k < keys.length; k++) {
+        var s = dagbldr_report_series[keys[k]];
+        var data = s.data;
+        var n = data.length;
+        if (n > maxlen) {
+            // linear interpolation down to maxlen points
+            var resampled = [];
+            for (var i = 0; i < maxlen; i++) {
+                var x = i * n / (maxlen - 1);
+                var lo = Math.floor(x);
+                if (lo >= n - 1) {
+                    resampled.push(data[n - 1]);
+                } else {
+                    resampled.push(data[lo] +
+                                   (x - lo) * (data[lo + 1] - data[lo]));
+                }
+            }
+            data = resampled;
+        }
+        out.push({name: s.name, data: data, visible: s.visible});
+    }
+    return out;
+}
+</script>
+"""
 
-def filled_js_template_from_results_dict(results_dict, default_show="all"):
+
+def _get_report_template():
+    """
+    Template parts (head, imports, post_imports, log_prefix, tail)
+
+    Downloads the plotter into the js_plot_dependencies resource dir if
+    needed. Files are only read once per process. Call with _report_lock
+    held.
+    """
+    global _report_template
+    if _report_template is not None:
+        return _report_template
     # Uses arbiter strings in the template to split the template and stick
     # values in
     partial_path = get_resource_dir("js_plot_dependencies")
@@ -1162,15 +2230,36 @@ def filled_js_template_from_results_dict(results_dict, default_show="all"):
         imports_split_index + 1:data_split_index]
     log_part = all_template_lines[data_split_index + 1:log_split_index]
     last_part = all_template_lines[log_split_index + 1:]
+    _report_template = tuple(["".join(p) for p in (
+        first_part, imports_part, post_imports_part, log_part, last_part)])
+    return _report_template
+
+
+def _report_values(values):
+    """ Flat float64 array from a results list or array """
+    if isinstance(values, np.ndarray):
+        return values.astype("float64").ravel()
+    assert type(values) is list
+    if len(values) > 0 and isinstance(values[0], (np.generic, np.ndarray)):
+        values = [float(np.asarray(v).ravel()[0]) for v in values]
+    return np.asarray(values, dtype="float64").ravel()
+
+
+def filled_js_template_from_results_dict(results_dict, default_show="all"):
+    """
+    Self contained HTML report, with all values inline
+    """
+    with _report_lock:
+        (first_part, imports_part, post_imports_part, log_part,
+         last_part) = _get_report_template()
 
     def gen_js_field_for_key_value(key, values, show=True):
-        assert type(values) is list
-        if isinstance(values[0], (np.generic, np.ndarray)):
-            values = [float(v.ravel()) for v in values]
+        values = _report_values(values)
         maxlen = 1500
         if len(values) > maxlen:
-            values = list(np.interp(np.linspace(0, len(values), maxlen),
-                          np.arange(len(values)), values))
+            values = np.interp(np.linspace(0, len(values), maxlen),
+                               np.arange(len(values)), values)
+        values = [float(v) for v in values]
         show_key = "true" if show else "false"
         return "{\n    name: '%s',\n    data: %s,\n    visible: %s\n},\n" % (
             str(key), str(values), show_key)
@@ -1178,28 +2267,110 @@ def filled_js_template_from_results_dict(results_dict, default_show="all"):
                  if k in default_show or default_show == "all"
                  else gen_js_field_for_key_value(k, results_dict[k], False)
                  for k in sorted(results_dict.keys())]
-    all_filled_lines = first_part + imports_part + post_imports_part
-    all_filled_lines = all_filled_lines + data_part + log_part
+    all_filled_lines = [first_part, imports_part, post_imports_part]
+    all_filled_lines = all_filled_lines + data_part + [log_part]
     # add logging output
-    tmp = copy.copy(string_f)
-    tmp.seek(0)
-    log_output = tmp.readlines()
-    del tmp
-    all_filled_lines = all_filled_lines + log_output + last_part
+    log_lines, count = log_ring.tail()
+    all_filled_lines = all_filled_lines + log_lines + [last_part]
     return all_filled_lines
 
 
+def _report_data_path(save_path):
+    return os.path.splitext(save_path)[0] + ".data.js"
+
+
+def _same_value(a, b):
+    return a == b or (np.isnan(a) and np.isnan(b))
+
+
+def write_results_report(save_path, results_dict, default_show="all"):
+    """
+    Write results as a static HTML viewer plus an append-only data sidecar
+
+    The HTML page is written once and loads save_path with a .data.js
+    extension, which only gets the points and log lines added since the
+    last write to the same path. Series which shrink or change their
+    written values are reset and written again. The page embeds the JS
+    libraries from js_plot_dependencies, so it works offline.
+    """
+    with _report_lock:
+        (first_part, imports_part, post_imports_part, log_part,
+         last_part) = _get_report_template()
+        data_path = _report_data_path(save_path)
+        state = _report_states.get(save_path, None)
+        if (state is None or not os.path.exists(data_path) or
+                os.path.getsize(data_path) != state["size"]):
+            state = {"size": 0, "series": {}, "log_count": 0}
+            mode = "w"
+        else:
+            mode = "a"
+        lines = []
+        for k in sorted(results_dict.keys()):
+            values = _report_values(results_dict[k])
+            visible = k in default_show or default_show == "all"
+            count, first, last, was_visible = state["series"].get(
+                k, (0, None, None, None))
+            if count > 0 and (
+                    len(values) < count or
+                    not _same_value(values[0], first) or
+                    not _same_value(values[count - 1], last)):
+                lines.append("dagbldr_report_reset(%s);\n" % json.dumps(k))
+                count = 0
+            if len(values) > count or visible != was_visible:
+                new_values = [float(v) for v in values[count:]]
+                lines.append("dagbldr_report_push(%s, %s, %s);\n" % (
+                    json.dumps(k), json.dumps(new_values),
+                    json.dumps(visible)))
+            if len(values) > 0:
+                state["series"][k] = (len(values), values[0], values[-1],
+                                      visible)
+        new_log, state["log_count"] = log_ring.tail(state["log_count"])
+        if len(new_log) > 0:
+            lines.append("dagbldr_report_push_log(%s);\n" % json.dumps(
+                new_log))
+        with open(data_path, mode) as f:
+            f.writelines(lines)
+        state["size"] = os.path.getsize(data_path)
+        _report_states[save_path] = state
+
+        if not os.path.exists(save_path):
+            sidecar_js = '<script src="%s"></script>\n' % os.path.basename(
+                data_path)
+            # spread in place of the inline {name, data, visible} entries
+            data_part = "...dagbldr_report_series_list(),\n"
+            log_js = ("<script>document.write("
+                      "dagbldr_report_log.join(''));</script>\n")
+            tmp_path = save_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.writelines([first_part, imports_part, _report_viewer_js,
+                              sidecar_js, post_imports_part, data_part,
+                              log_part, log_js, last_part])
+            os.rename(tmp_path, save_path)
+
+
+def _remove_report_files(save_path):
+    with _report_lock:
+        _report_states.pop(save_path, None)
+        for path in (save_path, _report_data_path(save_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def remove_results_report(save_path):
+    """ Remove a report written by write_results_report and its sidecar """
+    _remove_report_files(save_path)
+    forget_artifact(save_path)
+
+
 def save_results_as_html(save_path, results_dict, use_resource_dir=True,
-                         default_no_show="_auto"):
+                         default_no_show="_auto", objective=None):
     show_keys = [k for k in results_dict.keys()
                  if default_no_show not in k]
-    as_html = filled_js_template_from_results_dict(
-        results_dict, default_show=show_keys)
     if use_resource_dir:
         save_path = os.path.join(get_checkpoint_dir(), save_path)
     logger.info("Saving HTML results %s" % save_path)
-    with open(save_path, "w") as f:
-        f.writelines(as_html)
+    write_results_report(save_path, results_dict, default_show=show_keys)
+    record_artifact(save_path, objective)
     logger.info("Completed HTML results saving %s" % save_path)
 
 
@@ -1253,14 +2424,19 @@ def threaded_weights_writer(maxsize=25):
         messages.put((1, GeneratorExit))
 
 
-def save_checkpoint(save_path, pickle_item, use_resource_dir=True):
+def save_checkpoint(save_path, pickle_item, use_resource_dir=True,
+                    objective=None):
     if use_resource_dir:
         # Assume it ends with .py ...
         save_path = os.path.join(get_checkpoint_dir(), save_path)
     sys.setrecursionlimit(40000)
     logger.info("Saving checkpoint to %s" % save_path)
     with open(save_path, mode="wb") as f:
-        dill.dump(pickle_item, f, protocol=-1)
+        if isinstance(pickle_item, CheckpointSnapshot):
+            pickle_item.dump(f, protocol=-1)
+        else:
+            dill.dump(pickle_item, f, protocol=-1)
+    record_artifact(save_path, objective)
     logger.info("Checkpoint saving complete %s" % save_path)
 
 
@@ -1289,8 +2465,148 @@ def threaded_checkpoint_writer(maxsize=25):
         messages.put((1, GeneratorExit))
 
 
+# All timed writers share one service thread, which sleeps on this condition
+# until a message arrives, a channel becomes due, or training is finalized
+_timed_writer_condition = threading.Condition()
+_timed_writer_channels = []
+_timed_writer_thread = None
+
+
+class _TimedWriterChannel(object):
+    """
+    State for one threaded_timed_writer, serviced by the shared writer thread
+
+    messages is a heap of (priority, count, item), lowest priority is written
+    first. count breaks ties in insertion order so items are never compared.
+    """
+    def __init__(self, sleep_time, max_pending=5, profiler=None):
+        self.sleep_time = sleep_time
+        self.max_pending = max_pending
+        self.profiler = profiler
+        # always save the very first one
+        self.last_time = time.time() - (sleep_time + 1)
+        self.messages = []
+        self.count = 0
+        self.closed = False
+        self.finished = False
+
+    def put(self, priority, item):
+        heapq.heappush(self.messages, (priority, self.count, item))
+        self.count += 1
+        if len(self.messages) > self.max_pending:
+            # drop the worst pending item, handing back its snapshots
+            worst = max(self.messages)
+            self.messages.remove(worst)
+            heapq.heapify(self.messages)
+            _release_item_snapshots(worst[2])
+
+    def time_remaining(self, now):
+        return self.sleep_time - (now - self.last_time)
+
+
+def _write_timed_item(item):
+    objective, results_tup, weights_tup, checkpoint_tup = item
+    try:
+        if results_tup is not None:
+            save_path, results_dict = results_tup
+            save_results_as_html(save_path, results_dict,
+                                 objective=objective)
+        if weights_tup is not None:
+            save_path, items_dict = weights_tup
+            save_weights(save_path, items_dict, objective=objective)
+        if checkpoint_tup is not None:
+            save_path, pickle_item = checkpoint_tup
+            save_checkpoint(save_path, pickle_item, objective=objective)
+    finally:
+        _release_item_snapshots(item)
+
+
+def _release_item_snapshots(item):
+    # Each message holds one reference to its snapshot
+    objective, results_tup, weights_tup, checkpoint_tup = item
+    snapshots = [tup[1] for tup in (weights_tup, checkpoint_tup)
+                 if tup is not None and isinstance(tup[1], CheckpointSnapshot)]
+    for n, snapshot in enumerate(snapshots):
+        if all([snapshot is not other for other in snapshots[:n]]):
+            snapshot.release()
+
+
+def _run_timed_writer_service():
+    global _timed_writer_thread
+    cond = _timed_writer_condition
+    cond.acquire()
+    try:
+        while True:
+            # check if train loop has set FINALIZE_TRAINING
+            # if so, write out the best one for each channel and exit
+            train_flag = _get_finalize_train()
+            done = [ch for ch in _timed_writer_channels
+                    if ch.finished or (ch.closed and len(ch.messages) == 0)]
+            for ch in done:
+                _timed_writer_channels.remove(ch)
+            if len(_timed_writer_channels) == 0:
+                _timed_writer_thread = None
+                return
+
+            now = time.time()
+            ready = None
+            timeout = None
+            for ch in _timed_writer_channels:
+                if len(ch.messages) == 0:
+                    continue
+                remaining = ch.time_remaining(now)
+                if remaining <= 0 or train_flag:
+                    ready = ch
+                    break
+                if timeout is None or remaining < timeout:
+                    timeout = remaining
+
+            if ready is None:
+                # Nothing to write - sleep until the next channel is due or
+                # until a send, close or finalize notifies us
+                cond.wait(timeout)
+                continue
+
+            p, c, item = heapq.heappop(ready.messages)
+            ready.last_time = time.time()
+            # Do the disk I/O without holding the lock so senders never block
+            cond.release()
+            try:
+                write_start = time.time()
+                _write_timed_item(item)
+                if ready.profiler is not None:
+                    ready.profiler.record("writer_io", write_start,
+                                          time.time() - write_start)
+            except Exception:
+                # one failed save must not stop the writes of every channel
+                logger.exception("Timed writer failed to save an item")
+            finally:
+                cond.acquire()
+            # write the last one if training is done
+            # but do not stop on a "results only" save
+            artifact_flag = item[2] is not None or item[3] is not None
+            if train_flag and artifact_flag:
+                logger.info("Last checkpoint written, closing timed writer")
+                ready.finished = True
+    finally:
+        # let the next registered channel start a new service thread
+        if _timed_writer_thread is threading.current_thread():
+            _timed_writer_thread = None
+        cond.release()
+
+
+def _register_timed_writer_channel(channel):
+    global _timed_writer_thread
+    with _timed_writer_condition:
+        _timed_writer_channels.append(channel)
+        if _timed_writer_thread is None:
+            _timed_writer_thread = threading.Thread(
+                target=_run_timed_writer_service)
+            _timed_writer_thread.start()
+
+
 @coroutine
-def threaded_timed_writer(sleep_time=15 * 60):
+def threaded_timed_writer(sleep_time=15 * 60, profiler=None):
     """
     Expects to be sent a tuple of
     (objective,
@@ -1304,59 +2620,185 @@ def threaded_timed_writer(sleep_time=15 * 60):
     ((results_save_path, results_dict),
      None,
      None))
-    """
-    messages = Queue.PriorityQueue()
 
-    def run_thread():
-        # always save the very first one
-        last_time = time.time() - (sleep_time + 1)
-        while True:
-            if messages.qsize() > 5:
-                mi = messages.queue.index(max(messages.queue))
-                del messages.queue[mi]
-                heapq.heapify(messages.queue)
-
-            time_flag = (time.time() - last_time) > sleep_time
-            # check if train loop has set FINALIZE_TRAINING
-            # if so, write out the best one and exit
-            train_flag = _get_finalize_train()
-            if time_flag or train_flag:
-                p, item = messages.get()
-                last_time = time.time()
-                if item is GeneratorExit:
-                    return
-                else:
-                    results_tup, weights_tup, checkpoint_tup = item
-                    if results_tup is not None:
-                        save_path, results_dict = results_tup
-                        save_results_as_html(save_path, results_dict)
-                    if weights_tup is not None:
-                        save_path, items_dict = weights_tup
-                        save_weights(save_path, items_dict)
-                    if checkpoint_tup is not None:
-                        save_path, pickle_item = checkpoint_tup
-                        save_checkpoint(save_path, pickle_item)
-                    # write the last one if training is done
-                    # but do not stop on a "results only" save
-                    artifact_flag = checkpoint_tup is not None or weights_tup is not None
-                    if train_flag and artifact_flag:
-                        logger.info("Last checkpoint written, exiting save thread")
-                        return
+    The best objective seen so far is written first, at most once every
+    sleep_time seconds. All timed writers share a single writer thread which
+    blocks while there is nothing due, rather than polling.
 
-    threading.Thread(target=run_thread).start()
+    If profiler is a PhaseProfiler, time blocked in send is recorded as
+    "enqueue" and time spent writing as "writer_io".
+    """
+    channel = _TimedWriterChannel(sleep_time, profiler=profiler)
+    _register_timed_writer_channel(channel)
     try:
         last_best = np.inf
         n = -1
         while True:
             item = (yield)
-            if item[0] < last_best:
-                n = n - 1
-                last_best = item[0]
-                messages.put((n, item[1:]))
-            else:
-                messages.put((n + 1, item[1:]))
+            send_start = time.time()
+            with _timed_writer_condition:
+                if item[0] < last_best:
+                    n = n - 1
+                    last_best = item[0]
+                    channel.put(n, item)
+                else:
+                    channel.put(n + 1, item)
+                _timed_writer_condition.notify_all()
+            if profiler is not None:
+                profiler.record("enqueue", send_start,
+                                time.time() - send_start)
     except GeneratorExit:
-        messages.put((1, GeneratorExit))
+        with _timed_writer_condition:
+            channel.closed = True
+            _timed_writer_condition.notify_all()
+
+
+def _valid_shard_worker(valid_loop, valid_itr, shared_variables, buffers,
+                        task_queue, result_queue):
+    # Runs in a process forked before training starts. Each task is one
+    # shard of a pass, evaluated with the parameter values the parent left
+    # in buffers when it launched the pass
+    views = [np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape)))
+             .reshape(shape) for raw, dtype, shape in buffers]
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        shard, start_index, stop_index = task
+        try:
+            for var, view in safe_zip(shared_variables, views):
+                var.set_value(view)
+            valid_itr.start_index = start_index
+            valid_itr.stop_index = stop_index
+            valid_itr.reset()
+            costs = []
+            try:
+                while True:
+                    costs.append(float(np.mean(valid_loop(valid_itr))))
+            except StopIteration:
+                pass
+            result_queue.put((shard, costs, None))
+        except Exception as e:
+            result_queue.put((shard, None, repr(e)))
+
+
+class _ShardedValidation(object):
+    """
+    Evaluates valid_loop over shards of valid_itr in worker processes
+
+    n_shards workers are forked once, in __init__, and reused for every
+    pass. launch() copies the values of the shared variables used by the
+    functions in checkpoint_dict into shared memory, so every pass sees the
+    parameters at launch() and training can continue in the parent until
+    collect(). The workers use copies of the compiled functions and must
+    not share a GPU context with the parent, so this is for CPU training.
+    valid_itr needs shard_bounds, as base_iterator provides.
+
+    A fork only copies the calling thread, so this must be created before
+    any other thread is started: run_loop builds it before its prefetch
+    and writer threads. Iterators with readahead should not be iterated
+    before that either.
+    """
+    def __init__(self, valid_loop, valid_itr, n_shards, checkpoint_dict):
+        if not hasattr(valid_itr, "shard_bounds"):
+            raise ValueError("Sharded validation needs an iterator with "
+                             "start_index and stop_index, such as "
+                             "minibatch_iterator or list_iterator")
+        if threading.active_count() > 1:
+            logger.info("Forking validation workers with %i other threads "
+                        "running" % (threading.active_count() - 1))
+        self.valid_loop = valid_loop
+        self.valid_itr = valid_itr
+        self.n_shards = n_shards
+        if hasattr(multiprocessing, "get_context"):
+            self.context = multiprocessing.get_context("fork")
+        else:
+            self.context = multiprocessing
+        self.shared_variables = _checkpoint_shared_variables(
+            checkpoint_dict)[1]
+        self.buffers = []
+        self.views = []
+        for var in self.shared_variables:
+            value = np.asarray(var.get_value(borrow=True))
+            raw = self.context.RawArray("b", max(value.nbytes, 1))
+            self.buffers.append((raw, value.dtype, value.shape))
+            self.views.append(np.frombuffer(
+                raw, dtype=value.dtype, count=value.size).reshape(
+                    value.shape))
+        self.task_queue = self.context.Queue()
+        self.result_queue = self.context.Queue()
+        self.processes = []
+        for i in range(n_shards):
+            p = self.context.Process(
+                target=_valid_shard_worker,
+                args=(valid_loop, valid_itr, self.shared_variables,
+                      self.buffers, self.task_queue, self.result_queue))
+            p.daemon = True
+            p.start()
+            self.processes.append(p)
+        self.in_flight = 0
+
+    def launch(self):
+        if self.processes is None:
+            raise ValueError("Validation workers are no longer running")
+        for var, view in safe_zip(self.shared_variables, self.views):
+            value = np.asarray(var.get_value(borrow=True))
+            if value.shape != view.shape or value.dtype != view.dtype:
+                raise ValueError("Shape or dtype of %s changed after the "
+                                 "validation workers started" % var)
+            np.copyto(view, value)
+        bounds = self.valid_itr.shard_bounds(self.n_shards)
+        for shard, (start_index, stop_index) in enumerate(bounds):
+            self.task_queue.put((shard, start_index, stop_index))
+        self.in_flight = len(bounds)
+
+    def pending(self):
+        return self.in_flight > 0
+
+    def collect(self):
+        """ Wait for the pass, returns all minibatch costs in order """
+        shard_costs = [None] * self.in_flight
+        errors = []
+        while self.in_flight > 0:
+            try:
+                shard, costs, error = self.result_queue.get(timeout=1.)
+            except Queue.Empty:
+                # a worker killed by a signal never sends a result
+                crashed = [p for p in self.processes
+                           if p.exitcode not in (None, 0)]
+                if len(crashed) > 0:
+                    self.in_flight = 0
+                    self.close()
+                    raise ValueError("Validation process exited with "
+                                     "code %i" % crashed[0].exitcode)
+                continue
+            self.in_flight -= 1
+            shard_costs[shard] = costs
+            if error is not None:
+                errors.append("shard %i: %s" % (shard, error))
+        if len(errors) > 0:
+            raise ValueError("Validation failed in %s" % ", ".join(errors))
+        return [c for costs in shard_costs for c in costs]
+
+    def close(self):
+        """ Stop the workers, waiting for any pass in flight first """
+        if self.processes is None:
+            return
+        if self.in_flight > 0:
+            self.collect()
+        for p in self.processes:
+            if p.is_alive():
+                self.task_queue.put(None)
+        for p in self.processes:
+            p.join(timeout=5.)
+            if p.is_alive():
+                p.terminate()
+        self.processes = None
+
+
+# Quantiles of the minibatch costs added to the results every epoch
+_COST_QUANTILES = (0.05, 0.5, 0.95)
+_COST_QUANTILE_KEY = "^(train|valid)_costs_p[0-9]+_auto$"
 
 
 class TrainingLoop(object):
@@ -1372,6 +2814,15 @@ class TrainingLoop(object):
     skip_minimums - skip checkpoints based on minimum training/valid
     skip_intermediates - skip within epoch checkpoints
     skip_most_recents - skip writing most recent results html
+    prefetch_depth - if > 0, build up to this many train and valid
+        minibatches ahead in a background thread, skipped for iterators
+        with shared=True
+    profiler - a PhaseProfiler to record per minibatch timings of each
+        phase, not serialized
+    valid_shards - if > 0, validate in this many worker processes, each on
+        a contiguous range of valid_itr
+    async_valid - with valid_shards, validate the parameters from the start
+        of each epoch while it trains
     """
     def __init__(self, train_loop_function, train_itr,
                  valid_loop_function, valid_itr,
@@ -1384,7 +2835,11 @@ class TrainingLoop(object):
                  monitor_frequency=1000,
                  skip_minimums=False,
                  skip_intermediates=True,
-                 skip_most_recents=False):
+                 skip_most_recents=False,
+                 prefetch_depth=0,
+                 profiler=None,
+                 valid_shards=0,
+                 async_valid=False):
         self.train_loop_function = train_loop_function
         self.train_itr = train_itr
 
@@ -1404,6 +2859,10 @@ class TrainingLoop(object):
         self.skip_minimums = skip_minimums
         self.skip_intermediates = skip_intermediates
         self.skip_most_recents = skip_most_recents
+        self.prefetch_depth = prefetch_depth
+        self.profiler = profiler
+        self.valid_shards = valid_shards
+        self.async_valid = async_valid
 
         # tracker to ensure restarting at the correct minibatch
         self.num_train_minibatches_run = -1
@@ -1415,7 +2874,8 @@ class TrainingLoop(object):
                     self.valid_itr,
                     self.n_epochs,
                     self.checkpoint_dict]
-        return {k:v for k, v in self.__dict__.items() if v not in skiplist}
+        return {k: v for k, v in self.__dict__.items()
+                if v not in skiplist and k != "profiler"}
 
     def refresh(self, train_loop_function, train_itr,
                 valid_loop_function, valid_itr,
@@ -1445,7 +2905,11 @@ class TrainingLoop(object):
                  self.skip_intermediates,
                  self.skip_most_recents,
                  self.num_train_minibatches_run,
-                 self)
+                 self,
+                 prefetch_depth=getattr(self, "prefetch_depth", 0),
+                 profiler=getattr(self, "profiler", None),
+                 valid_shards=getattr(self, "valid_shards", 0),
+                 async_valid=getattr(self, "async_valid", False))
 
 
 def run_loop(train_loop_function, train_itr,
@@ -1458,13 +2922,31 @@ def run_loop(train_loop_function, train_itr,
              monitor_frequency=1000, skip_minimums=False,
              skip_intermediates=True, skip_most_recents=False,
              skip_n_train_minibatches=-1,
-             stateful_object=None):
+             stateful_object=None,
+             prefetch_depth=0,
+             profiler=None,
+             valid_shards=0,
+             async_valid=False):
     """
     TODO: add all logging info into the js report
     TODO: add upload fields to add data to an html and save a copy
     loop function should return a list of costs
     stateful_object allows to serialize and relaunch in middle of an epoch
     for long training models
+    prefetch_depth > 0 wraps train_itr and valid_itr in a prefetch_iterator,
+    except iterators in shared mode, which only yield minibatch indices
+    profiler, a PhaseProfiler, records per minibatch phase timings. Their
+    percentiles are added to the results as profile_*_auto keys every epoch
+    and the timeline is saved as a Chrome trace
+    the 5/50/95 percentiles of the minibatch costs of every epoch are added
+    to the results as train_costs_p*_auto and valid_costs_p*_auto keys
+    valid_shards > 0 runs validation in that many worker processes, each
+    over a contiguous range of valid_itr. The workers are forked before
+    any training thread starts and get the parameters through shared
+    memory at every pass. With async_valid the pass for
+    the parameters at the start of an epoch runs while that epoch trains,
+    so the valid cost of epoch e belongs to the parameters after epoch
+    e - 1 and valid checkpoints save those parameters
     """
     # Assume keys which are theano functions to ignore!
     ignore_keys = [k for k, v in checkpoint_dict.items()
@@ -1472,6 +2954,30 @@ def run_loop(train_loop_function, train_itr,
 
     train_loop = train_loop_function
     valid_loop = valid_loop_function
+    if async_valid and valid_shards < 1:
+        raise ValueError("async_valid requires valid_shards > 0")
+    sharded_valid = None
+    if valid_shards > 0:
+        # shards index the raw iterator in the children
+        sharded_valid = _ShardedValidation(valid_loop, valid_itr,
+                                           valid_shards, checkpoint_dict)
+    # prefetch_iterators started here, closed when the loop ends
+    prefetched = []
+    if prefetch_depth > 0:
+        # imported here to avoid a circular import at module load
+        from ..datasets.dataset_utils import prefetch_iterator
+        # shared mode iterators upload chunks from next(), which must not
+        # race with the function call reading the same shared variables
+        if not getattr(train_itr, "shared", False):
+            train_itr = prefetch_iterator(train_itr, prefetch_depth)
+            prefetched.append(train_itr)
+        if sharded_valid is None and not getattr(valid_itr, "shared", False):
+            valid_itr = prefetch_iterator(valid_itr, prefetch_depth)
+            prefetched.append(valid_itr)
+    if profiler is not None:
+        train_itr = _ProfiledIterator(train_itr, profiler, "train_fetch")
+        if sharded_valid is None:
+            valid_itr = _ProfiledIterator(valid_itr, profiler, "valid_fetch")
     ident = str(uuid.uuid4())[:8]
     random_state = np.random.RandomState(2177)
     monitor_prob = 1. / monitor_frequency
@@ -1507,9 +3013,14 @@ def run_loop(train_loop_function, train_itr,
                         "joint_deltas_auto",
                         "joint_times_auto",
                         "train_checkpoint_auto",
-                        "valid_checkpoint_auto"]
+                        "valid_checkpoint_auto",
+                        "epoch_count_auto"]
+        # profiler summaries and cost quantiles are optional and may be
+        # missing from older checkpoints
         not_handled = [k for k in checkpoint_dict.keys()
-                       if k not in keys_checked and k not in ignore_keys]
+                       if k not in keys_checked and k not in ignore_keys
+                       and not k.startswith("profile_")
+                       and re.match(_COST_QUANTILE_KEY, k) is None]
         if len(not_handled) > 0:
             raise ValueError("Unhandled keys %s in checkpoint_dict, exiting..." % not_handled)
 
@@ -1558,24 +3069,27 @@ def run_loop(train_loop_function, train_itr,
     logger.info("Total parameter count %f M" % (total / 1E6))
 
     # Timed versus forced here
-    tcw = threaded_timed_writer(write_every_n_seconds)
-    vcw = threaded_timed_writer(write_every_n_seconds)
+    tcw = threaded_timed_writer(write_every_n_seconds, profiler=profiler)
+    vcw = threaded_timed_writer(write_every_n_seconds, profiler=profiler)
 
     if _special_check():
-        fcw = threaded_timed_writer(sleep_time=write_every_n_seconds)
+        fcw = threaded_timed_writer(sleep_time=write_every_n_seconds,
+                                    profiler=profiler)
     else:
-        fcw = threaded_timed_writer(sleep_time=0)
+        fcw = threaded_timed_writer(sleep_time=0, profiler=profiler)
 
-    best_train_checkpoint_pickle = None
-    best_train_checkpoint_epoch = 0
-    best_valid_checkpoint_pickle = None
+    # Checkpoints copy parameter values into reusable buffers, the writer
+    # threads do the actual serialization
+    snapshot = ParameterSnapshot(checkpoint_dict)
+    best_train_snapshot = None
     best_train_checkpoint_epoch = 0
-    # If there are more than 1M minibatches per epoch this will break!
-    # Not reallocating buffer greatly helps fast training models though
-    # Also we have bigger problems if there are 1M minibatches per epoch...
-    # This will get sliced down to the correct number of minibatches down below
-    train_costs = [0.] * 1000000
-    valid_costs = [0.] * 1000000
+    best_valid_snapshot = None
+    best_valid_checkpoint_epoch = 0
+    # parameters being validated asynchronously
+    valid_snapshot = None
+    # Per minibatch costs for the current epoch
+    train_costs = RunningStatistics()
+    valid_costs = RunningStatistics()
     try:
         for e in range(start_epoch, start_epoch + n_epochs):
             logger.info(" ")
@@ -1585,48 +3099,67 @@ def run_loop(train_loop_function, train_itr,
             logger.info("Starting training, epoch %i" % e_i)
             train_mb_count = 0
             valid_mb_count = 0
+            # reset gives new buffers, results already sent keep the old ones
+            train_costs.reset()
+            valid_costs.reset()
+            if profiler is not None:
+                profile_start_count = profiler.count
             results_dict = {k: v for k, v in checkpoint_dict.items()
                             if k not in ignore_keys}
             this_results_dict = results_dict
             try:
                 # train loop
+                if async_valid:
+                    valid_snapshot = snapshot.take()
+                    sharded_valid.launch()
                 train_start = time.time()
                 last_time_checkpoint = train_start
                 while True:
                     if train_mb_count < skip_n_train_minibatches:
                         train_mb_count += 1
                         continue
+                    if profiler is not None:
+                        fetch_before = train_itr.total_duration
+                        compute_start = time.time()
                     partial_train_costs = train_loop(train_itr)
-                    train_costs[train_mb_count] = np.mean(partial_train_costs)
-                    tc = train_costs[train_mb_count]
+                    if profiler is not None:
+                        nan_check_start = time.time()
+                        profiler.record("train_compute", compute_start,
+                                        nan_check_start - compute_start - (
+                                            train_itr.total_duration -
+                                            fetch_before))
+                    tc = np.mean(partial_train_costs)
+                    train_costs.append(tc)
                     if np.isnan(tc):
                         logger.info("NaN detected in train cost, update %i" % train_mb_count)
                         raise StopIteration("NaN detected in train")
+                    if profiler is not None:
+                        profiler.record("nan_check", nan_check_start,
+                                        time.time() - nan_check_start)
 
                     train_mb_count += 1
                     if (train_mb_count % checkpoint_every_n_updates) == 0:
                         checkpoint_save_path = "%s_model_update_checkpoint_%i.pkl" % (ident, train_mb_count)
-                        weights_save_path = "%s_model_update_weights_%i.npz" % (ident, train_mb_count)
+                        weights_save_path = (
+                            "%s_model_update_weights_%i.json" % (
+                                ident, train_mb_count))
                         results_save_path = "%s_model_update_results_%i.html" % (ident, train_mb_count)
-                        # Use pickle to preserve relationships between keys
-                        # while still copying buffers
-                        copy_pickle = pickle.dumps(checkpoint_dict)
-                        copy_dict = pickle.loads(copy_pickle)
+                        copy_dict = snapshot.take()
 
                         logger.info("Update checkpoint after train mb %i" % train_mb_count)
                         logger.info("Current mean cost %f" % np.mean(partial_train_costs))
-                        this_results_dict["this_epoch_train_auto"] = train_costs[:train_mb_count]
-                        tmb = train_costs[:train_mb_count]
-                        running_train_mean = np.cumsum(tmb) / (np.arange(train_mb_count) + 1)
-                        # needs to be a list
-                        running_train_mean = list(running_train_mean)
-                        this_results_dict["this_epoch_train_mean_auto"] = running_train_mean
-
-                        objective = running_train_mean
+                        this_results_dict["this_epoch_train_auto"] = (
+                            train_costs.values())
+                        this_results_dict["this_epoch_train_mean_auto"] = (
+                            train_costs.running_mean())
+                        this_results_dict["this_epoch_train_ema_auto"] = (
+                            train_costs.ema())
+
+                        objective = train_costs.mean()
                         tcw.send((objective,
                                   (results_save_path, this_results_dict),
-                                  (checkpoint_save_path, copy_dict),
-                                  (weights_save_path, copy_dict)))
+                                  (weights_save_path, copy_dict),
+                                  (checkpoint_save_path, copy_dict)))
 
                         if stateful_object is not None:
                             stateful_object.num_train_minibatches_run = train_mb_count
@@ -1636,27 +3169,25 @@ def run_loop(train_loop_function, train_itr,
                         time_diff = time.time() - train_start
                         last_time_checkpoint = time.time()
                         checkpoint_save_path = "%s_model_time_checkpoint_%i.pkl" % (ident, int(time_diff))
-                        weights_save_path = "%s_model_time_weights_%i.npz" % (ident, int(time_diff))
+                        weights_save_path = "%s_model_time_weights_%i.json" % (
+                            ident, int(time_diff))
                         results_save_path = "%s_model_time_results_%i.html" % (ident, int(time_diff))
-                        # Use pickle to preserve relationships between keys
-                        # while still copying buffers
-                        copy_pickle = pickle.dumps(checkpoint_dict)
-                        copy_dict = pickle.loads(copy_pickle)
+                        copy_dict = snapshot.take()
 
                         logger.info("Time checkpoint after train mb %i" % train_mb_count)
                         logger.info("Current mean cost %f" % np.mean(partial_train_costs))
-                        this_results_dict["this_epoch_train_auto"] = train_costs[:train_mb_count]
-                        tmb = train_costs[:train_mb_count]
-                        running_train_mean = np.cumsum(tmb) / (np.arange(train_mb_count) + 1)
-                        # needs to be a list
-                        running_train_mean = list(running_train_mean)
-                        this_results_dict["this_epoch_train_mean_auto"] = running_train_mean
-
-                        objective = running_train_mean
+                        this_results_dict["this_epoch_train_auto"] = (
+                            train_costs.values())
+                        this_results_dict["this_epoch_train_mean_auto"] = (
+                            train_costs.running_mean())
+                        this_results_dict["this_epoch_train_ema_auto"] = (
+                            train_costs.ema())
+
+                        objective = train_costs.mean()
                         tcw.send((objective,
                                   (results_save_path, this_results_dict),
-                                  (checkpoint_save_path, copy_dict),
-                                  (weights_save_path, copy_dict)))
+                                  (weights_save_path, copy_dict),
+                                  (checkpoint_save_path, copy_dict)))
 
                         if stateful_object is not None:
                             stateful_object.num_train_minibatches_run = train_mb_count
@@ -1667,7 +3198,8 @@ def run_loop(train_loop_function, train_itr,
                         logger.info("Starting train mb %i" % train_mb_count)
                         logger.info("Current mean cost %f" % np.mean(partial_train_costs))
                         results_save_path = "%s_intermediate_results.html" % ident
-                        this_results_dict["this_epoch_train_auto"] = train_costs[:train_mb_count]
+                        this_results_dict["this_epoch_train_auto"] = (
+                            train_costs.values())
 
                         objective = np.mean(partial_train_costs)
                         fcw.send((objective,
@@ -1675,41 +3207,62 @@ def run_loop(train_loop_function, train_itr,
                                   None,
                                   None))
             except StopIteration:
-                # Slice so that only valid data is in the minibatch
-                # this also assumes there is not a variable number
-                # of minibatches in an epoch!
                 train_stop = time.time()
-                train_costs = train_costs[:train_mb_count]
                 logger.info("Starting validation, epoch %i" % e_i)
                 valid_start = time.time()
-                try:
-                    # Valid loop
-                    while True:
-                        partial_valid_costs = valid_loop(valid_itr)
-                        valid_costs[valid_mb_count] = np.mean(partial_valid_costs)
-                        vc = valid_costs[valid_mb_count]
+                if sharded_valid is not None:
+                    if not sharded_valid.pending():
+                        sharded_valid.launch()
+                    sharded_costs = sharded_valid.collect()
+                    if profiler is not None:
+                        profiler.record("valid_wait", valid_start,
+                                        time.time() - valid_start)
+                    for vc in sharded_costs:
+                        valid_costs.append(vc)
                         if np.isnan(vc):
                             logger.info("NaN detected in valid cost, minibatch %i" % valid_mb_count)
-                            raise StopIteration("NaN detected in valid")
+                            break
                         valid_mb_count += 1
-                        draw = random_state.rand()
-                        if draw < monitor_prob and not skip_intermediates:
-                            logger.info("Valid mb %i" % valid_mb_count)
-                            logger.info("Current validation mean cost %f" % np.mean(
-                                valid_costs))
-                            results_save_path = "%s_intermediate_results.html" % ident
-                            this_results_dict["this_epoch_valid_auto"] = valid_costs[:valid_mb_count]
-
-                            objective = np.mean(valid_costs)
-                            fcw.send((objective,
-                                     (results_save_path, this_results_dict),
-                                     None,
-                                     None))
-                except StopIteration:
-                    pass
+                else:
+                    try:
+                        # Valid loop
+                        while True:
+                            if profiler is not None:
+                                fetch_before = valid_itr.total_duration
+                                compute_start = time.time()
+                            partial_valid_costs = valid_loop(valid_itr)
+                            if profiler is not None:
+                                profiler.record("valid_compute", compute_start,
+                                                time.time() - compute_start - (
+                                                    valid_itr.total_duration -
+                                                    fetch_before))
+                            vc = np.mean(partial_valid_costs)
+                            valid_costs.append(vc)
+                            if np.isnan(vc):
+                                logger.info("NaN detected in valid cost, "
+                                            "minibatch %i" % valid_mb_count)
+                                raise StopIteration("NaN detected in valid")
+                            valid_mb_count += 1
+                            draw = random_state.rand()
+                            if draw < monitor_prob and not skip_intermediates:
+                                logger.info("Valid mb %i" % valid_mb_count)
+                                logger.info("Current validation mean cost %f" %
+                                            valid_costs.mean())
+                                results_save_path = (
+                                    "%s_intermediate_results.html" % ident)
+                                this_results_dict["this_epoch_valid_auto"] = (
+                                    valid_costs.values())
+
+                                objective = valid_costs.mean()
+                                fcw.send((objective,
+                                          (results_save_path,
+                                           this_results_dict),
+                                          None,
+                                          None))
+                    except StopIteration:
+                        pass
                 valid_stop = time.time()
                 epoch_stop = time.time()
-                valid_costs = valid_costs[:valid_mb_count]
 
                 # Logging and tracking training statistics
                 epoch_time_delta = epoch_stop - epoch_start
@@ -1727,7 +3280,7 @@ def run_loop(train_loop_function, train_itr,
                 overall_valid_deltas.append(valid_time_delta)
                 overall_valid_times.append(valid_time_total)
 
-                mean_epoch_train_cost = np.mean(train_costs)
+                mean_epoch_train_cost = train_costs.mean()
                 # np.inf trick to avoid taking the min of length 0 list
                 old_min_train_cost = min(overall_train_costs + [np.inf])
                 if np.isnan(mean_epoch_train_cost):
@@ -1736,7 +3289,7 @@ def run_loop(train_loop_function, train_itr,
                     raise StopIteration("NaN detected in train")
                 overall_train_costs.append(mean_epoch_train_cost)
 
-                mean_epoch_valid_cost = np.mean(valid_costs)
+                mean_epoch_valid_cost = valid_costs.mean()
                 old_min_valid_cost = min(overall_valid_costs + [np.inf])
                 if np.isnan(mean_epoch_valid_cost):
                     logger.info("Previous valid costs %s" % overall_valid_costs[-5:])
@@ -1777,6 +3330,22 @@ def run_loop(train_loop_function, train_itr,
                 checkpoint_dict["train_checkpoint_auto"] = overall_train_checkpoint
                 checkpoint_dict["valid_checkpoint_auto"] = overall_valid_checkpoint
 
+                # Per epoch cost quantiles, from the reservoir samples
+                for name, stats in (("train", train_costs),
+                                    ("valid", valid_costs)):
+                    for q, v in safe_zip(_COST_QUANTILES,
+                                         stats.quantiles(_COST_QUANTILES)):
+                        k = "%s_costs_p%i_auto" % (name, int(100 * q))
+                        checkpoint_dict[k] = list(
+                            checkpoint_dict.get(k, [])) + [float(v)]
+
+                if profiler is not None:
+                    profile_summary = profiler.summary(profile_start_count)
+                    for k in sorted(profile_summary.keys()):
+                        checkpoint_dict[k] = list(
+                            checkpoint_dict.get(k, [])) + [profile_summary[k]]
+                        logger.info("%s %f ms" % (k, profile_summary[k]))
+                    profiler.save_chrome_trace("%s_profile_trace.json" % ident)
 
                 script = get_script()
                 hostname = socket.gethostname()
@@ -1784,6 +3353,10 @@ def run_loop(train_loop_function, train_itr,
                 logger.info("Epoch %i complete" % e_i)
                 logger.info("Epoch mean train cost %f" % mean_epoch_train_cost)
                 logger.info("Epoch mean valid cost %f" % mean_epoch_valid_cost)
+                logger.info("Epoch train cost 5/50/95 percentiles %s" %
+                            train_costs.quantiles())
+                logger.info("Epoch valid cost 5/50/95 percentiles %s" %
+                            valid_costs.quantiles())
                 logger.info("Previous train costs %s" % overall_train_costs[-5:])
                 logger.info("Previous valid costs %s" % overall_valid_costs[-5:])
 
@@ -1799,47 +3372,69 @@ def run_loop(train_loop_function, train_itr,
                     # Using dumps so relationship between keys in the pickle
                     # is preserved
                     checkpoint_save_path = "%s_model_checkpoint_valid_%i.pkl" % (ident, e_i)
-                    weights_save_path = "%s_model_weights_valid_%i.npz" % (ident, e_i)
+                    weights_save_path = "%s_model_weights_valid_%i.json" % (
+                        ident, e_i)
                     results_save_path = "%s_model_results_valid_%i.html" % (ident, e_i)
-                    best_valid_checkpoint_pickle = pickle.dumps(checkpoint_dict)
+                    if valid_snapshot is not None:
+                        # the parameters which gave this valid cost
+                        copy_dict = valid_snapshot
+                        valid_snapshot = None
+                    else:
+                        copy_dict = snapshot.take()
+                    # keep a reference to write the best one at the end
+                    if best_valid_snapshot is not None:
+                        best_valid_snapshot.release()
+                    copy_dict.retain()
+                    best_valid_snapshot = copy_dict
                     best_valid_checkpoint_epoch = e
-                    # preserve key relations
-                    copy_dict = pickle.loads(best_valid_checkpoint_pickle)
 
                     objective = mean_epoch_valid_cost
                     vcw.send((objective,
                              (results_save_path, this_results_dict),
-                             (checkpoint_save_path, copy_dict),
-                             (weights_save_path, copy_dict)))
+                             (weights_save_path, copy_dict),
+                             (checkpoint_save_path, copy_dict)))
 
                     if mean_epoch_train_cost < old_min_train_cost:
                         checkpoint_save_path = "%s_model_checkpoint_train_%i.pkl" % (ident, e_i)
-                        weights_save_path = "%s_model_weights_train_%i.npz" % (ident, e_i)
+                        weights_save_path = (
+                            "%s_model_weights_train_%i.json" % (ident, e_i))
                         results_save_path = "%s_model_results_train_%i.html" % (ident, e_i)
-                        best_train_checkpoint_pickle = pickle.dumps(checkpoint_dict)
+                        if best_train_snapshot is not None:
+                            best_train_snapshot.release()
+                        if async_valid:
+                            # valid used older parameters
+                            copy_dict = snapshot.take()
+                        else:
+                            copy_dict.retain()
+                        # one reference for the best, one for this send
+                        copy_dict.retain()
+                        best_train_snapshot = copy_dict
                         best_train_checkpoint_epoch = e
 
                         objective = mean_epoch_train_cost
                         vcw.send((objective,
                                 (results_save_path, this_results_dict),
-                                (checkpoint_save_path, copy_dict),
-                                (weights_save_path, copy_dict)))
+                                (weights_save_path, copy_dict),
+                                (checkpoint_save_path, copy_dict)))
                     logger.info("Valid checkpointing complete.")
                 elif mean_epoch_train_cost < old_min_train_cost:
                     logger.info("Checkpointing train...")
                     checkpoint_save_path = "%s_model_checkpoint_train_%i.pkl" % (ident, e_i)
-                    weights_save_path = "%s_model_weights_train_%i.npz" % (ident, e_i)
+                    weights_save_path = "%s_model_weights_train_%i.json" % (
+                        ident, e_i)
                     results_save_path = "%s_model_results_train_%i.html" % (ident, e_i)
-                    best_train_checkpoint_pickle = pickle.dumps(checkpoint_dict)
+                    copy_dict = snapshot.take()
+                    if best_train_snapshot is not None:
+                        best_train_snapshot.release()
+                    copy_dict.retain()
+                    best_train_snapshot = copy_dict
                     best_train_checkpoint_epoch = e
-                    # preserve key relations
-                    copy_dict = pickle.loads(best_train_checkpoint_pickle)
 
                     objective = mean_epoch_train_cost
                     vcw.send((objective,
                              (results_save_path, this_results_dict),
-                             (checkpoint_save_path, copy_dict),
-                             (weights_save_path, copy_dict)))
+                             (weights_save_path, copy_dict),
+                             (checkpoint_save_path, copy_dict)))
                     logger.info("Train checkpointing complete.")
 
                 if e < checkpoint_delay:
@@ -1849,12 +3444,10 @@ def run_loop(train_loop_function, train_itr,
                 elif((e % checkpoint_every_n_epochs) == 0) or (e == (n_epochs - 1)):
                     logger.info("Checkpointing force...")
                     checkpoint_save_path = "%s_model_checkpoint_%i.pkl" % (ident, e_i)
-                    weights_save_path = "%s_model_weights_%i.npz" % (ident, e_i)
+                    weights_save_path = "%s_model_weights_%i.json" % (
+                        ident, e_i)
                     results_save_path = "%s_model_results_%i.html" % (ident, e_i)
-                    # Use pickle to preserve relationships between keys
-                    # while still copying buffers
-                    copy_pickle = pickle.dumps(checkpoint_dict)
-                    copy_dict = pickle.loads(copy_pickle)
+                    copy_dict = snapshot.take()
 
                     objective = mean_epoch_train_cost
                     fcw.send((objective,
@@ -1863,6 +3456,10 @@ def run_loop(train_loop_function, train_itr,
                              (checkpoint_save_path, copy_dict)))
                     logger.info("Force checkpointing complete.")
 
+                if valid_snapshot is not None:
+                    valid_snapshot.release()
+                    valid_snapshot = None
+
                 checkpoint_stop = time.time()
                 joint_stop = time.time()
 
@@ -1890,14 +3487,18 @@ def run_loop(train_loop_function, train_itr,
     except KeyboardInterrupt:
         logger.info("Training loop interrupted by user! Saving current best results.")
 
-    if not skip_minimums:
+    if sharded_valid is not None:
+        # results from an interrupted epoch are not used
+        sharded_valid.close()
+
+    if not skip_minimums and best_valid_snapshot is not None:
         # Finalize saving best train and valid
-        best_valid_checkpoint_dict = pickle.loads(best_valid_checkpoint_pickle)
-        best_valid_results_dict = {k: v for k, v in best_valid_checkpoint_dict.items()
-                                   if k not in ignore_keys}
+        # The writer takes over the references held for the best snapshots
+        best_valid_checkpoint_dict = best_valid_snapshot
+        best_valid_results_dict = best_valid_snapshot.results
         ee = best_valid_checkpoint_epoch
         checkpoint_save_path = "%s_model_checkpoint_valid_%i.pkl" % (ident, ee + 1)
-        weights_save_path = "%s_model_weights_valid_%i.npz" % (ident, ee + 1)
+        weights_save_path = "%s_model_weights_valid_%i.json" % (ident, ee + 1)
         results_save_path = "%s_model_results_valid_%i.html" % (ident, ee + 1)
 
         objective = -np.inf
@@ -1906,12 +3507,12 @@ def run_loop(train_loop_function, train_itr,
                  (weights_save_path, best_valid_checkpoint_dict),
                  (checkpoint_save_path, best_valid_checkpoint_dict)))
 
-        best_train_checkpoint_dict = pickle.loads(best_train_checkpoint_pickle)
-        best_train_results_dict = {k: v for k, v in best_train_checkpoint_dict.items()
-                                   if k not in ignore_keys}
+    if not skip_minimums and best_train_snapshot is not None:
+        best_train_checkpoint_dict = best_train_snapshot
+        best_train_results_dict = best_train_snapshot.results
         ee = best_train_checkpoint_epoch
         checkpoint_save_path = "%s_model_checkpoint_train_%i.pkl" % (ident, ee + 1)
-        weights_save_path = "%s_model_weights_train_%i.npz" % (ident, ee + 1)
+        weights_save_path = "%s_model_weights_train_%i.json" % (ident, ee + 1)
         results_save_path = "%s_model_results_train_%i.html" % (ident, ee + 1)
 
         objective = -np.inf
@@ -1920,6 +3521,9 @@ def run_loop(train_loop_function, train_itr,
                  (weights_save_path, best_train_checkpoint_dict),
                  (checkpoint_save_path, best_train_checkpoint_dict)))
 
+    for itr in prefetched:
+        itr.close()
+
     logger.info("Loop finished, closing write threads (this may take a while!)")
     # set FINALIZE_TRAINING so that write threads know it is time to close
     _set_finalize_train()
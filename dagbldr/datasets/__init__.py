@@ -5,3 +5,7 @@ from .datasets import *
 from .dataset_utils import minibatch_iterator, list_iterator
 from .dataset_utils import character_sequence_iterator
 from .dataset_utils import word_sequence_iterator
+from .dataset_utils import prefetch_iterator
+from .dataset_utils import chunked_readahead
+from .dataset_utils import packed_list_iterator
+from .dataset_utils import packed_binary_array
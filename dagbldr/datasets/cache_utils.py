@@ -0,0 +1,130 @@
+# License: BSD 3-clause
+# Authors: Kyle Kastner
+"""
+On disk cache of fetched datasets as .npy files plus a json metadata file
+
+Each array is written once to <name>_v<version>.npy and loaded back with
+np.load(mmap_mode="r"), so repeated fetches are near-instant and jobs on
+one host share the page cache. Every file is written to a temporary name
+and renamed into place, and the metadata file is written last, so a
+cache entry is either complete or ignored.
+"""
+import numpy as np
+import json
+import os
+
+from ..core import get_logger
+
+logger = get_logger()
+
+
+def _array_path(cache_dir, name, version):
+    return os.path.join(cache_dir, "%s_v%s.npy" % (name, version))
+
+
+def _meta_path(cache_dir, version):
+    return os.path.join(cache_dir, "meta_v%s.json" % version)
+
+
+def _atomic_save(path, arr):
+    tmp_path = "%s.%i.tmp.npy" % (path[:-len(".npy")], os.getpid())
+    np.save(tmp_path, arr)
+    os.rename(tmp_path, path)
+
+
+def save_cached_arrays(cache_dir, arrays, version=1, meta=None):
+    """
+    Store arrays in cache_dir under version
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory for the cache, created if needed
+
+    arrays : dict
+        Mapping of name to array
+
+    version : int or str, default 1
+        Bump when the stored format of a dataset changes
+
+    meta : dict or None, default None
+        Extra json serializable metadata stored with the arrays
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    info = {}
+    for name, arr in arrays.items():
+        arr = np.asarray(arr)
+        _atomic_save(_array_path(cache_dir, name, version), arr)
+        info[name] = {"shape": list(arr.shape), "dtype": arr.dtype.str}
+    meta_path = _meta_path(cache_dir, version)
+    tmp_path = "%s.%i.tmp" % (meta_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump({"version": version, "arrays": info,
+                   "meta": meta if meta is not None else {}}, f)
+    os.rename(tmp_path, meta_path)
+
+
+def load_cached_arrays(cache_dir, version=1, mmap_mode="r"):
+    """
+    Load the arrays stored in cache_dir under version
+
+    Returns
+    -------
+    arrays, meta : dict, dict
+        Arrays are memory mapped unless mmap_mode is None. Both are None if
+        there is no complete cache entry for version.
+    """
+    meta_path = _meta_path(cache_dir, version)
+    if not os.path.exists(meta_path):
+        return None, None
+    with open(meta_path, "r") as f:
+        stored = json.load(f)
+    arrays = {}
+    for name, info in stored["arrays"].items():
+        path = _array_path(cache_dir, name, version)
+        if not os.path.exists(path):
+            return None, None
+        arr = np.load(path, mmap_mode=mmap_mode)
+        if (list(arr.shape) != info["shape"] or
+                arr.dtype.str != info["dtype"]):
+            logger.info("Cache file %s does not match its metadata" % path)
+            return None, None
+        arrays[name] = arr
+    return arrays, stored["meta"]
+
+
+def cached_arrays(cache_dir, build_func, version=1, mmap_mode="r"):
+    """
+    Load arrays from cache_dir, building and storing them first if needed
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory for the cache
+
+    build_func : callable
+        Called with no arguments on a cache miss, returns a dict of arrays
+        or a tuple of (arrays, meta)
+
+    version : int or str, default 1
+        Bump when the stored format of a dataset changes
+
+    mmap_mode : str or None, default "r"
+        Passed to np.load
+
+    Returns
+    -------
+    arrays, meta : dict, dict
+    """
+    arrays, meta = load_cached_arrays(cache_dir, version, mmap_mode)
+    if arrays is not None:
+        return arrays, meta
+    logger.info("Building dataset cache in %s" % cache_dir)
+    built = build_func()
+    if isinstance(built, tuple):
+        built, meta = built
+    else:
+        meta = None
+    save_cached_arrays(cache_dir, built, version=version, meta=meta)
+    return load_cached_arrays(cache_dir, version, mmap_mode)
@@ -1,21 +1,339 @@
 import numbers
+import os
+import json
+import hashlib
+import multiprocessing
 import numpy as np
-import itertools
+import threading
 import re
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
-from ..core import get_logger
-from collections import Counter
+from ..core import get_logger, safe_zip, RaggedArray
+from collections import Counter, OrderedDict
 
 logger = get_logger()
 
 
+def _offset_index(ind, offset):
+    # shift a slice or index array by offset
+    if isinstance(ind, slice):
+        return slice(ind.start + offset, ind.stop + offset)
+    return ind + offset
+
+
+def _storage_chunk_rows(container, chunk_bytes):
+    # rows per readahead chunk, a multiple of the storage chunking if any
+    shape = container.shape
+    row_bytes = np.dtype(container.dtype).itemsize * int(np.prod(shape[1:]))
+    target_rows = max(1, chunk_bytes // max(1, row_bytes))
+    storage = getattr(container, "chunks", None)
+    if storage is None:
+        # PyTables
+        storage = getattr(container, "chunkshape", None)
+    if storage is None or not isinstance(storage[0], numbers.Integral):
+        return int(target_rows)
+    storage_rows = int(storage[0])
+    return storage_rows * max(1, int(target_rows // storage_rows))
+
+
+class chunked_readahead(object):
+    """
+    Wrap a large array-like (memmap, h5py or PyTables dataset, ...) so reads
+    along the first axis go through whole chunks, with the next
+    n_chunks_ahead chunks read by a background thread
+
+    Chunks are chunk_rows rows, by default a multiple of the storage
+    chunking (.chunks or .chunkshape) of about chunk_bytes. At most
+    max_resident_chunks chunks are kept, least recently used first out,
+    so resident memory stays bounded whatever the size of the data.
+
+    Supports len, shape, dtype and indexing with an integer, a slice or
+    an index array on the first axis, optionally followed by indices for
+    the remaining axes. A slice inside one chunk returns a view of the
+    cached chunk.
+    """
+    def __init__(self, container, n_chunks_ahead=4, chunk_rows=None,
+                 chunk_bytes=2 ** 22, max_resident_chunks=None):
+        self.container = container
+        self.shape = tuple(container.shape)
+        self.dtype = np.dtype(container.dtype)
+        self.ndim = len(self.shape)
+        if chunk_rows is None:
+            chunk_rows = _storage_chunk_rows(container, chunk_bytes)
+        self.chunk_rows = chunk_rows
+        self.n_chunks = (self.shape[0] + chunk_rows - 1) // chunk_rows
+        self.n_chunks_ahead = n_chunks_ahead
+        if max_resident_chunks is None:
+            max_resident_chunks = 2 * (n_chunks_ahead + 1)
+        self.max_resident_chunks = max_resident_chunks
+        self._cache = OrderedDict()
+        self._pending = set()
+        self._queued = set()
+        self._condition = threading.Condition()
+        self._read_lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_chunk(self, k):
+        start = k * self.chunk_rows
+        stop = min(start + self.chunk_rows, self.shape[0])
+        if isinstance(self.container, np.ndarray):
+            return np.asarray(self.container[start:stop])
+        # other containers may hand out reused buffers and need not be
+        # thread safe, so read one chunk at a time into a private copy
+        with self._read_lock:
+            return np.array(self.container[start:stop], copy=True)
+
+    def _store(self, k, chunk):
+        # called with the condition held
+        self._cache[k] = chunk
+        self._pending.discard(k)
+        while len(self._cache) > self.max_resident_chunks:
+            self._cache.popitem(last=False)
+        self._condition.notify_all()
+
+    def _get_chunk(self, k):
+        with self._condition:
+            while True:
+                if k in self._cache:
+                    # mark as most recently used
+                    chunk = self._cache.pop(k)
+                    self._cache[k] = chunk
+                    return chunk
+                if k not in self._pending:
+                    break
+                self._condition.wait()
+            self._pending.add(k)
+        chunk = self._read_chunk(k)
+        with self._condition:
+            self._store(k, chunk)
+        return chunk
+
+    def _fill(self):
+        while True:
+            k = self._queue.get()
+            if k is None:
+                return
+            with self._condition:
+                self._queued.discard(k)
+                if k in self._cache or k in self._pending:
+                    continue
+                self._pending.add(k)
+            try:
+                chunk = self._read_chunk(k)
+            except Exception:
+                # the reader will retry and raise in the main thread
+                with self._condition:
+                    self._pending.discard(k)
+                    self._condition.notify_all()
+                continue
+            with self._condition:
+                self._store(k, chunk)
+
+    def _schedule(self, last_chunk):
+        if self.n_chunks_ahead < 1:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._fill)
+            self._thread.daemon = True
+            self._thread.start()
+        with self._condition:
+            for k in range(last_chunk + 1, min(
+                    last_chunk + 1 + self.n_chunks_ahead, self.n_chunks)):
+                if (k not in self._cache and k not in self._pending and
+                        k not in self._queued):
+                    self._queued.add(k)
+                    self._queue.put(k)
+
+    def close(self):
+        """ Stop the readahead thread and drop cached chunks """
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+        with self._condition:
+            self._cache.clear()
+            self._queued.clear()
+        self._queue = Queue.Queue()
+
+    def _rows(self, start, stop):
+        first = start // self.chunk_rows
+        last = (stop - 1) // self.chunk_rows
+        pieces = []
+        for k in range(first, last + 1):
+            offset = k * self.chunk_rows
+            chunk = self._get_chunk(k)
+            pieces.append(chunk[max(start - offset, 0):stop - offset])
+        self._schedule(last)
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces, axis=0)
+
+    def _gather(self, ind):
+        ind = np.asarray(ind)
+        if ind.dtype == bool:
+            ind = np.where(ind)[0]
+        ind = np.where(ind < 0, ind + self.shape[0], ind)
+        if np.any(ind < 0) or np.any(ind >= self.shape[0]):
+            raise IndexError("Index out of bounds for axis 0 with size %i" %
+                             self.shape[0])
+        out = np.empty((len(ind),) + self.shape[1:], dtype=self.dtype)
+        chunk_ids = ind // self.chunk_rows
+        for k in np.unique(chunk_ids):
+            sel = chunk_ids == k
+            out[sel] = self._get_chunk(k)[ind[sel] - k * self.chunk_rows]
+        if len(ind) > 0:
+            self._schedule(int(chunk_ids.max()))
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            first, rest = key[0], key[1:]
+        else:
+            first, rest = key, ()
+        if isinstance(first, numbers.Integral):
+            i = first + self.shape[0] if first < 0 else first
+            if i < 0 or i >= self.shape[0]:
+                raise IndexError("Index %i out of bounds for axis 0 with size"
+                                 " %i" % (first, self.shape[0]))
+            out = self._rows(i, i + 1)[0]
+        elif isinstance(first, slice):
+            start, stop, step = first.indices(self.shape[0])
+            if step != 1:
+                out = self._gather(np.arange(start, stop, step))
+            elif stop <= start:
+                out = np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            else:
+                out = self._rows(start, stop)
+        else:
+            out = self._gather(first)
+        if len(rest) > 0:
+            if isinstance(first, numbers.Integral):
+                return out[rest]
+            return out[(slice(None),) + rest]
+        return out
+
+
+class packed_binary_array(object):
+    """
+    Binary (0 or 1) data stored 8 samples per byte with np.packbits
+
+    Indexing along the first axis unpacks only the selected rows, into one
+    of n_buffers reused arrays of dtype, used in turn. A result stays valid
+    for the next n_buffers - 1 lookups, so keep n_buffers above the
+    prefetch depth of any iterator reading from this array.
+
+    Parameters
+    ----------
+    packed : array, shape (n_samples, ceil(n_features / 8))
+        Output of np.packbits(binary_data, axis=1), uint8
+
+    n_features : int
+        Number of features before packing
+
+    dtype : dtype, default "float32"
+        dtype of unpacked rows
+
+    n_buffers : int, default 2
+        Number of reused output buffers
+    """
+    def __init__(self, packed, n_features, dtype="float32", n_buffers=2):
+        self.packed = packed
+        self.n_features = n_features
+        self.dtype = np.dtype(dtype)
+        self.shape = (len(packed), n_features)
+        self.ndim = 2
+        self.n_buffers = n_buffers
+        self._buffers = [None] * n_buffers
+        self._slot = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def unpack(self, dtype=None):
+        """ All rows, unpacked into a new array """
+        if dtype is None:
+            dtype = self.dtype
+        return np.unpackbits(np.asarray(self.packed), axis=1)[
+            :, :self.n_features].astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            first, rest = key[0], key[1:]
+        else:
+            first, rest = key, ()
+        if isinstance(first, numbers.Integral):
+            bits = np.unpackbits(np.asarray(self.packed[first]))
+            out = bits[:self.n_features].astype(self.dtype)
+            return out[rest] if len(rest) > 0 else out
+        bits = np.unpackbits(np.asarray(self.packed[first]), axis=1)
+        n_rows = len(bits)
+        buf = self._buffers[self._slot]
+        if buf is None or len(buf) < n_rows:
+            buf = np.empty((n_rows, self.n_features), dtype=self.dtype)
+            self._buffers[self._slot] = buf
+        self._slot = (self._slot + 1) % self.n_buffers
+        out = buf[:n_rows]
+        out[...] = bits[:, :self.n_features]
+        if len(rest) > 0:
+            return out[(slice(None),) + rest]
+        return out
+
+
 class base_iterator(object):
+    """
+    Minibatches over containers which share a sample axis
+
+    Sequential minibatches are basic slices, so ndarray and memmap
+    containers hand out views without copying. Minibatches with arbitrary
+    indices are gathers. With n_buffers > 0 a gather writes into one of
+    n_buffers preallocated arrays per container, used in turn, so a
+    minibatch stays valid for the next n_buffers - 1 calls.
+
+    shuffle draws a new sample order at every reset
+
+    None - sequential, minibatches are views
+    "full" - a permutation of all samples between start_index and stop_index
+    "block" - permutes contiguous blocks of block_size samples and shuffles
+        within each block, so a minibatch reads from one or two regions of
+        a memmap or HDF5 container
+
+    Indices are sorted within each shuffled minibatch, which keeps reads
+    in order and is what h5py requires for fancy indexing. random_state
+    is a RandomState or seed, default 1999. block_size defaults to 16
+    minibatches.
+
+    Containers given as a path to a .npy file are memory mapped. With
+    readahead > 0, containers which are not in memory arrays (memmaps,
+    HDF5 datasets, ...) are wrapped in chunked_readahead, reading
+    readahead chunks ahead in a background thread. packed_binary_array
+    is already in memory and is not wrapped. Readahead needs the samples
+    on the first axis.
+    """
     def __init__(self, list_of_containers, minibatch_size,
                  axis,
                  start_index=0,
                  stop_index=np.inf,
                  make_mask=False,
-                 one_hot_class_size=None):
+                 one_hot_class_size=None,
+                 n_buffers=0,
+                 shuffle=None,
+                 random_state=None,
+                 block_size=None,
+                 readahead=0):
+        list_of_containers = [np.load(c, mmap_mode="r")
+                              if isinstance(c, str) else c
+                              for c in list_of_containers]
+        self.readahead = readahead
+        if readahead > 0:
+            list_of_containers = self._wrap_readahead(list_of_containers,
+                                                      axis)
         self.list_of_containers = list_of_containers
         self.minibatch_size = minibatch_size
         self.make_mask = make_mask
@@ -25,9 +343,82 @@ class base_iterator(object):
         self.axis = axis
         if axis not in [0, 1]:
             raise ValueError("Unknown sample_axis setting %i" % axis)
+        self.n_buffers = n_buffers
+        self._buffers = {}
+        self._buffer_slot = 0
+        if shuffle not in [None, "full", "block"]:
+            raise ValueError("Unknown shuffle setting %s" % shuffle)
+        self.shuffle = shuffle
+        if random_state is None:
+            random_state = np.random.RandomState(1999)
+        elif isinstance(random_state, numbers.Integral):
+            random_state = np.random.RandomState(random_state)
+        self.random_state = random_state
+        if block_size is None:
+            block_size = 16 * minibatch_size
+        self.block_size = block_size
+        self._permutation = None
+        if self.shuffle is not None:
+            self._permute()
 
     def reset(self):
         self.slice_start_ = self.start_index
+        if self.shuffle is not None:
+            self._permute()
+
+    def _wrap_readahead(self, list_of_containers, axis):
+        if axis != 0:
+            raise ValueError("readahead requires axis=0")
+        return [chunked_readahead(c, self.readahead)
+                if (not isinstance(c, np.ndarray) or
+                    isinstance(c, np.memmap)) and
+                not isinstance(c, (list, chunked_readahead,
+                                   packed_binary_array))
+                else c for c in list_of_containers]
+
+    def _permute(self):
+        # new order for the samples of one epoch, offset by start_index
+        stop_index = min(self.stop_index, self._n_samples())
+        n = int(stop_index - self.start_index)
+        if self.shuffle == "full":
+            perm = self.random_state.permutation(n)
+        else:
+            n_blocks = (n + self.block_size - 1) // self.block_size
+            block_rank = np.empty((n_blocks,), dtype="int64")
+            block_rank[self.random_state.permutation(n_blocks)] = np.arange(
+                n_blocks)
+            sample_rank = block_rank[np.arange(n) // self.block_size]
+            # sort by shuffled block, then randomly inside each block
+            perm = np.lexsort((self.random_state.rand(n), sample_rank))
+        self._permutation = perm + self.start_index
+
+    def _n_samples(self):
+        c = self.list_of_containers[0]
+        if self.axis == 0:
+            return len(c)
+        else:
+            return c.shape[1]
+
+    def shard_bounds(self, n_shards):
+        """
+        Split the minibatches between start_index and stop_index into at
+        most n_shards contiguous (start_index, stop_index) ranges
+
+        Bounds are minibatch aligned, so iterating every shard gives the
+        same minibatches as iterating the whole range.
+        """
+        stop_index = min(self.stop_index, self._n_samples())
+        n_minibatches = int((stop_index - self.start_index) //
+                            self.minibatch_size)
+        bounds = []
+        for i in range(n_shards):
+            first = i * n_minibatches // n_shards
+            last = (i + 1) * n_minibatches // n_shards
+            if last > first:
+                bounds.append(
+                    (self.start_index + first * self.minibatch_size,
+                     self.start_index + last * self.minibatch_size))
+        return bounds
 
     def __iter__(self):
         return self
@@ -37,23 +428,50 @@ class base_iterator(object):
 
     def __next__(self):
         self.slice_end_ = self.slice_start_ + self.minibatch_size
-        if self.slice_end_ > self.stop_index:
+        # slices never raise IndexError, so check the data length here
+        if self.slice_end_ > min(self.stop_index, self._n_samples()):
             # TODO: Think about boundary issues with weird shaped last mb
             self.reset()
             raise StopIteration("Stop index reached")
-        ind = np.arange(self.slice_start_, self.slice_end_)
+        ind = self._minibatch_index(self.slice_start_, self.slice_end_)
         self.slice_start_ = self.slice_end_
+        if self.n_buffers > 0:
+            self._buffer_slot = (self._buffer_slot + 1) % self.n_buffers
         if self.make_mask is False:
             return self._slice_without_masks(ind)
         else:
             return self._slice_with_masks(ind)
 
+    def _minibatch_index(self, start, end):
+        """ Slice or index array for samples start to end of an epoch """
+        if self.shuffle is None:
+            return slice(start, end)
+        return np.sort(self._permutation[start - self.start_index:
+                                         end - self.start_index])
+
+    def _take(self, n, c, ind):
+        # container n, indexed along the sample axis
+        if (isinstance(ind, slice) or self.n_buffers < 1 or
+                not isinstance(c, np.ndarray)):
+            if self.axis == 0:
+                return c[ind]
+            else:
+                return c[:, ind]
+        shape = list(c.shape)
+        shape[self.axis] = len(ind)
+        shape = tuple(shape)
+        key = (n, self._buffer_slot)
+        buf = self._buffers.get(key, None)
+        if buf is None or buf.shape != shape or buf.dtype != c.dtype:
+            buf = np.empty(shape, dtype=c.dtype)
+            self._buffers[key] = buf
+        np.take(c, ind, axis=self.axis, out=buf)
+        return buf
+
     def _slice_without_masks(self, ind):
         try:
-            if self.axis == 0:
-                return [c[ind] for c in self.list_of_containers]
-            elif self.axis == 1:
-                return [c[:, ind] for c in self.list_of_containers]
+            return [self._take(n, c, ind)
+                    for n, c in enumerate(self.list_of_containers)]
         except IndexError:
             self.reset()
             raise StopIteration("End of iteration")
@@ -73,19 +491,166 @@ class base_iterator(object):
 
 
 class minibatch_iterator(base_iterator):
+    """
+    Minibatches over containers which share a sample axis
+
+    With shared=True the containers are uploaded to theano shared
+    variables (shared_containers) and the iterator yields the integer
+    index of each minibatch instead of arrays. Compile functions with
+    givens=itr.shared_givens(symbols, index_sym), so every call only
+    passes that index. Shuffled orders are applied through a shared
+    int32 permutation, updated at every reset.
+
+    shared_chunk_size, a multiple of minibatch_size, uploads that many
+    samples at a time, in epoch order, for datasets larger than device
+    memory. Shared mode needs axis=0, no masks, and containers in the
+    dtype the graph expects (float32 on the GPU).
+    """
+    def __init__(self, list_of_containers, minibatch_size,
+                 axis,
+                 start_index=0,
+                 stop_index=np.inf,
+                 make_mask=False,
+                 one_hot_class_size=None,
+                 n_buffers=0,
+                 shuffle=None,
+                 random_state=None,
+                 block_size=None,
+                 readahead=0,
+                 shared=False,
+                 shared_chunk_size=None):
+        self.shared = shared
+        self.shared_chunk_size = shared_chunk_size
+        self.shared_containers = None
+        self._shared_perm = None
+        base_iterator.__init__(self, list_of_containers, minibatch_size,
+                               axis, start_index=start_index,
+                               stop_index=stop_index, make_mask=make_mask,
+                               one_hot_class_size=one_hot_class_size,
+                               n_buffers=n_buffers, shuffle=shuffle,
+                               random_state=random_state,
+                               block_size=block_size, readahead=readahead)
+        if shared:
+            self._init_shared()
+
+    def _init_shared(self):
+        import theano
+        if self.make_mask is not False:
+            raise ValueError("shared mode does not support make_mask")
+        if self.axis != 0:
+            raise ValueError("shared mode requires axis=0")
+        stop_index = int(min(self.stop_index, self._n_samples()))
+        self._n_shared_minibatches = int(
+            (stop_index - self.start_index) // self.minibatch_size)
+        if self.shared_chunk_size is None:
+            self._chunk_minibatches = max(1, self._n_shared_minibatches)
+            # shuffled epochs can draw any sample in range
+            rows = slice(self.start_index, stop_index)
+            self.shared_containers = [theano.shared(np.asarray(c[rows]))
+                                      for c in self.list_of_containers]
+            if self.shuffle is not None:
+                self._shared_perm = theano.shared(
+                    self._shared_permutation())
+            self._loaded_chunk = 0
+        else:
+            if self.shared_chunk_size % self.minibatch_size != 0:
+                raise ValueError("shared_chunk_size must be a multiple of "
+                                 "minibatch_size")
+            self._chunk_minibatches = (self.shared_chunk_size //
+                                       self.minibatch_size)
+            self.shared_containers = [
+                theano.shared(np.zeros((0,) + tuple(c.shape[1:]),
+                                       dtype=c.dtype))
+                for c in self.list_of_containers]
+            self._loaded_chunk = None
+
+    def _shared_permutation(self):
+        # epoch order relative to start_index, sorted within minibatches
+        n_used = self._n_shared_minibatches * self.minibatch_size
+        perm = self._permutation[:n_used] - self.start_index
+        perm = np.sort(perm.reshape(-1, self.minibatch_size), axis=1)
+        return perm.ravel().astype("int32")
+
+    def _permute(self):
+        base_iterator._permute(self)
+        if self._shared_perm is not None:
+            self._shared_perm.set_value(self._shared_permutation())
+
+    def _load_chunk(self, k):
+        first = k * self.shared_chunk_size
+        last = min(first + self.shared_chunk_size,
+                   self._n_shared_minibatches * self.minibatch_size)
+        if self.shuffle is None:
+            ind = slice(self.start_index + first, self.start_index + last)
+            chunks = [np.asarray(c[ind]) for c in self.list_of_containers]
+        else:
+            ind = np.sort(self._permutation[first:last].reshape(
+                -1, self.minibatch_size), axis=1).ravel()
+            # read in increasing order, as h5py requires, then reorder
+            sorted_ind = np.sort(ind)
+            order = np.searchsorted(sorted_ind, ind)
+            chunks = [np.asarray(c[sorted_ind])[order]
+                      for c in self.list_of_containers]
+        for sc, chunk in safe_zip(self.shared_containers, chunks):
+            sc.set_value(chunk)
+        self._loaded_chunk = k
+
+    def reset(self):
+        base_iterator.reset(self)
+        if self.shared and self.shuffle is not None and (
+                self.shared_chunk_size is not None):
+            # the next epoch has a new order, chunks must be gathered again
+            self._loaded_chunk = None
+
+    def __next__(self):
+        if not self.shared:
+            return base_iterator.__next__(self)
+        k = (self.slice_start_ - self.start_index) // self.minibatch_size
+        if k >= self._n_shared_minibatches:
+            self.reset()
+            raise StopIteration("Stop index reached")
+        chunk = k // self._chunk_minibatches
+        if chunk != self._loaded_chunk:
+            self._load_chunk(chunk)
+        self.slice_start_ += self.minibatch_size
+        return k % self._chunk_minibatches
+
+    def shared_givens(self, list_of_symbols, index_sym):
+        """
+        Givens mapping each symbol to its container's minibatch index_sym
+
+        Parameters
+        ----------
+        list_of_symbols : list of theano variables
+            One symbolic input per container, in container order
+
+        index_sym : theano integer scalar
+            The minibatch index, as yielded by the iterator
+
+        Returns
+        -------
+        givens : OrderedDict
+            To pass as givens to theano.function
+        """
+        if not self.shared:
+            raise ValueError("shared_givens requires shared=True")
+        start = index_sym * self.minibatch_size
+        stop = start + self.minibatch_size
+        givens = OrderedDict()
+        for sym, sc in safe_zip(list_of_symbols, self.shared_containers):
+            if self._shared_perm is not None:
+                givens[sym] = sc[self._shared_perm[start:stop]]
+            else:
+                givens[sym] = sc[start:stop]
+        return givens
+
     def _slice_without_masks(self, ind):
         try:
-            if self.axis == 0:
-                if len(self.list_of_containers) > 1:
-                    return [c[ind] for c in self.list_of_containers]
-                else:
-                    return self.list_of_containers[0][ind]
-
-            elif self.axis == 1:
-                if len(self.list_of_containers) > 1:
-                    return [c[:, ind] for c in self.list_of_containers]
-                else:
-                    return self.list_of_containers[0][:, ind]
+            if len(self.list_of_containers) > 1:
+                return [self._take(n, c, ind)
+                        for n, c in enumerate(self.list_of_containers)]
+            else:
+                return self._take(0, self.list_of_containers[0], ind)
         except IndexError:
             self.reset()
             raise StopIteration("End of iteration")
@@ -106,44 +671,185 @@ class minibatch_iterator(base_iterator):
 
 
 class list_iterator(base_iterator):
+    """
+    Minibatches of ragged sequences, padded to the longest in each batch
+
+    With bucket_boundaries, samples are grouped by length into buckets
+    (length <= boundary, plus one bucket past the last boundary) and every
+    minibatch comes from a single bucket. Samples left over at the end of
+    a bucket move on to the next one, leftovers of the last bucket are
+    dropped. Within a bucket samples are shuffled if shuffle is set, and
+    shuffle_buckets shuffles the order of the minibatches every epoch.
+    padding_efficiency() reports the fraction of padded steps which hold
+    data.
+    """
+    def __init__(self, list_of_containers, minibatch_size,
+                 axis,
+                 start_index=0,
+                 stop_index=np.inf,
+                 make_mask=False,
+                 one_hot_class_size=None,
+                 n_buffers=0,
+                 shuffle=None,
+                 random_state=None,
+                 block_size=None,
+                 readahead=0,
+                 bucket_boundaries=None,
+                 shuffle_buckets=False):
+        self.bucket_boundaries = bucket_boundaries
+        self.shuffle_buckets = shuffle_buckets
+        self._lengths = None
+        self._batches = None
+        self._ragged = None
+        base_iterator.__init__(self, list_of_containers, minibatch_size,
+                               axis, start_index=start_index,
+                               stop_index=stop_index, make_mask=make_mask,
+                               one_hot_class_size=one_hot_class_size,
+                               n_buffers=n_buffers, shuffle=shuffle,
+                               random_state=random_state,
+                               block_size=block_size, readahead=readahead)
+        if self.bucket_boundaries is not None:
+            self._make_batches()
+
+    def _n_samples(self):
+        # samples are always indexed along the first dimension of a list
+        return len(self.list_of_containers[0])
+
+    def _wrap_readahead(self, list_of_containers, axis):
+        # samples are on the first axis whatever the time axis, only
+        # regular arrays can be read in chunks
+        return [chunked_readahead(c, self.readahead)
+                if (not isinstance(c, (list, chunked_readahead,
+                                       packed_binary_array)) and
+                    np.dtype(c.dtype) != object and
+                    (not isinstance(c, np.ndarray) or
+                     isinstance(c, np.memmap)))
+                else c for c in list_of_containers]
+
+    def reset(self):
+        base_iterator.reset(self)
+        if self.bucket_boundaries is not None and (
+                self.shuffle is not None or self.shuffle_buckets):
+            self._make_batches()
+
+    def _sample_lengths(self):
+        # longest entry over all containers, for each sample in range
+        if self._lengths is None:
+            stop_index = int(min(self.stop_index, self._n_samples()))
+            lengths = []
+            for n, c in enumerate(self.list_of_containers):
+                ragged = self._ragged_container(n)
+                if ragged is None:
+                    c_lengths = np.array([len(c[i]) for i in range(
+                        self.start_index, stop_index)])
+                else:
+                    c_lengths = ragged.lengths[self.start_index:stop_index]
+                lengths.append(c_lengths)
+            self._lengths = np.max(np.array(lengths), axis=0)
+        return self._lengths
+
+    def _make_batches(self):
+        lengths = self._sample_lengths()
+        buckets = np.searchsorted(np.asarray(self.bucket_boundaries),
+                                  lengths, side="left")
+        batches = []
+        carry = np.zeros((0,), dtype="int64")
+        for b in range(len(self.bucket_boundaries) + 1):
+            members = np.where(buckets == b)[0]
+            if self.shuffle is not None:
+                members = self.random_state.permutation(members)
+            members = np.concatenate((carry, members))
+            n_full = len(members) // self.minibatch_size
+            for i in range(n_full):
+                batches.append(members[i * self.minibatch_size:
+                                       (i + 1) * self.minibatch_size])
+            carry = members[n_full * self.minibatch_size:]
+        if self.shuffle_buckets:
+            batches = [batches[i] for i in
+                       self.random_state.permutation(len(batches))]
+        self._batches = [np.sort(bt) + self.start_index for bt in batches]
+
+    def _epoch_batches(self):
+        if self.bucket_boundaries is not None:
+            return self._batches
+        n = len(self._sample_lengths()) // self.minibatch_size
+        return [self._minibatch_index(
+            self.start_index + i * self.minibatch_size,
+            self.start_index + (i + 1) * self.minibatch_size)
+            for i in range(n)]
+
+    def padding_efficiency(self):
+        """
+        Data steps over padded steps for the minibatches of this epoch
+        """
+        lengths = self._sample_lengths()
+        used = 0
+        padded = 0
+        for ind in self._epoch_batches():
+            batch_lengths = lengths[_offset_index(ind, -self.start_index)]
+            used += np.sum(batch_lengths)
+            padded += len(batch_lengths) * np.max(batch_lengths)
+        if padded == 0:
+            return 1.
+        return float(used) / padded
+
+    def _minibatch_index(self, start, end):
+        if self.bucket_boundaries is None:
+            return base_iterator._minibatch_index(self, start, end)
+        k = (start - self.start_index) // self.minibatch_size
+        if k >= len(self._batches):
+            self.reset()
+            raise StopIteration("End of buckets")
+        return self._batches[k]
+
+    def _ragged_container(self, n):
+        # RaggedArray for container n, None for a regular array
+        if self._ragged is None:
+            self._ragged = [None if (isinstance(c, (np.ndarray,
+                                                    chunked_readahead)) and
+                                     c.dtype != object)
+                            else RaggedArray(c)
+                            for c in self.list_of_containers]
+        return self._ragged[n]
+
+    def _padded(self, ind):
+        # (data, mask) per container, mask is None for regular arrays
+        slot = self._buffer_slot if self.n_buffers > 0 else None
+        padded = []
+        for n, c in enumerate(self.list_of_containers):
+            ragged = self._ragged_container(n)
+            if ragged is None:
+                padded.append((np.asarray(c[ind]), None))
+                continue
+            if self.axis == 0:
+                raise ValueError("Unsupported axis of iteration")
+            data, mask = ragged.padded(ind, time_major=True,
+                                       mask_dtype=ragged.flat.dtype,
+                                       slot=slot)
+            if len(ragged.feature_shape) == 0:
+                data = data[:, :, None]
+            padded.append((data, mask))
+        return padded
+
     def _slice_without_masks(self, ind):
         try:
-            sliced_c = [np.asarray(c[ind]) for c in self.list_of_containers]
-            for n in range(len(sliced_c)):
-                sc = sliced_c[n]
-                if not isinstance(sc, np.ndarray) or sc.dtype == np.object:
-                    maxlen = max([len(i) for i in sc])
-                    # Assume they at least have the same internal dtype
-                    if len(sc[0].shape) > 1:
-                        total_shape = (maxlen, sc[0].shape[1])
-                    elif len(sc[0].shape) == 1:
-                        total_shape = (maxlen, 1)
-                    else:
-                        raise ValueError("Unhandled array size in list")
-                    if self.axis == 0:
-                        raise ValueError("Unsupported axis of iteration")
-                        new_sc = np.zeros((len(sc), total_shape[0],
-                                           total_shape[1]))
-                        new_sc = new_sc.squeeze().astype(sc[0].dtype)
-                    else:
-                        new_sc = np.zeros((total_shape[0], len(sc),
-                                           total_shape[1]))
-                        new_sc = new_sc.astype(sc[0].dtype)
-                        for m, sc_i in enumerate(sc):
-                            new_sc[:len(sc_i), m, :] = sc_i
-                    sliced_c[n] = new_sc
-            return sliced_c
+            return [data for data, mask in self._padded(ind)]
         except IndexError:
             self.reset()
             raise StopIteration("End of iteration")
 
     def _slice_with_masks(self, ind):
         try:
-            cs = self._slice_without_masks(ind)
-            if self.axis == 0:
-                ms = [np.ones_like(c[:, 0]) for c in cs]
-            elif self.axis == 1:
-                ms = [np.ones_like(c[:, :, 0]) for c in cs]
+            cs = []
+            ms = []
+            for data, mask in self._padded(ind):
+                if mask is None:
+                    if self.axis == 0:
+                        mask = np.ones_like(data[:, 0])
+                    elif self.axis == 1:
+                        mask = np.ones_like(data[:, :, 0])
+                cs.append(data)
+                ms.append(mask)
             assert len(cs) == len(ms)
             return [i for sublist in list(zip(cs, ms)) for i in sublist]
         except IndexError:
@@ -151,6 +857,245 @@ class list_iterator(base_iterator):
             raise StopIteration("End of iteration")
 
 
+def _first_fit_decreasing(lengths, capacity):
+    """
+    Pack items into bins of size capacity, longest item first, each into
+    the lowest numbered bin with room
+
+    Returns the bin and the offset within that bin for every item.
+    """
+    lengths = np.asarray(lengths, dtype="int64")
+    n = len(lengths)
+    if n > 0 and lengths.max() > capacity:
+        raise ValueError("Sequence of length %i does not fit in rows of "
+                         "length %i" % (lengths.max(), capacity))
+    # max tree over remaining capacity, one leaf per possible bin
+    size = 1
+    while size < max(n, 1):
+        size *= 2
+    tree = [capacity] * (2 * size)
+    bins = np.zeros((n,), dtype="int64")
+    offsets = np.zeros((n,), dtype="int64")
+    for i in np.argsort(-lengths, kind="mergesort"):
+        length = lengths[i]
+        node = 1
+        while node < size:
+            node = 2 * node if tree[2 * node] >= length else 2 * node + 1
+        bins[i] = node - size
+        offsets[i] = capacity - tree[node]
+        tree[node] -= length
+        node //= 2
+        while node >= 1:
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+            node //= 2
+    return bins, offsets
+
+
+class packed_list_iterator(base_iterator):
+    """
+    Minibatches of ragged sequences packed back to back into rows
+
+    Sequences between start_index and stop_index are packed into rows of
+    row_length steps by first fit decreasing, and minibatches are
+    minibatch_size rows. Each minibatch is the time major data of every
+    container, (row_length, minibatch_size, features), followed by a
+    loss mask, 1 at steps which hold data, and a reset mask, 1 at the
+    first step of every sequence, both (row_length, minibatch_size).
+
+    Pass the reset mask to the recurrent nodes (simple, lstm) so state
+    does not carry from one sequence to the next within a row. All
+    containers must hold sequences of the same lengths. shuffle applies
+    to the order of the rows.
+    """
+    def __init__(self, list_of_containers, minibatch_size, row_length,
+                 start_index=0,
+                 stop_index=np.inf,
+                 shuffle=None,
+                 random_state=None,
+                 block_size=None,
+                 mask_dtype="float32"):
+        self.row_length = row_length
+        self.mask_dtype = mask_dtype
+        self.sample_start_index = start_index
+        self.sample_stop_index = stop_index
+        stop_index = int(min(stop_index, len(list_of_containers[0])))
+        self._ragged = [RaggedArray(c[start_index:stop_index])
+                        for c in list_of_containers]
+        lengths = self._ragged[0].lengths
+        for r in self._ragged[1:]:
+            if not np.all(r.lengths == lengths):
+                raise ValueError("All containers must have sequences of "
+                                 "the same length to be packed")
+        rows, offsets = _first_fit_decreasing(lengths, row_length)
+        self.n_rows = int(rows.max()) + 1 if len(rows) > 0 else 0
+        # sequences grouped by row, so a run of rows is a run of sequences
+        order = np.argsort(rows, kind="mergesort")
+        self._seq = order
+        self._seq_rows = rows[order]
+        self._seq_offsets = offsets[order]
+        self._row_starts = np.searchsorted(self._seq_rows,
+                                           np.arange(self.n_rows + 1))
+        base_iterator.__init__(self, list_of_containers, minibatch_size,
+                               axis=1, shuffle=shuffle,
+                               random_state=random_state,
+                               block_size=block_size)
+
+    def _n_samples(self):
+        # the iteration is over packed rows
+        return self.n_rows
+
+    def padding_efficiency(self):
+        """
+        Data steps over total steps for the rows which fill minibatches
+        """
+        n_used_rows = ((self.n_rows // self.minibatch_size) *
+                       self.minibatch_size)
+        if n_used_rows == 0:
+            return 1.
+        used = self._row_starts[n_used_rows]
+        steps = np.sum(self._ragged[0].lengths[self._seq[:used]])
+        return float(steps) / (n_used_rows * self.row_length)
+
+    def _slice_without_masks(self, ind):
+        if isinstance(ind, slice):
+            ind = np.arange(ind.start, ind.stop)
+        # batch column of every sequence in the selected rows
+        counts = self._row_starts[ind + 1] - self._row_starts[ind]
+        column = np.repeat(np.arange(len(ind)), counts)
+        pos = np.concatenate([np.zeros((0,), dtype="int64")] +
+                             [np.arange(self._row_starts[r],
+                                        self._row_starts[r + 1])
+                              for r in ind])
+        seq = self._seq[pos]
+        t_start = self._seq_offsets[pos]
+        lengths = self._ragged[0].lengths[seq]
+        # one entry per data step, as in RaggedArray.padded
+        step_seq = np.repeat(np.arange(len(seq)), lengths)
+        within = np.arange(np.sum(lengths)) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths)
+        t = t_start[step_seq] + within
+        b = column[step_seq]
+        out = []
+        for ragged in self._ragged:
+            src = ragged.offsets[seq][step_seq] + within
+            data = np.zeros((self.row_length, len(ind)) + ragged.feature_shape,
+                            dtype=ragged.flat.dtype)
+            data[t, b] = ragged.flat[src]
+            if len(ragged.feature_shape) == 0:
+                data = data[:, :, None]
+            out.append(data)
+        loss_mask = np.zeros((self.row_length, len(ind)),
+                             dtype=self.mask_dtype)
+        loss_mask[t, b] = 1.
+        reset_mask = np.zeros((self.row_length, len(ind)),
+                              dtype=self.mask_dtype)
+        reset_mask[t_start, column] = 1.
+        return out + [loss_mask, reset_mask]
+
+    def _slice_with_masks(self, ind):
+        return self._slice_without_masks(ind)
+
+
+class prefetch_iterator(object):
+    """
+    Wraps any dagbldr iterator, building minibatches ahead of time in a
+    background thread so that minibatch construction overlaps with the
+    theano function call.
+
+    The end of an epoch is passed through the queue, so next() raises
+    StopIteration in the same place the wrapped iterator would. The worker
+    then continues with the following epoch. Calling reset() discards any
+    prefetched minibatches and resets the wrapped iterator.
+
+    Attribute lookups not found on the wrapper (n_classes, transform, ...) are
+    forwarded to the wrapped iterator.
+
+    prefetch_depth is the maximum number of ready minibatches held in memory.
+    Iterators which reuse output buffers must keep more buffers than
+    prefetch_depth + 1.
+    """
+    def __init__(self, iterator, prefetch_depth=2):
+        if prefetch_depth < 1:
+            raise ValueError("prefetch_depth must be >= 1")
+        self.iterator = iterator
+        self.prefetch_depth = prefetch_depth
+        self._start()
+
+    def _start(self):
+        self.queue_ = Queue.Queue(maxsize=self.prefetch_depth)
+        self.stop_event_ = threading.Event()
+        self.thread_ = threading.Thread(
+            target=self._fill, args=(self.queue_, self.stop_event_))
+        # Never hold up interpreter exit for a blocked producer
+        self.thread_.daemon = True
+        self.thread_.start()
+
+    def _fill(self, queue, stop_event):
+        while not stop_event.is_set():
+            try:
+                item = ("batch", next(self.iterator))
+            except StopIteration as e:
+                item = ("stop", e)
+            except Exception as e:
+                item = ("error", e)
+            while not stop_event.is_set():
+                try:
+                    queue.put(item, timeout=.1)
+                    break
+                except Queue.Full:
+                    pass
+            if item[0] == "error":
+                return
+
+    def _drain(self):
+        try:
+            while True:
+                self.queue_.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def _stop(self):
+        self.stop_event_.set()
+        # Unblock the producer if it is waiting on a full queue, then discard
+        # anything it managed to put before seeing the stop event
+        self._drain()
+        self.thread_.join()
+        self._drain()
+
+    def close(self):
+        """ Stop the background thread """
+        if self.thread_.is_alive():
+            self._stop()
+
+    def reset(self):
+        self.close()
+        self.iterator.reset()
+        self._start()
+
+    def __getattr__(self, name):
+        # Only called when normal lookup fails, avoid recursion before init
+        if name == "iterator":
+            raise AttributeError(name)
+        return getattr(self.iterator, name)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.__next__()
+
+    def __next__(self):
+        if not self.thread_.is_alive() and self.queue_.empty():
+            raise ValueError("prefetch_iterator is closed")
+        kind, item = self.queue_.get()
+        if kind == "batch":
+            return item
+        elif kind == "stop":
+            raise StopIteration(*item.args)
+        else:
+            raise item
+
+
 cap = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
 lower = "abcdefghijklmnopqrstuvwxyz"
 alpha = "0123456789"
@@ -158,61 +1103,66 @@ punc = " \\`,.?!=-+!@#$%^&*()[]{}:;'|/"
 punc += '"'
 all_chars = cap + lower + alpha + punc
 
-class character_sequence_iterator(object):
-    def __init__(self, sentence_iterator, minibatch_size,
-                 truncation_length,
-                 iterator_length=None,
-                 start_index=0,
-                 stop_index=np.inf,
-                 valid_items=None,
-                 stop_items=None,
-                 extra_preproc_options=None):
-        self.sentence_iterator = sentence_iterator
-        self.minibatch_size = minibatch_size
-        self.truncation_length = truncation_length
-        self.start_index = start_index
-        self.stop_index = stop_index
-        if start_index != 0 or stop_index != np.inf:
-            raise AttributeError("start_index and stop_index not yet supported")
-        self.slice_start_ = start_index
-        self.extra_preproc_options = extra_preproc_options
-        if self.extra_preproc_options is not None:
-            raise AttributeError("Extra preproc options not yet supported")
-        self.n_classes = len(all_chars)
-        rlu = {k: v for k, v in enumerate(all_chars)}
-        lu = {v: k for k, v in rlu.items()}
-        self.char_to_class = lu
-        self.class_to_char = rlu
-        def process(s):
-            return [si for si in s]
 
-        self._process = process
+def _unichr(codepoint):
+    try:
+        return unichr(codepoint)
+    except NameError:
+        return chr(codepoint)
+
+
+def encode_characters(text, chars=all_chars):
+    """
+    Encode text as a uint8 array of indices into chars, in one pass
+
+    Characters are mapped through a lookup table indexed by code point.
+    Raises ValueError for characters not in chars.
+    """
+    if len(chars) > 256:
+        raise ValueError("uint8 encoding supports at most 256 characters")
+    if not isinstance(text, type(u"")):
+        text = text.decode("utf-8")
+    if not isinstance(chars, type(u"")):
+        chars = chars.decode("utf-8")
+    codepoints = np.frombuffer(text.encode("utf-32-le"), dtype="<u4")
+    char_codepoints = np.frombuffer(chars.encode("utf-32-le"), dtype="<u4")
+    lut_size = max(int(char_codepoints.max()),
+                   int(codepoints.max()) if len(codepoints) > 0 else 0) + 1
+    # 256 marks characters without a class
+    lut = 256 * np.ones((lut_size,), dtype="int32")
+    lut[char_codepoints] = np.arange(len(chars))
+    encoded = lut[codepoints]
+    unknown = encoded == 256
+    if np.any(unknown):
+        missing = sorted(set(np.unique(codepoints[unknown]).tolist()))
+        raise ValueError("Characters not in the vocabulary: %s" % repr(
+            u"".join([_unichr(c) for c in missing])))
+    return encoded.astype("uint8")
+
+
+class _truncated_stream_iterator(object):
+    """
+    Shared truncated BPTT logic over an encoded index array
+
+    The corpus is split into minibatch_size contiguous streams, each
+    sequence_length long, stored as a 2D view of the encoded array.
+    Minibatches are (truncation_length, minibatch_size) float32 windows
+    taken from that view, and reset only rewinds slice_start_.
+    """
+    def _init_streams(self, encoded, iterator_length=None):
         if iterator_length is None:
-            logger.info("No iterator_length provided for truncation mode.")
-            logger.info("Calculating...")
-            l = 0
-            for s in sentence_iterator:
-                l += len(s)
-            self.iterator_length = l
-
-        self.iterator_length -= self.iterator_length % (minibatch_size * truncation_length)
-        self.sequence_length = self.iterator_length // minibatch_size
-
-        def rg():
-            minibatch_gens = []
-            sl = self.sequence_length
-            def r(): return (i for s in sentence_iterator for i in self._process(s))
-            for i in range(minibatch_size):
-                self.flat_gen = r()
-                minibatch_gens.append(itertools.islice(self.flat_gen, i * sl, (i + 1) * sl))
-            self.flat_gen = r()
-            self.minibatch_gens = minibatch_gens
-        rg()
-        self.reset_gens = rg
+            iterator_length = len(encoded)
+        self.iterator_length = min(iterator_length, len(encoded))
+        step = self.minibatch_size * self.truncation_length
+        self.iterator_length -= self.iterator_length % step
+        self.sequence_length = self.iterator_length // self.minibatch_size
+        self.encoded = encoded
+        # stream i starts at i * sequence_length in the flat corpus
+        self.streams = encoded[:self.iterator_length].reshape(
+            self.minibatch_size, self.sequence_length)
 
     def reset(self):
-        #self.slice_start_ = self.start_index
-        self.reset_gens()
+        self.slice_start_ = self.start_index
 
     def __iter__(self):
         return self
@@ -220,18 +1170,14 @@ class character_sequence_iterator(object):
     def next(self):
         return self.__next__()
 
-    def _t(self, el):
-        return self.char_to_class[el]
-
     def __next__(self):
-        try:
-            arr  = [[self._t(next(self.minibatch_gens[i]))
-                    for n in range(self.truncation_length)]
-                    for i in range(self.minibatch_size)]
-            return np.asarray(arr).T.astype("float32")
-        except StopIteration:
+        slice_end = self.slice_start_ + self.truncation_length
+        if slice_end > self.sequence_length:
             self.reset()
             raise StopIteration("Stop index reached")
+        window = self.streams[:, self.slice_start_:slice_end]
+        self.slice_start_ = slice_end
+        return window.T.astype("float32")
 
     def transform(self, list_of_strings):
         """
@@ -247,11 +1193,70 @@ class character_sequence_iterator(object):
         """
         index_array should be 2D, shape (n_steps, minibatch_index)
         """
-        return [[self.class_to_char[int(ai)]
+        return [[self._class_lookup[int(ai)]
                  for ai in index_array[:, i]]
                  for i in range(index_array.shape[1])]
 
 
+class character_sequence_iterator(_truncated_stream_iterator):
+    """
+    Truncated BPTT windows over minibatch_size contiguous character streams
+
+    The corpus is encoded once to a uint8 array. If cache_path is given the
+    array is loaded from (with mmap_mode="r") or saved to that .npy file,
+    .npy is appended if missing; delete the cache if the corpus changes.
+    """
+    def __init__(self, sentence_iterator, minibatch_size,
+                 truncation_length,
+                 iterator_length=None,
+                 start_index=0,
+                 stop_index=np.inf,
+                 valid_items=None,
+                 stop_items=None,
+                 extra_preproc_options=None,
+                 cache_path=None):
+        self.sentence_iterator = sentence_iterator
+        self.minibatch_size = minibatch_size
+        self.truncation_length = truncation_length
+        self.start_index = start_index
+        self.stop_index = stop_index
+        if start_index != 0 or stop_index != np.inf:
+            raise AttributeError("start_index and stop_index not yet "
+                                 "supported")
+        self.slice_start_ = start_index
+        self.extra_preproc_options = extra_preproc_options
+        if self.extra_preproc_options is not None:
+            raise AttributeError("Extra preproc options not yet supported")
+        self.n_classes = len(all_chars)
+        rlu = {k: v for k, v in enumerate(all_chars)}
+        lu = {v: k for k, v in rlu.items()}
+        self.char_to_class = lu
+        self.class_to_char = rlu
+        self._class_lookup = rlu
+
+        def process(s):
+            return [si for si in s]
+
+        self._process = process
+        # np.save adds the extension if it is missing
+        if cache_path is not None and not cache_path.endswith(".npy"):
+            cache_path = cache_path + ".npy"
+        if cache_path is not None and os.path.exists(cache_path):
+            logger.info("Loading encoded corpus from %s" % cache_path)
+            encoded = np.load(cache_path, mmap_mode="r")
+        else:
+            logger.info("Encoding corpus...")
+            encoded = encode_characters(
+                "".join([s for s in sentence_iterator]))
+            if cache_path is not None:
+                logger.info("Saving encoded corpus to %s" % cache_path)
+                np.save(cache_path, encoded)
+        self._init_streams(encoded, iterator_length)
+
+    def _t(self, el):
+        return self.char_to_class[el]
+
+
 """
 # based on http://alexbowe.com/au-naturale/
 # Word Tokenization Regex adapted from NLTK book
@@ -273,7 +1278,59 @@ compiled_sentence_re = re.compile(sentence_re)
 """
 compiled_process_re = re.compile('[^A-Za-z ]+')
 
-class word_sequence_iterator(object):
+
+def _tokenize_default(s, eos):
+    s = s.lower()
+    toks = re.sub(compiled_process_re, "", s).split(" ")
+    # why is this infinity times slower
+    # toks = nltk.regexp_tokenize(s, compiled_sentence_re)
+    toks += [eos]
+    return toks
+
+
+def _tokenize_chunk(args):
+    """
+    Tokenize a list of sentences to chunk-local first-seen ids
+
+    Returns the local word list (in first-seen order), their counts and the
+    int32 local ids of every token. Module level so it can run in a Pool.
+    """
+    sentences, eos = args
+    first_seen = {}
+    ids = []
+    for s in sentences:
+        ids.extend([first_seen.setdefault(t, len(first_seen))
+                    for t in _tokenize_default(s, eos)])
+    ids = np.array(ids, dtype="int32")
+    local_words = sorted(first_seen, key=first_seen.get)
+    counts = np.bincount(ids, minlength=len(local_words))
+    return local_words, counts, ids
+
+
+def _chunk_sentences(sentence_iterator, chunk_size, eos):
+    chunk = []
+    for s in sentence_iterator:
+        chunk.append(s)
+        if len(chunk) == chunk_size:
+            yield chunk, eos
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk, eos
+
+
+def _hash_corpus(sentence_iterator, settings):
+    h = hashlib.md5()
+    h.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    for s in sentence_iterator:
+        if isinstance(s, type(u"")):
+            s = s.encode("utf-8")
+        h.update(s)
+        # separator so sentence boundaries change the hash
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+class word_sequence_iterator(_truncated_stream_iterator):
     def __init__(self, sentence_iterator, minibatch_size,
                  truncation_length,
                  iterator_length=None,
@@ -281,9 +1338,26 @@ class word_sequence_iterator(object):
                  stop_index=np.inf,
                  vocabulary=None,
                  max_vocabulary_size=5000,
-                 tokenizer="default"):
+                 tokenizer="default",
+                 n_jobs=1,
+                 chunk_size=10000,
+                 cache_dir=None):
         """
         'default' is lowercase
+
+        The corpus is tokenized once, to provisional first-seen ids which
+        give both the word counts and, after remapping through the final
+        vocabulary, the int32 encoded corpus. With n_jobs > 1 (-1 for all
+        cores) chunks of chunk_size sentences are tokenized in a process
+        pool and merged in corpus order.
+
+        vocabulary fixes the word list, for example to reuse the
+        vocabulary of a training iterator; "<UNK>" is appended if missing.
+
+        If cache_dir is given, the encoded corpus and vocabulary are stored
+        there under an md5 of the sentences and these settings, so a
+        second run only hashes the corpus and memory maps the indices.
+        The sentence_iterator must then be iterable more than once.
         """
         self.sentence_iterator = sentence_iterator
         self.minibatch_size = minibatch_size
@@ -291,7 +1365,8 @@ class word_sequence_iterator(object):
         self.start_index = start_index
         self.stop_index = stop_index
         if start_index != 0 or stop_index != np.inf:
-            raise AttributeError("start_index and stop_index not yet supported")
+            raise AttributeError("start_index and stop_index not yet "
+                                 "supported")
         self.slice_start_ = start_index
         self.tokenizer = tokenizer
         if tokenizer != "default":
@@ -302,95 +1377,88 @@ class word_sequence_iterator(object):
         self._sos = "<START>"
         self._eos = "<EOS>"
         def process(s):
-            s = s.lower()
-            toks = re.sub(compiled_process_re, "", s).split(" ")
-            # why is this infinity times slower
-            #toks = nltk.regexp_tokenize(s, compiled_sentence_re)
-            toks += [self._eos]
-            return toks
+            return _tokenize_default(s, self._eos)
         self._process = process
+        self.max_vocabulary_size = max_vocabulary_size
+
+        cache_base = None
+        if cache_dir is not None:
+            settings = {"tokenizer": tokenizer,
+                        "max_vocabulary_size": max_vocabulary_size,
+                        "vocabulary": vocabulary,
+                        "eos": self._eos, "unk": self._unk}
+            key = _hash_corpus(sentence_iterator, settings)
+            cache_base = os.path.join(cache_dir, "word_corpus_%s" % key)
+            if os.path.exists(cache_base + ".json"):
+                logger.info("Loading encoded corpus from %s" % cache_base)
+                with open(cache_base + ".json", "r") as f:
+                    meta = json.load(f)
+                words = Counter()
+                for w, ct in meta["counts"]:
+                    words[w] = ct
+                self.words_counter = words
+                self._set_vocabulary(meta["vocabulary"])
+                encoded = np.load(cache_base + ".npy", mmap_mode="r")
+                self._init_streams(encoded, iterator_length)
+                return
 
-        calculated_iterator_length = 0
+        logger.info("Tokenizing corpus...")
+        chunks = _chunk_sentences(sentence_iterator, chunk_size, self._eos)
+        if n_jobs == -1:
+            n_jobs = multiprocessing.cpu_count()
+        pool = None
+        if n_jobs > 1:
+            pool = multiprocessing.Pool(n_jobs)
+            results = pool.imap(_tokenize_chunk, chunks)
+        else:
+            results = (_tokenize_chunk(c) for c in chunks)
+        # merge chunks in corpus order, so global first-seen order (and
+        # most_common tie breaking) matches a serial Counter.update
         words = Counter()
-        if vocabulary is None:
-            logger.info("No vocabulary provided for truncation mode.")
-            logger.info("Calculating...")
-            sg = (s for s in sentence_iterator)
-            for n, s in enumerate(sg):
-                toks = self._process(s)
-                words.update(toks)
-                calculated_iterator_length += len(toks)
-                if n % 1000 == 0:
-                    logger.info("Processed %s sentences so far" % n)
-        elif vocabulary is not None:
-            raise ValueError("TODO: Support fixed vocabulary!")
-
-        self.iterator_length = calculated_iterator_length
+        provisional = []
+        try:
+            for n, (local_words, counts, ids) in enumerate(results):
+                for w, ct in zip(local_words, counts):
+                    words[w] += int(ct)
+                provisional.append((local_words, ids))
+                logger.info("Processed %s chunks of %s sentences so far" % (
+                    n + 1, chunk_size))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
         self.words_counter = words
 
-        self.max_vocabulary_size = max_vocabulary_size
+        if vocabulary is None:
+            v = sorted([w[0] for w in words.most_common(
+                max_vocabulary_size - 1)]) + [self._unk]
+        else:
+            v = list(vocabulary)
+            if self._unk not in v:
+                v.append(self._unk)
+        self._set_vocabulary(v)
+
+        encoded = np.concatenate(
+            [np.zeros((0,), dtype="int32")] +
+            [np.array([self._t(w) for w in local_words], dtype="int32")[ids]
+             for local_words, ids in provisional])
+        if cache_base is not None:
+            logger.info("Saving encoded corpus to %s" % cache_base)
+            np.save(cache_base + ".npy", encoded)
+            # the .json is written last and marks a complete cache entry
+            with open(cache_base + ".json", "w") as f:
+                json.dump({"vocabulary": self.vocabulary,
+                           "counts": list(words.items())}, f)
+        self._init_streams(encoded, iterator_length)
 
-        v = sorted([w[0] for w in words.most_common(max_vocabulary_size - 1)]) + [self._unk]
+    def _set_vocabulary(self, v):
         rlu = {k: v for k, v in enumerate(v)}
         lu = {v: k for k, v in rlu.items()}
         self.word_to_class = lu
         self.class_to_word = rlu
+        self._class_lookup = rlu
         self.vocabulary = v
         self.n_classes = len(v)
 
-        self.iterator_length -= self.iterator_length % (minibatch_size * truncation_length)
-        self.sequence_length = self.iterator_length // minibatch_size
-
-        def rg():
-            minibatch_gens = []
-            sl = self.sequence_length
-            def r(): return (i for s in sentence_iterator for i in self._process(s))
-            for i in range(minibatch_size):
-                self.flat_gen = r()
-                minibatch_gens.append(itertools.islice(self.flat_gen, i * sl, (i + 1) * sl))
-            self.flat_gen = r()
-            self.minibatch_gens = minibatch_gens
-        rg()
-        self.reset_gens = rg
-
-    def reset(self):
-        #self.slice_start_ = self.start_index
-        self.reset_gens()
-
-    def __iter__(self):
-        return self
-
-    def next(self):
-        return self.__next__()
-
     def _t(self, el):
         return self.word_to_class.get(el, self.word_to_class[self._unk])
-
-    def __next__(self):
-        try:
-            out = []
-            for i in range(self.minibatch_size):
-                a = [self._t(next(self.minibatch_gens[i])) for n in range(self.truncation_length)]
-                out.append(a)
-            return np.asarray(out).T.astype("float32")
-        except StopIteration:
-            self.reset()
-            raise StopIteration("Stop index reached")
-
-    def transform(self, list_of_strings):
-        """
-        list_of strings should be, well, a list of strings
-        """
-        arr = [self._t(si) for s in list_of_strings for si in self._process(s)]
-        arr = np.asarray(arr)
-        if len(arr.shape) == 1:
-            arr = arr[None, :]
-        return arr.T.astype("float32")
-
-    def inverse_transform(self, index_array):
-        """
-        index_array should be 2D, shape (n_steps, minibatch_index)
-        """
-        return [[self.class_to_word[int(ai)]
-                 for ai in index_array[:, i]]
-                 for i in range(index_array.shape[1])]
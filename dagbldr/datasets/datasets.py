@@ -5,10 +5,12 @@
 import numpy as np
 from collections import Counter
 from scipy.io import loadmat, wavfile
-from scipy.linalg import svd
 from functools import reduce
-from ..core import whitespace_tokenizer, safe_zip, get_logger
+from ..core import whitespace_tokenizer, get_logger
 from .preprocessing_utils import stft
+from .preprocessing_utils import randomized_pca, incremental_pca
+from .cache_utils import cached_arrays
+from .dataset_utils import packed_binary_array
 import shutil
 import string
 import tarfile
@@ -16,6 +18,8 @@ import fnmatch
 import theano
 import zipfile
 import gzip
+import hashlib
+import multiprocessing
 import os
 import re
 import csv
@@ -419,11 +423,47 @@ def check_fetch_fruitspeech():
     return audio_path
 
 
-def fetch_fruitspeech():
+def _fruitspeech_features(wav_path):
+    # per file work for fetch_fruitspeech, module level for the Pool
+    # Convert chars to int classes
+    word = wav_path.split(os.sep)[-1][:-6]
+    chars = string_to_character_index(word).astype("int32")
+    fs, d = wavfile.read(wav_path)
+    d = d.astype("int32")
+    # Preprocessing from A. Graves "Towards End-to-End Speech
+    # Recognition"
+    Pxx = 10. * np.log10(np.abs(stft(d.astype("float64"),
+                                     fftsize=128))).astype(
+                                         theano.config.floatX)
+    return d, Pxx, chars, word
+
+
+def _to_flat(list_of_arrays):
+    # flat + offsets storage, sequence n is flat[offsets[n]:offsets[n + 1]]
+    offsets = np.zeros((len(list_of_arrays) + 1,), dtype="int64")
+    offsets[1:] = np.cumsum([len(a) for a in list_of_arrays])
+    return np.concatenate(list_of_arrays, axis=0), offsets
+
+
+def _from_flat(flat, offsets):
+    # object array of views into flat
+    ret = np.empty((len(offsets) - 1,), dtype=object)
+    for i in range(len(ret)):
+        ret[i] = flat[offsets[i]:offsets[i + 1]]
+    return ret
+
+
+def fetch_fruitspeech(n_jobs=None):
     """ Check for fruitspeech data
 
     Recorded by Hakon Sandsmark
 
+    Parameters
+    ----------
+    n_jobs : int or None, default None
+        Processes used to extract features the first time, all cores if
+        None
+
     Returns
     -------
     summary : dict
@@ -452,69 +492,76 @@ def fetch_fruitspeech():
 
         summary["vocabulary"] : string
             The whole vocabulary as a string
-    """
 
-    data_path = check_fetch_fruitspeech()
-    audio_matches = []
-    for root, dirnames, filenames in os.walk(data_path):
-        for filename in fnmatch.filter(filenames, '*.wav'):
-            audio_matches.append(os.path.join(root, filename))
-    all_chars = []
-    all_words = []
-    all_data = []
-    all_specgram_data = []
-    for wav_path in audio_matches:
-        # Convert chars to int classes
-        word = wav_path.split(os.sep)[-1][:-6]
-        chars = string_to_character_index(word)
-        fs, d = wavfile.read(wav_path)
-        d = d.astype("int32")
-        # Preprocessing from A. Graves "Towards End-to-End Speech
-        # Recognition"
-        Pxx = 10. * np.log10(np.abs(stft(d, fftsize=128))).astype(
-            theano.config.floatX)
-        all_data.append(d)
-        all_specgram_data.append(Pxx)
-        all_chars.append(chars)
-        all_words.append(word)
+    Features are extracted once, in a process pool, and cached as flat
+    arrays plus offsets. data, specgrams and target are object arrays of
+    views into the memory mapped cache.
+
+    The wav files are now read in sorted order rather than in os.walk
+    order, so the train / valid split is the same on every machine but
+    can differ from the split given by versions before the cache.
+    """
+    def build():
+        data_path = check_fetch_fruitspeech()
+        audio_matches = []
+        for root, dirnames, filenames in os.walk(data_path):
+            for filename in fnmatch.filter(filenames, '*.wav'):
+                audio_matches.append(os.path.join(root, filename))
+        # os.walk order depends on the filesystem
+        audio_matches = sorted(audio_matches)
+        if n_jobs == 1:
+            features = [_fruitspeech_features(p) for p in audio_matches]
+        else:
+            pool = multiprocessing.Pool(n_jobs)
+            try:
+                features = pool.map(_fruitspeech_features, audio_matches,
+                                    chunksize=8)
+            finally:
+                pool.close()
+                pool.join()
+        # Shuffle data
+        all_lists = list(features)
+        random_state = np.random.RandomState(1999)
+        random_state.shuffle(all_lists)
+        all_data, all_specgram_data, all_chars, all_words = zip(*all_lists)
+        wordset = sorted(set(all_words))
+        train_matches = []
+        valid_matches = []
+        for w in wordset:
+            matches = [n for n, i in enumerate(all_words) if i == w]
+            # Hold out ~25% of the data, keeping some of every class
+            train_matches.append(matches[:-4])
+            valid_matches.append(matches[-4:])
+        train_indices = sorted([r for i in train_matches for r in i])
+        valid_indices = sorted([r for i in valid_matches for r in i])
+        # reorganize into contiguous blocks
+        order = train_indices + valid_indices
+        arrays = {}
+        for name, list_ in [("data", all_data),
+                            ("specgrams", all_specgram_data),
+                            ("target", all_chars)]:
+            flat, offsets = _to_flat([list_[i] for i in order])
+            arrays[name + "_flat"] = flat
+            arrays[name + "_offsets"] = offsets
+        arrays["train_indices"] = np.arange(
+            len(train_indices)).astype("int32")
+        arrays["valid_indices"] = (np.arange(len(valid_indices)) + len(
+            train_indices)).astype("int32")
+        return arrays, {"target_names": [all_words[i] for i in order]}
+
+    cache_dir = os.path.join(get_dataset_dir("fruitspeech"), "cache")
+    # version 2: int32 indices
+    arrays, meta = cached_arrays(cache_dir, build,
+                                 version="2_%s" % theano.config.floatX)
     vocabulary_size = len(all_vocabulary_chars)
-    # Shuffle data
-    all_lists = list(safe_zip(all_data, all_specgram_data, all_chars,
-                              all_words))
-    random_state = np.random.RandomState(1999)
-    random_state.shuffle(all_lists)
-    all_data, all_specgram_data, all_chars, all_words = zip(*all_lists)
-    wordset = list(set(all_words))
-    train_matches = []
-    valid_matches = []
-    for w in wordset:
-        matches = [n for n, i in enumerate(all_words) if i == w]
-        # Hold out ~25% of the data, keeping some of every class
-        train_matches.append(matches[:-4])
-        valid_matches.append(matches[-4:])
-    train_indices = np.array(sorted(
-        [r for i in train_matches for r in i])).astype("int32")
-    valid_indices = np.array(sorted(
-        [r for i in valid_matches for r in i])).astype("int32")
-
-    # reorganize into contiguous blocks
-    def reorg(list_):
-        ret = [list_[i] for i in train_indices] + [
-            list_[i] for i in valid_indices]
-        return np.asarray(ret)
-    all_data = reorg(all_data)
-    all_specgram_data = reorg(all_specgram_data)
-    all_chars = reorg(all_chars)
-    all_words = reorg(all_words)
-    # after reorganizing finalize indices
-    train_indices = np.arange(len(train_indices))
-    valid_indices = np.arange(len(valid_indices)) + len(train_indices)
-    return {"data": all_data,
-            "specgrams": all_specgram_data,
-            "target": all_chars,
-            "target_names": all_words,
-            "train_indices": train_indices,
-            "valid_indices": valid_indices,
+    return {"data": _from_flat(arrays["data_flat"], arrays["data_offsets"]),
+            "specgrams": _from_flat(arrays["specgrams_flat"],
+                                    arrays["specgrams_offsets"]),
+            "target": _from_flat(arrays["target_flat"],
+                                 arrays["target_offsets"]),
+            "target_names": np.asarray(meta["target_names"]),
+            "train_indices": arrays["train_indices"],
+            "valid_indices": arrays["valid_indices"],
             "vocabulary_size": vocabulary_size,
             "vocabulary": all_vocabulary_chars}
 
@@ -615,51 +662,106 @@ def check_fetch_fer():
     return full_path
 
 
-def fetch_fer():
+def _parse_fer_csv(raw):
+    # fer2013.csv is "emotion,pixels,Usage" with space separated pixels
+    lines = raw.decode("utf-8").strip().split("\n")[1:]
+    fields = [line.split(",") for line in lines]
+    target = np.array([int(f[0]) for f in fields], dtype="int32")
+    pixels = np.fromstring(" ".join([f[1].strip("\"") for f in fields]),
+                           dtype="int32", sep=" ")
+    return pixels.reshape(len(fields), 48 * 48).astype(np.uint8), target
+
+
+class _scaled_rows(object):
+    # rows of arr divided by scale as they are read, for chunked PCA
+    def __init__(self, arr, scale):
+        self.arr = arr
+        self.scale = scale
+        self.shape = arr.shape
+
+    def __getitem__(self, key):
+        return self.arr[key] / np.float32(self.scale)
+
+
+def _cached_pca(saved_pca_path, train_data, mean, n_components):
+    # full PCA by covariance accumulation, top k by randomized PCA
+    if not os.path.exists(saved_pca_path):
+        logger.info("Saved PCA not found at %s, computing..." %
+                    saved_pca_path)
+        if n_components is None:
+            train_pca, _ = incremental_pca(train_data, mean=mean)
+        else:
+            train_pca, _ = randomized_pca(train_data, n_components,
+                                          mean=mean)
+        train_pca = train_pca.astype("float32")
+        np.save(saved_pca_path, train_pca)
+    else:
+        train_pca = np.load(saved_pca_path)
+    return train_pca
+
+
+def fetch_fer(as_float=True, n_components=None):
     """
     Flattened 48x48 fer faces with pixel values in [0 - 1]
 
-    n_samples : 35888
+    n_samples : 35887
     n_features : 2304
 
+    Parameters
+    ----------
+    as_float : bool, default True
+        If True, summary["data"] is scaled to [0 - 1] float32. Otherwise
+        it is the cached uint8 pixels, also in summary["pixels"]
+
+    n_components : int or None, default None
+        Rows of summary["pca_matrix"], all 2304 if None. Each setting is
+        computed once and cached
+
     Returns
     -------
     summary : dict
         A dictionary cantaining data and image statistics.
 
-        summary["data"] : array, shape (35888, 2304)
+        summary["data"] : array, shape (35887, 2304)
             The flattened data for FER
 
+    The csv is parsed once and cached as uint8. The saved PCA is keyed
+    to a hash of the cached pixels.
     """
-    data_path = check_fetch_fer()
-    t = tarfile.open(data_path, 'r')
-    f = t.extractfile(t.getnames()[0])
-    reader = csv.reader(f)
-    valid_indices = 2 * 3859
-    data = np.zeros((35888, 48 * 48), dtype="float32")
-    target = np.zeros((35888,), dtype="int32")
-    header = None
-    for n, row in enumerate(reader):
-        if n % 1000 == 0:
-            print("Reading sample %i" % n)
-        if n == 0:
-            header = row
-        else:
-            target[n] = int(row[0])
-            data[n] = np.array(map(float, row[1].split(" "))) / 255.
+    def build():
+        data_path = check_fetch_fer()
+        t = tarfile.open(data_path, 'r')
+        f = t.extractfile(t.getnames()[0])
+        logger.info("Parsing %s" % t.getnames()[0])
+        pixels, target = _parse_fer_csv(f.read())
+        t.close()
+        train_mean0 = pixels[:23709].mean(axis=0) / 255.
+        data_hash = hashlib.md5(pixels.tobytes()).hexdigest()
+        return ({"pixels": pixels,
+                 "target": target,
+                 "mean0": train_mean0.astype("float32")},
+                {"data_hash": data_hash})
+
+    cache_dir = os.path.join(get_dataset_dir("fer"), "cache")
+    arrays, meta = cached_arrays(cache_dir, build, version=1)
+    pixels = arrays["pixels"]
     train_indices = np.arange(23709)
-    valid_indices = np.arange(23709, len(data))
-    train_mean0 = data[train_indices].mean(axis=0)
-    saved_pca_path = os.path.join(get_dataset_dir("fer"), "FER_PCA.npy")
-    if not os.path.exists(saved_pca_path):
-        print("Saved PCA not found for FER, computing...")
-        U, S, V = svd(data[train_indices] - train_mean0, full_matrices=False)
-        train_pca = V
-        np.save(saved_pca_path, train_pca)
+    valid_indices = np.arange(23709, len(pixels))
+    train_mean0 = arrays["mean0"]
+    pca_name = "FER_PCA_%s" % meta["data_hash"][:12]
+    if n_components is not None:
+        pca_name += "_%i" % n_components
+    saved_pca_path = os.path.join(get_dataset_dir("fer"), pca_name + ".npy")
+    train_pca = _cached_pca(saved_pca_path,
+                            _scaled_rows(pixels[:len(train_indices)], 255.),
+                            train_mean0, n_components)
+    if as_float:
+        data = pixels / np.float32(255.)
     else:
-        train_pca = np.load(saved_pca_path)
+        data = pixels
     return {"data": data,
-            "target": target,
+            "pixels": pixels,
+            "target": arrays["target"],
             "train_indices": train_indices,
             "valid_indices": valid_indices,
             "mean0": train_mean0,
@@ -677,13 +779,19 @@ def check_fetch_tfd():
     return full_path
 
 
-def fetch_tfd():
+def fetch_tfd(n_components=None):
     """
     Flattened 48x48 TFD faces with pixel values in [0 - 1]
 
     n_samples : 102236
     n_features : 2304
 
+    Parameters
+    ----------
+    n_components : int or None, default None
+        Rows of summary["pca_matrix"], all 2304 if None. Each setting is
+        computed once and cached
+
     Returns
     -------
     summary : dict
@@ -704,15 +812,14 @@ def fetch_tfd():
     train_mean0 = train_data.mean(axis=0)
     random_state = np.random.RandomState(1999)
     subset_indices = random_state.choice(train_indices, 25000, replace=False)
-    saved_pca_path = os.path.join(get_dataset_dir("tfd"), "TFD_PCA.npy")
-    if not os.path.exists(saved_pca_path):
-        print("Saved PCA not found for TFD, computing...")
-        U, S, V = svd(train_data[subset_indices] - train_mean0,
-                      full_matrices=False)
-        train_pca = V
-        np.save(saved_pca_path, train_pca)
+    if n_components is None:
+        pca_name = "TFD_PCA.npy"
     else:
-        train_pca = np.load(saved_pca_path)
+        pca_name = "TFD_PCA_%i.npy" % n_components
+    saved_pca_path = os.path.join(get_dataset_dir("tfd"), pca_name)
+    train_pca = _cached_pca(saved_pca_path,
+                            train_data[np.sort(subset_indices)],
+                            train_mean0, n_components)
     return {"data": all_data,
             "train_indices": train_indices,
             "valid_indices": valid_indices,
@@ -789,27 +896,40 @@ def fetch_mnist():
         summary["valid_indices"] : array, shape (10000,)
         summary["test_indices"] : array, shape (10000,)
 
+    The arrays are converted once and cached as .npy files next to the
+    download. Later calls return read-only memory maps.
     """
-    data_path = check_fetch_mnist()
-    f = gzip.open(data_path, 'rb')
-    try:
-        train_set, valid_set, test_set = pickle.load(f, encoding="latin1")
-    except TypeError:
-        train_set, valid_set, test_set = pickle.load(f)
-    f.close()
-    train_indices = np.arange(0, len(train_set[0]))
-    valid_indices = np.arange(0, len(valid_set[0])) + train_indices[-1] + 1
-    test_indices = np.arange(0, len(test_set[0])) + valid_indices[-1] + 1
-    data = np.concatenate((train_set[0], valid_set[0], test_set[0]),
-                          axis=0).astype(theano.config.floatX)
-    target = np.concatenate((train_set[1], valid_set[1], test_set[1]),
-                            axis=0).astype(np.int32)
+    def build():
+        data_path = check_fetch_mnist()
+        f = gzip.open(data_path, 'rb')
+        try:
+            train_set, valid_set, test_set = pickle.load(f, encoding="latin1")
+        except TypeError:
+            train_set, valid_set, test_set = pickle.load(f)
+        f.close()
+        train_indices = np.arange(0, len(train_set[0]))
+        valid_indices = np.arange(0, len(valid_set[0])) + train_indices[-1] + 1
+        test_indices = np.arange(0, len(test_set[0])) + valid_indices[-1] + 1
+        data = np.concatenate((train_set[0], valid_set[0], test_set[0]),
+                              axis=0).astype(theano.config.floatX)
+        target = np.concatenate((train_set[1], valid_set[1], test_set[1]),
+                                axis=0).astype(np.int32)
+        return {"data": data,
+                "target": target,
+                "train_indices": train_indices.astype(np.int32),
+                "valid_indices": valid_indices.astype(np.int32),
+                "test_indices": test_indices.astype(np.int32)}
+
+    cache_dir = os.path.join(get_dataset_dir("mnist"), "cache")
+    arrays, _ = cached_arrays(cache_dir, build,
+                              version="1_%s" % theano.config.floatX)
+    data = arrays["data"]
     return {"data": data,
-            "target": target,
+            "target": arrays["target"],
             "images": data.reshape((len(data), 1, 28, 28)),
-            "train_indices": train_indices.astype(np.int32),
-            "valid_indices": valid_indices.astype(np.int32),
-            "test_indices": test_indices.astype(np.int32)}
+            "train_indices": arrays["train_indices"],
+            "valid_indices": arrays["valid_indices"],
+            "test_indices": arrays["test_indices"]}
 
 
 def check_fetch_binarized_mnist():
@@ -838,7 +958,7 @@ def check_fetch_binarized_mnist():
     """
 
 
-def fetch_binarized_mnist():
+def fetch_binarized_mnist(packed=False):
     """
     Flattened 28x28 mnist digits with pixel of either 0 or 1, sampled from
     binomial distribution defined by the original MNIST values
@@ -846,6 +966,13 @@ def fetch_binarized_mnist():
     n_samples : 70000
     n_features : 784
 
+    Parameters
+    ----------
+    packed : bool, default False
+        If True, summary["data"] is a packed_binary_array, which keeps the
+        bit-packed samples in memory and unpacks only the rows of each
+        minibatch. Otherwise it is an unpacked floatX array.
+
     Returns
     -------
     summary : dict
@@ -857,20 +984,35 @@ def fetch_binarized_mnist():
         summary["valid_indices"] : array, shape (10000,)
         summary["test_indices"] : array, shape (10000,)
 
+    The sample is drawn once, with a fixed seed, and cached with
+    np.packbits.
     """
-    mnist = fetch_mnist()
-    random_state = np.random.RandomState(1999)
-
-    def get_sampled(arr):
-        # make sure that a pixel can always be turned off
-        return random_state.binomial(1, arr * 255 / 256., size=arr.shape)
-
-    data = get_sampled(mnist["data"]).astype(theano.config.floatX)
+    def build():
+        mnist = fetch_mnist()
+        random_state = np.random.RandomState(1999)
+
+        def get_sampled(arr):
+            # make sure that a pixel can always be turned off
+            return random_state.binomial(1, arr * 255 / 256., size=arr.shape)
+
+        data = get_sampled(np.asarray(mnist["data"])).astype(np.uint8)
+        return {"packed_data": np.packbits(data, axis=1),
+                "target": mnist["target"],
+                "train_indices": mnist["train_indices"],
+                "valid_indices": mnist["valid_indices"],
+                "test_indices": mnist["test_indices"]}
+
+    cache_dir = os.path.join(get_dataset_dir("binarized_mnist"), "cache")
+    arrays, _ = cached_arrays(cache_dir, build, version=1)
+    data = packed_binary_array(arrays["packed_data"], 784,
+                               dtype=theano.config.floatX)
+    if not packed:
+        data = data.unpack()
     return {"data": data,
-            "target": mnist["target"],
-            "train_indices": mnist["train_indices"],
-            "valid_indices": mnist["valid_indices"],
-            "test_indices": mnist["test_indices"]}
+            "target": arrays["target"],
+            "train_indices": arrays["train_indices"],
+            "valid_indices": arrays["valid_indices"],
+            "test_indices": arrays["test_indices"]}
 
 
 def make_sincos(n_timesteps, n_pairs):
@@ -770,6 +770,147 @@ def lsf_to_lpc(all_lsf):
     return np.squeeze(all_lpc)
 
 
+def _chunked_centered_dot(X, mean, M, chunk_size):
+    # (X - mean) M, reading X in chunks of rows
+    out = np.zeros((X.shape[0], M.shape[1]))
+    mean_M = np.dot(mean, M)
+    for i in range(0, X.shape[0], chunk_size):
+        out[i:i + chunk_size] = np.dot(
+            np.asarray(X[i:i + chunk_size], dtype="float64"), M) - mean_M
+    return out
+
+
+def _chunked_centered_tdot(X, mean, Q, chunk_size):
+    # (X - mean).T Q, reading X in chunks of rows
+    out = -np.outer(mean, Q.sum(axis=0))
+    for i in range(0, X.shape[0], chunk_size):
+        out += np.dot(np.asarray(X[i:i + chunk_size], dtype="float64").T,
+                      Q[i:i + chunk_size])
+    return out
+
+
+def _chunked_mean(X, chunk_size):
+    total = np.zeros((X.shape[1],))
+    for i in range(0, X.shape[0], chunk_size):
+        total += np.asarray(X[i:i + chunk_size], dtype="float64").sum(axis=0)
+    return total / X.shape[0]
+
+
+def _flip_signs(components):
+    # largest absolute loading of each component positive, for determinism
+    rows = np.arange(len(components))
+    signs = np.sign(components[rows, np.argmax(np.abs(components), axis=1)])
+    signs[signs == 0] = 1
+    return components * signs[:, None]
+
+
+def randomized_pca(X, n_components, n_oversamples=10, n_iter=4, mean=None,
+                   chunk_size=4096, random_state=None):
+    """
+    Top principal components with a randomized range finder
+
+    Parameters
+    ----------
+    X : ndarray or memmap, shape=(n_samples, n_features)
+        Input data, read chunk_size rows at a time
+
+    n_components : int
+        Number of components to compute
+
+    n_oversamples : int, optional (default=10)
+        Extra random directions, improves accuracy
+
+    n_iter : int, optional (default=4)
+        Power iterations, improves accuracy when the spectrum decays slowly
+
+    mean : ndarray, shape=(n_features,), optional (default=None)
+        Mean to center with, computed from X if None
+
+    chunk_size : int, optional (default=4096)
+        Rows of X read at a time
+
+    random_state : RandomState or None, optional (default=None)
+        Defaults to RandomState(1999)
+
+    Returns
+    -------
+    components : ndarray, shape=(n_components, n_features)
+        Principal axes, as the rows of V from svd(X - mean)
+
+    explained_variance : ndarray, shape=(n_components,)
+
+    Reference
+    ---------
+    Halko, Martinsson, Tropp, "Finding structure with randomness", 2009
+    """
+    if random_state is None:
+        random_state = np.random.RandomState(1999)
+    if mean is None:
+        mean = _chunked_mean(X, chunk_size)
+    mean = np.asarray(mean, dtype="float64")
+    n_random = min(n_components + n_oversamples, min(X.shape))
+    omega = random_state.randn(X.shape[1], n_random)
+    Q, _ = linalg.qr(_chunked_centered_dot(X, mean, omega, chunk_size),
+                     mode="economic")
+    for i in range(n_iter):
+        Z, _ = linalg.qr(_chunked_centered_tdot(X, mean, Q, chunk_size),
+                         mode="economic")
+        Q, _ = linalg.qr(_chunked_centered_dot(X, mean, Z, chunk_size),
+                         mode="economic")
+    # B = Q.T (X - mean) is small, (n_random, n_features)
+    B = _chunked_centered_tdot(X, mean, Q, chunk_size).T
+    _, S, V = linalg.svd(B, full_matrices=False)
+    components = _flip_signs(V[:n_components])
+    explained_variance = S[:n_components] ** 2 / (X.shape[0] - 1)
+    return components, explained_variance
+
+
+def incremental_pca(X, n_components=None, mean=None, chunk_size=4096):
+    """
+    Principal components by accumulating the covariance over chunks of rows
+
+    Exact, with memory bounded by chunk_size rows plus an
+    (n_features, n_features) covariance, so X can be a memmap larger than
+    memory.
+
+    Parameters
+    ----------
+    X : ndarray or memmap, shape=(n_samples, n_features)
+        Input data, read chunk_size rows at a time
+
+    n_components : int or None, optional (default=None)
+        Number of components to keep, all if None
+
+    mean : ndarray, shape=(n_features,), optional (default=None)
+        Mean to center with, computed from X if None
+
+    chunk_size : int, optional (default=4096)
+        Rows of X read at a time
+
+    Returns
+    -------
+    components : ndarray, shape=(n_components, n_features)
+        Principal axes, as the rows of V from svd(X - mean)
+
+    explained_variance : ndarray, shape=(n_components,)
+    """
+    if mean is None:
+        mean = _chunked_mean(X, chunk_size)
+    mean = np.asarray(mean, dtype="float64")
+    n_features = X.shape[1]
+    if n_components is None:
+        n_components = n_features
+    cov = np.zeros((n_features, n_features))
+    for i in range(0, X.shape[0], chunk_size):
+        chunk = np.asarray(X[i:i + chunk_size], dtype="float64") - mean
+        cov += np.dot(chunk.T, chunk)
+    cov /= (X.shape[0] - 1)
+    evals, evecs = linalg.eigh(cov)
+    order = np.argsort(evals)[::-1][:n_components]
+    components = _flip_signs(evecs[:, order].T)
+    return components, np.maximum(evals[order], 0.)
+
+
 def test_lpc_to_lsf():
     # Matlab style vectors for testing
     # lsf = [0.7842 1.5605 1.8776 1.8984 2.3593]
@@ -821,7 +962,21 @@ def test_feature_build():
         features[i, start_indices[i]:end_indices[i]] = combined[i]
 
 
+def test_pca():
+    random_state = np.random.RandomState(1999)
+    X = np.dot(random_state.randn(200, 5), random_state.randn(5, 30))
+    X += .01 * random_state.randn(200, 30)
+    mean = X.mean(axis=0)
+    _, S, V = linalg.svd(X - mean, full_matrices=False)
+    V = _flip_signs(V)
+    for pca in [randomized_pca, incremental_pca]:
+        components, explained_variance = pca(X, 3, chunk_size=64)
+        assert_almost_equal(components, V[:3], decimal=4)
+        assert_almost_equal(explained_variance, S[:3] ** 2 / 199., decimal=4)
+
+
 def test_all():
+    test_pca()
     test_lpc_analysis_truncate()
     test_feature_build()
     test_lpc_to_lsf()
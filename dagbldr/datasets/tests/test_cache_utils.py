@@ -0,0 +1,29 @@
+from dagbldr.datasets.cache_utils import cached_arrays
+from dagbldr.datasets.cache_utils import load_cached_arrays
+import numpy as np
+import shutil
+import tempfile
+
+
+def test_cached_arrays():
+    tmp_dir = tempfile.mkdtemp()
+    calls = []
+
+    def build():
+        calls.append(1)
+        return {"X": np.arange(12).reshape(3, 4).astype("float32"),
+                "y": np.arange(3).astype("int32")}, {"n_classes": 3}
+    try:
+        assert load_cached_arrays(tmp_dir, version=1) == (None, None)
+        for i in range(2):
+            arrays, meta = cached_arrays(tmp_dir, build, version=1)
+            assert isinstance(arrays["X"], np.memmap)
+            assert np.all(arrays["X"][2] == np.arange(8, 12))
+            assert arrays["y"].dtype == np.int32
+            assert meta["n_classes"] == 3
+        assert len(calls) == 1
+        # a new version builds again
+        cached_arrays(tmp_dir, build, version=2)
+        assert len(calls) == 2
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -1,5 +1,17 @@
 from dagbldr.datasets.dataset_utils import character_sequence_iterator
 from dagbldr.datasets.dataset_utils import word_sequence_iterator
+from dagbldr.datasets.dataset_utils import minibatch_iterator
+from dagbldr.datasets.dataset_utils import list_iterator
+from dagbldr.datasets.dataset_utils import prefetch_iterator
+from dagbldr.datasets.dataset_utils import chunked_readahead
+from dagbldr.datasets.dataset_utils import packed_list_iterator
+from dagbldr.datasets.dataset_utils import packed_binary_array
+import numpy as np
+import theano
+from theano import tensor
+import os
+import shutil
+import tempfile
 
 sample_sentences = ["The end of the world was nigh",
                     "My hands feel just like two balloons",
@@ -14,6 +26,26 @@ def test_character_sequence_iterator():
     assert neg[0] == list("harsh times")
 
 
+def test_character_sequence_iterator_streams():
+    sentences = sample_sentences * 5
+    corpus = "".join(sentences)
+    itr = character_sequence_iterator(sentences, 2, 5)
+    sl = itr.sequence_length
+    for i in range(2):
+        r = [mb for mb in itr]
+        assert len(r) == sl // 5
+        for n, mb in enumerate(r):
+            assert mb.dtype == np.float32
+            ir = itr.inverse_transform(mb)
+            for j in range(2):
+                start = j * sl + n * 5
+                assert "".join(ir[j]) == corpus[start:start + 5]
+    assert itr.encoded.dtype == np.uint8
+    itr = character_sequence_iterator(sentences, 2, 5, iterator_length=50)
+    assert itr.iterator_length == 50
+    assert len([mb for mb in itr]) == 5
+
+
 def test_word_sequence_iterator():
     itr = word_sequence_iterator(sample_sentences, 1, 10)
     r = itr.next()
@@ -22,3 +54,222 @@ def test_word_sequence_iterator():
     # Test unk
     neg = itr.inverse_transform(itr.transform(["harsh times"]))
     assert neg[0] == ["<UNK>", "<UNK>", "<EOS>"]
+
+
+def test_word_sequence_iterator_cache_and_vocabulary():
+    sentences = sample_sentences * 4
+    itr = word_sequence_iterator(sentences, 2, 3, max_vocabulary_size=6)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for i in range(2):
+            c_itr = word_sequence_iterator(sentences, 2, 3,
+                                           max_vocabulary_size=6,
+                                           chunk_size=5, cache_dir=tmp_dir)
+            assert c_itr.vocabulary == itr.vocabulary
+            assert c_itr.words_counter == itr.words_counter
+            assert np.all(c_itr.encoded == itr.encoded)
+        assert len(os.listdir(tmp_dir)) == 2
+    finally:
+        shutil.rmtree(tmp_dir)
+    f_itr = word_sequence_iterator(["my balloons are nigh"], 1, 2,
+                                   vocabulary=itr.vocabulary)
+    assert f_itr.vocabulary == itr.vocabulary
+    ir = f_itr.inverse_transform(f_itr.transform(["my balloons are nigh"]))
+    assert ir[0] == [w if w in itr.vocabulary else "<UNK>"
+                     for w in ["my", "balloons", "are", "nigh", "<EOS>"]]
+
+
+def test_prefetch_iterator():
+    X = np.arange(100).reshape(50, 2)
+    base_itr = minibatch_iterator([X], 10, axis=0)
+    itr = prefetch_iterator(minibatch_iterator([X], 10, axis=0), 3)
+    for epoch in range(2):
+        for base_mb in base_itr:
+            assert np.all(base_mb == next(itr))
+        try:
+            next(itr)
+            raise AssertionError("Expected StopIteration at end of epoch")
+        except StopIteration:
+            pass
+    next(itr)
+    itr.reset()
+    assert np.all(next(itr) == X[:10])
+    itr.close()
+
+
+def test_shard_bounds():
+    X = np.arange(206).reshape(103, 2)
+    itr = minibatch_iterator([X], 10, axis=0)
+    full = [mb for mb in itr]
+    bounds = itr.shard_bounds(3)
+    assert bounds == [(0, 30), (30, 60), (60, 100)]
+    sharded = []
+    for start_index, stop_index in bounds:
+        shard_itr = minibatch_iterator([X], 10, axis=0,
+                                       start_index=start_index,
+                                       stop_index=stop_index)
+        sharded.extend([mb for mb in shard_itr])
+    assert len(sharded) == len(full)
+    assert all([np.all(a == b) for a, b in zip(full, sharded)])
+
+
+def test_minibatch_iterator_views():
+    X = np.arange(206).reshape(103, 2)
+    itr = minibatch_iterator([X], 10, axis=0)
+    mbs = [mb for mb in itr]
+    assert len(mbs) == 10
+    assert all([np.may_share_memory(mb, X) for mb in mbs])
+    assert np.all(mbs[-1] == X[90:100])
+
+
+def test_minibatch_iterator_shuffle():
+    X = np.arange(103)
+    for shuffle in ["full", "block"]:
+        itr = minibatch_iterator([X], 10, axis=0, shuffle=shuffle,
+                                 random_state=1999, block_size=20)
+        epoch1 = np.concatenate([mb for mb in itr])
+        epoch2 = np.concatenate([mb for mb in itr])
+        assert len(np.unique(epoch1)) == len(epoch1) == 100
+        assert np.any(epoch1 != epoch2)
+
+
+def test_list_iterator_buckets():
+    random_state = np.random.RandomState(1999)
+    lengths = random_state.randint(1, 100, size=50)
+    X = np.empty((len(lengths),), dtype=object)
+    for n, l in enumerate(lengths):
+        X[n] = np.ones((l, 2), dtype="float32")
+    itr = list_iterator([X], 5, axis=1)
+    bucket_itr = list_iterator([X], 5, axis=1,
+                               bucket_boundaries=[20, 40, 60, 80],
+                               shuffle="full", shuffle_buckets=True)
+    assert bucket_itr.padding_efficiency() > itr.padding_efficiency()
+    n_samples = 0
+    for mb in bucket_itr:
+        n_samples += mb[0].shape[1]
+    assert n_samples == 50
+
+
+class _fake_chunked_dataset(object):
+    # stands in for an h5py dataset, recording every read
+    def __init__(self, arr, chunks):
+        self.arr = arr
+        self.shape = arr.shape
+        self.dtype = arr.dtype
+        self.chunks = chunks
+        self.reads = []
+
+    def __len__(self):
+        return len(self.arr)
+
+    def __getitem__(self, key):
+        self.reads.append(key)
+        return self.arr[key]
+
+
+def test_chunked_readahead():
+    X = np.arange(500 * 4).reshape(500, 4).astype("float32")
+    h = _fake_chunked_dataset(X, (7, 4))
+    r = chunked_readahead(h, 2, chunk_bytes=10 * 4 * 4)
+    assert r.chunk_rows == 7
+    assert np.all(r[5:25, 2:4] == X[5:25, 2:4])
+    assert np.all(r[[3, 400, -2]] == X[[3, 400, -2]])
+    assert np.all(r[-1] == X[-1])
+    r.close()
+    assert all([k.start % 7 == 0 for k in h.reads])
+    assert len(r._cache) <= r.max_resident_chunks
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "X.npy")
+        np.save(path, X)
+        for shuffle in [None, "block"]:
+            itr = minibatch_iterator([X], 20, 0, shuffle=shuffle)
+            ra_itr = minibatch_iterator([path], 20, 0, shuffle=shuffle,
+                                        readahead=3)
+            assert isinstance(ra_itr.list_of_containers[0], chunked_readahead)
+            for i in range(2):
+                r = [mb for mb in itr]
+                ra_r = [mb for mb in ra_itr]
+                assert len(r) == len(ra_r)
+                for mb, ra_mb in zip(r, ra_r):
+                    assert np.all(mb == ra_mb)
+            ra_itr.list_of_containers[0].close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_minibatch_iterator_shared():
+    X = np.arange(103 * 3).reshape(103, 3).astype("float32")
+    X_sym = tensor.fmatrix()
+    i_sym = tensor.iscalar()
+    for shuffle in [None, "block"]:
+        for chunk_size in [None, 20]:
+            itr = minibatch_iterator([X], 10, 0, shuffle=shuffle,
+                                     random_state=3)
+            s_itr = minibatch_iterator([X], 10, 0, shuffle=shuffle,
+                                       random_state=3, shared=True,
+                                       shared_chunk_size=chunk_size)
+            f = theano.function([i_sym], X_sym,
+                                givens=s_itr.shared_givens([X_sym], i_sym))
+            for i in range(2):
+                r = [mb for mb in itr]
+                s_r = [f(ind) for ind in s_itr]
+                assert len(r) == len(s_r)
+                for mb, s_mb in zip(r, s_r):
+                    assert np.all(mb == s_mb)
+
+
+def test_packed_list_iterator():
+    random_state = np.random.RandomState(1999)
+    lengths = random_state.randint(2, 20, size=100)
+    X = [np.arange(l) + 100 * i for i, l in enumerate(lengths)]
+    itr = packed_list_iterator([X], 4, 25)
+    assert itr.padding_efficiency() > .9
+    seen = []
+    for X_mb, loss_mask, reset_mask in itr:
+        assert X_mb.shape == (25, 4, 1)
+        for b in range(4):
+            starts = list(np.where(reset_mask[:, b])[0])
+            stops = starts[1:] + [int(loss_mask[:, b].sum())]
+            for start, stop in zip(starts, stops):
+                i = X_mb[start, b, 0] // 100
+                assert np.all(X_mb[start:stop, b, 0] == X[i])
+                seen.append(i)
+    assert len(seen) == len(set(seen))
+
+
+def test_packed_binary_array():
+    random_state = np.random.RandomState(1999)
+    X = random_state.binomial(1, .3, size=(50, 13)).astype("float32")
+    packed = packed_binary_array(np.packbits(X.astype("uint8"), axis=1), 13)
+    assert packed.shape == X.shape
+    assert np.all(packed.unpack() == X)
+    assert np.all(packed[7] == X[7])
+    assert np.all(packed[3:9, 2:5] == X[3:9, 2:5])
+    itr = minibatch_iterator([X], 10, 0, shuffle="full")
+    p_itr = minibatch_iterator([packed], 10, 0, shuffle="full")
+    for mb, p_mb in zip(itr, p_itr):
+        assert p_mb.dtype == np.float32
+        assert np.all(mb == p_mb)
+
+
+def test_packed_binary_array_readahead():
+    random_state = np.random.RandomState(1999)
+    X = random_state.binomial(1, .3, size=(3000, 20)).astype("float32")
+    packed = packed_binary_array(np.packbits(X.astype("uint8"), axis=1), 20)
+    itr = minibatch_iterator([packed], 100, 0, readahead=4)
+    for n, mb in enumerate(itr):
+        assert np.all(mb == X[n * 100:(n + 1) * 100])
+    # buffers reused by the container must not alias cached chunks
+    r = chunked_readahead(packed, n_chunks_ahead=0, chunk_rows=100,
+                          max_resident_chunks=10)
+    first = r[0:100]
+    assert np.all(first == X[:100])
+    r[100:200]
+    r[200:300]
+    assert np.all(r[0:100] == X[:100])
+    r = chunked_readahead(packed, n_chunks_ahead=4, chunk_rows=100)
+    for i in range(0, 3000, 50):
+        assert np.all(r[i:i + 50] == X[i:i + 50])
+    r.close()
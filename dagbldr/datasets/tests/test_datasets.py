@@ -1,6 +1,7 @@
 from dagbldr.datasets import load_digits
 from dagbldr.datasets import load_iris
 from nose.tools import assert_equal
+import numpy as np
 
 
 def test_digits():
@@ -11,3 +12,15 @@ def test_digits():
 def test_iris():
     iris = load_iris()
     assert_equal(len(iris["data"]), len(iris["target"]))
+
+
+def test_parse_fer_csv():
+    from dagbldr.datasets.datasets import _parse_fer_csv
+    pixels = np.arange(2 * 48 * 48).reshape(2, -1) % 256
+    raw = "emotion,pixels,Usage\r\n"
+    for t, p in zip([3, 5], pixels):
+        raw += "%i,%s,Training\r\n" % (t, " ".join([str(pi) for pi in p]))
+    data, target = _parse_fer_csv(raw.encode("utf-8"))
+    assert data.dtype == np.uint8
+    assert np.all(data == pixels)
+    assert_equal(list(target), [3, 5])
@@ -5,7 +5,7 @@ import theano
 import numpy as np
 
 from ..utils import concatenate, as_shared
-from ..core import get_logger, get_type, set_shared
+from ..core import get_logger, get_type, get_shared, set_shared
 from .nodes import projection
 from .nodes import np_tanh_fan_uniform
 from .nodes import np_variance_scaled_uniform
@@ -35,9 +35,14 @@ def simple_fork(list_of_inputs, list_of_input_dims, proj_dim, name=None,
 
 
 def simple(step_input, previous_hidden, hidden_dim, mask=None,
-           name=None, random_state=None, strict=True, init_func=np_ortho):
+           name=None, random_state=None, strict=True, init_func=np_ortho,
+           reset=None):
     """
     hidden_dim 1x
+
+    reset is an optional (minibatch_size,) vector for this step, 1 where a
+    new sequence starts (as from packed_list_iterator). The previous
+    hidden state of those rows is zeroed before the update.
     """
     if name is None:
         name = get_name()
@@ -56,6 +61,8 @@ def simple(step_input, previous_hidden, hidden_dim, mask=None,
         np_W = init_func((hidden_dim, hidden_dim), random_state)
         W = as_shared(np_W)
         set_shared(W_name, W)
+    if reset is not None:
+        previous_hidden = previous_hidden * (1. - reset.dimshuffle(0, 'x'))
     return tensor.tanh(step_input + tensor.dot(previous_hidden, W))
 
 
@@ -163,9 +170,14 @@ def lstm_fork(list_of_inputs, list_of_input_dims, proj_dim, name=None,
 
 
 def lstm(step_input, previous_state, list_of_input_dims, hidden_dim,
-         name=None, random_state=None, strict=True, init_func=np_ortho):
+         name=None, random_state=None, strict=True, init_func=np_ortho,
+         reset=None):
     """
     hidden_dim is really 2x hidden_dim
+
+    reset is an optional (minibatch_size,) vector for this step, 1 where a
+    new sequence starts (as from packed_list_iterator). The previous
+    hidden and cell state of those rows are zeroed before the update.
     """
     if name is None:
         name = get_name()
@@ -179,6 +191,9 @@ def lstm(step_input, previous_state, list_of_input_dims, hidden_dim,
     def _s(p, d):
         return p[:, d * dim:(d+1) * dim]
 
+    if reset is not None:
+        previous_state = previous_state * (1. - reset.dimshuffle(0, 'x'))
+
     previous_cell = _s(previous_state, 1)
     previous_st = _s(previous_state, 0)
 
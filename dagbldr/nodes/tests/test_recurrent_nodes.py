@@ -107,3 +107,44 @@ def run_lstm():
     f = theano.function([X_sym, y_sym, h0], [cost, h], updates=updates,
                         mode="FAST_COMPILE")
     f(X, y, h_init)
+
+
+def test_simple_reset():
+    del_shared()
+    n_hid = 4
+    random_state = np.random.RandomState(42)
+    in_sym = tensor.fmatrix()
+    h_sym = tensor.fmatrix()
+    reset_sym = tensor.fvector()
+    h = simple(in_sym, h_sym, n_hid, name="rec", random_state=random_state,
+               reset=reset_sym)
+    f = theano.function([in_sym, h_sym, reset_sym], h, mode="FAST_COMPILE")
+    in_t = np.ones((2, n_hid)).astype("float32")
+    h_tm1 = np.ones((2, n_hid)).astype("float32")
+    r = f(in_t, h_tm1, np.array([1., 0.]).astype("float32"))
+    assert np.allclose(r[0], np.tanh(in_t[0]))
+    assert not np.allclose(r[1], np.tanh(in_t[1]))
+
+
+def test_lstm_reset():
+    del_shared()
+    n_in = 3
+    n_hid = 4
+    random_state = np.random.RandomState(42)
+    in_sym = tensor.fmatrix()
+    h_sym = tensor.fmatrix()
+    reset_sym = tensor.fvector()
+    h = lstm(in_sym, h_sym, [n_in], n_hid, name="rec",
+             random_state=random_state, reset=reset_sym)
+    f = theano.function([in_sym, h_sym, reset_sym], h, mode="FAST_COMPILE")
+    in_t = np.ones((2, 4 * n_hid)).astype("float32")
+    reset = np.array([1., 0.]).astype("float32")
+    h_zero = np.zeros((2, 2 * n_hid)).astype("float32")
+    r_zero = f(in_t, h_zero, reset)
+    # hidden half, then cell half, of the previous state set on its own
+    for half in [0, 1]:
+        h_tm1 = np.zeros((2, 2 * n_hid)).astype("float32")
+        h_tm1[:, half * n_hid:(half + 1) * n_hid] = 1.
+        r = f(in_t, h_tm1, reset)
+        assert np.allclose(r[0], r_zero[0])
+        assert not np.allclose(r[1], r_zero[1])
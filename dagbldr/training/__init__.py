@@ -1,4 +1,4 @@
 __version_info__ = ('0', '0', '1')
 __version__ = '.'.join(__version_info__)
 
-from ..core import TrainingLoop
+from ..core import TrainingLoop, PhaseProfiler
@@ -1,7 +1,25 @@
 from nose.tools import assert_raises
+from collections import OrderedDict
+import os
+import json
+import shutil
+import tempfile
+import logging
+from io import BytesIO
+import numpy as np
+import theano
 
 from dagbldr.utils import make_character_level_from_text, convert_to_one_hot
 from dagbldr.utils import make_embedding_minibatch
+from dagbldr.utils import ParameterSnapshot, RunningStatistics
+from dagbldr.utils import PhaseProfiler, RingBufferHandler
+from dagbldr.utils import record_artifact, forget_artifact
+from dagbldr.utils import get_latest_artifact, get_best_artifact
+from dagbldr.utils import RaggedArray
+from dagbldr.utils import save_weight_store, load_weight_store
+from dagbldr.utils import load_weight_store_index
+from dagbldr.core.core import _TimedWriterChannel
+from dagbldr.externals import dill
 from dagbldr.datasets import load_digits
 
 digits = load_digits()
@@ -46,5 +64,180 @@ def test_character_level_from_text():
     if new_clean[-1] != m["EOS"]:
         raise AssertionError("Failed to add EOS tag")
 
+
+def test_parameter_snapshot():
+    W = theano.shared(np.ones((3, 2)).astype("float32"))
+    X_sym = theano.tensor.fmatrix()
+    predict_function = theano.function([X_sym], theano.tensor.dot(X_sym, W))
+    checkpoint_dict = {"predict_function": predict_function,
+                       "train_costs": [1.]}
+    snapshot = ParameterSnapshot(checkpoint_dict)
+    snap = snapshot.take()
+    W.set_value(np.zeros((3, 2)).astype("float32"))
+    checkpoint_dict["train_costs"].append(0.)
+    assert np.all(snap.get_function_values("predict_function")[0] == 1.)
+    assert snap.results["train_costs"] == [1.]
+    f = BytesIO()
+    snap.dump(f)
+    f.seek(0)
+    loaded = dill.load(f)
+    X = np.ones((1, 3)).astype("float32")
+    assert np.all(loaded["predict_function"](X) == 3.)
+    snap.release()
+    assert len(snapshot.free_buffers) == 2
+    # snapshots of items dropped by a full writer channel are handed back
+    channel = _TimedWriterChannel(1, max_pending=1)
+    for n in range(3):
+        snap = snapshot.take()
+        channel.put(n, (float(n), None, ("w", snap), ("c", snap)))
+    assert len(snapshot.free_buffers) == 1
+
+
+def test_weight_store():
+    weights = OrderedDict()
+    weights["W_0"] = np.arange(6).reshape(2, 3).astype("float32")
+    weights["b_1"] = np.arange(3).astype("float64")
+    weights["c_2"] = np.arange(5).astype("int8")
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        save_path = os.path.join(tmp_dir, "model_weights_1.json")
+        save_weight_store(save_path, weights)
+        loaded = load_weight_store(save_path)
+        assert list(loaded.keys()) == list(weights.keys())
+        for k in weights.keys():
+            assert loaded[k].dtype == weights[k].dtype
+            assert np.all(loaded[k] == weights[k])
+        del loaded
+        # results JSON can not encode are stored as their repr
+        save_weight_store(save_path, weights,
+                          results={"train_costs": [1., 0.5],
+                                   "opt": object()})
+        results = load_weight_store_index(save_path)["results"]
+        assert results["train_costs"] == [1., 0.5]
+        assert results["opt"].startswith("<object")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_running_statistics():
+    costs = np.random.RandomState(1999).rand(3000)
+    stats = RunningStatistics(initial_size=16, reservoir_size=5000)
+    for c in costs:
+        stats.append(c)
+    first_view = stats.values()
+    assert len(stats) == len(costs)
+    assert np.allclose(stats.values(), costs)
+    assert np.allclose(stats.running_mean(),
+                       np.cumsum(costs) / (np.arange(len(costs)) + 1))
+    assert np.allclose(stats.mean(), np.mean(costs))
+    assert np.allclose(stats.quantiles((0.5,)), np.median(costs))
+    stats.reset()
+    stats.append(-1.)
+    # views handed out before reset are untouched
+    assert np.allclose(first_view, costs)
+    assert stats.mean() == -1.
+
+
+def test_phase_profiler():
+    profiler = PhaseProfiler(ring_size=10)
+    for i in range(20):
+        profiler.record("compute", float(i), 0.001 * i)
+    profiler.record("fetch", 20., 0.002)
+    summary = profiler.summary()
+    # only the last 10 records are kept
+    assert np.allclose(summary["profile_compute_p50_auto"], 15.)
+    assert np.allclose(summary["profile_fetch_p99_auto"], 2.)
+    assert "profile_fetch_p50_auto" not in profiler.summary(21)
+
+
+def test_ring_buffer_handler():
+    handler = RingBufferHandler(capacity=3)
+    test_logger = logging.getLogger("test_ring_buffer_handler")
+    test_logger.propagate = False
+    test_logger.addHandler(handler)
+    for i in range(5):
+        test_logger.warning("message %i" % i)
+    lines, count = handler.tail()
+    assert count == 5
+    assert lines == ["message %i\n" % i for i in range(2, 5)]
+    test_logger.warning("message 5")
+    lines, count = handler.tail(count)
+    assert lines == ["message 5\n"]
+    assert count == 6
+    test_logger.removeHandler(handler)
+
+
+def test_artifact_manifest():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(tmp_dir, "model_checkpoint_%i.pkl" % i)
+                 for i in range(1, 4)]
+        for path, objective in zip(paths, [3., 1., 2.]):
+            with open(path, "w") as f:
+                f.write("0")
+            record_artifact(path, objective)
+        assert get_latest_artifact("checkpoint",
+                                   checkpoint_dir=tmp_dir) == paths[2]
+        assert get_best_artifact("checkpoint",
+                                 checkpoint_dir=tmp_dir) == paths[1]
+        forget_artifact(paths[1])
+        assert get_best_artifact("checkpoint",
+                                 checkpoint_dir=tmp_dir) == paths[2]
+        assert get_latest_artifact("weights", checkpoint_dir=tmp_dir) is None
+        # a rewrite by another process keeping the same mtime is still seen
+        manifest_path = os.path.join(tmp_dir, "dagbldr_manifest.json")
+        st = os.stat(manifest_path)
+        with open(manifest_path, "r") as f:
+            stored = json.load(f)
+        del stored["artifacts"][os.path.basename(paths[2])]
+        with open(manifest_path + ".other", "w") as f:
+            json.dump(stored, f)
+        os.rename(manifest_path + ".other", manifest_path)
+        os.utime(manifest_path, (st.st_atime, st.st_mtime))
+        assert get_latest_artifact("checkpoint",
+                                   checkpoint_dir=tmp_dir) == paths[0]
+        # a list is forgotten with a single manifest write
+        forget_artifact(paths)
+        assert get_latest_artifact("checkpoint",
+                                   checkpoint_dir=tmp_dir) is None
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_ragged_array():
+    random_state = np.random.RandomState(1999)
+    sequences = [random_state.rand(random_state.randint(1, 10), 3)
+                 for i in range(7)]
+    ragged = RaggedArray(sequences)
+    for slot in [None, 0, 0]:
+        data, mask = ragged.padded(np.array([4, 1, 6]), slot=slot)
+        for n, i in enumerate([4, 1, 6]):
+            length = len(sequences[i])
+            assert np.all(data[:length, n] == sequences[i])
+            assert np.all(data[length:, n] == 0)
+            assert np.all(mask[:length, n] == 1)
+            assert np.all(mask[length:, n] == 0)
+
+
+def test_embedding_minibatch_buffers():
+    fake_str_int = [[1, 5, 7, 1, 6, 2], [2, 3, 6, 2], [3, 3, 3, 3, 3, 3, 3]]
+    rows, mask = make_embedding_minibatch(fake_str_int, slice(0, 2))
+    assert list(rows[1][:4]) == [2, 3, 6, 2]
+    # edits to the list show up in the next minibatch
+    fake_str_int[1][0] = 5
+    rows, mask = make_embedding_minibatch(fake_str_int, slice(0, 2))
+    assert list(rows[1][:5]) == [5, 3, 6, 2, 0]
+    ragged = RaggedArray(fake_str_int)
+    rows2, mask2 = make_embedding_minibatch(ragged, slice(0, 2))
+    assert np.all(np.array(rows2) == np.array(rows))
+    assert np.all(mask2 == mask)
+    # minibatches are fresh arrays unless a slot is given
+    rows3, mask3 = make_embedding_minibatch(ragged, slice(1, 3))
+    assert np.all(np.array(rows2) == np.array(rows))
+    rows4, mask4 = make_embedding_minibatch(ragged, slice(1, 3), slot=0)
+    rows5, mask5 = make_embedding_minibatch(ragged, slice(0, 2), slot=0)
+    assert np.may_share_memory(rows4[0], rows5[0])
+
+
 if __name__ == "__main__":
     test_make_embedding_minibatch()
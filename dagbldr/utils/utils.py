@@ -8,10 +8,9 @@ from collections import OrderedDict
 
 from ..core import safe_zip
 from ..core import get_type
-from ..core import get_file_matches
+from ..core import get_latest_artifact
 from ..core import get_checkpoint_dir
-from ..core import dunpickle
-from ..core import set_shared_variables_in_function
+from ..core import load_weights
 from ..core import get_lib_shared_params
 
 _type = get_type()
@@ -138,30 +137,14 @@ def create_or_continue_from_checkpoint_dict(lcls, append_name="best"):
         A checkpoint dictionary suitable for passing to a training loop
 
     """
-    sorted_paths = get_file_matches("*.npz", append_name)
-    if len(sorted_paths) < 1:
+    last_weights_path = get_latest_artifact("weights", append_name)
+    if last_weights_path is None:
         print("No saved results found in %s, creating!" % get_checkpoint_dir())
         return create_checkpoint_dict(lcls)
 
-    last_weights_path = sorted_paths[-1]
     print("Loading in weights from %s" % last_weights_path)
-    last_weights = np.load(last_weights_path)
-
-    checkpoint_dict = {}
-
-    sorted_paths = get_file_matches("*_results_*.pkl", append_name)
-    last_results_path = sorted_paths[-1]
-    print("Loading in results from %s" % last_results_path)
-
-    checkpoint_dict["previous_results"] = dunpickle(
-        last_results_path)
-
-    for k, v in lcls.items():
-        if isinstance(v, theano.compile.function_module.Function):
-            matches = [name for name in last_weights.keys() if k in name]
-            sorted_matches = sorted(
-                matches, key=lambda x: int(x.split("_")[-1]))
-            matching_values = [last_weights[s] for s in sorted_matches]
-            set_shared_variables_in_function(v, matching_values)
-            checkpoint_dict[k] = v
+    checkpoint_dict = create_checkpoint_dict(lcls)
+    # Results saved with the weights are the training history for the loop
+    results = load_weights(last_weights_path, checkpoint_dict)
+    checkpoint_dict.update(results)
     return checkpoint_dict